@@ -1,10 +1,10 @@
 # app_types.py
-from typing import TypedDict, List, Dict, Literal, Optional, Any, Set
+from typing import TypedDict, List, Dict, Literal, Optional, Any, Set, Tuple
 
 # --- 基本的なデータ型 ---
 StatKey = str
 StatName = str
-BuffType = Literal["単純加算", "スタック形式", "ステータス変換", "ダメージ倍率アップ"]
+BuffType = Literal["単純加算", "スタック形式", "ステータス変換", "ダメージ倍率アップ", "共鳴エネルギー獲得(固定)", "共鳴エネルギー獲得(変動)"]
 AttributeName = Literal["", "気動", "焦熱", "電導", "凝縮", "消滅", "回折"]
 SkillCategory = Literal["", "基本攻撃手段", "共鳴スキル", "共鳴回路", "共鳴解放", "変奏スキル", "終奏スキル", "その他"]
 
@@ -29,6 +29,7 @@ class Echo(TypedDict):
     cost: int
     main_stat: Optional[EchoStat]
     sub_stats: List[EchoStat]
+    harmony_name: Optional[str] # 所持音骸のハーモニー (セット) 名
 
 # --- データファイル構造 ---
 class SkillData(TypedDict):
@@ -42,6 +43,8 @@ class SkillData(TypedDict):
     resonance_energy_gain_scaling: Optional[float]
     skill_category: SkillCategory
     is_healing: Optional[bool] # 回復効果の有無
+    abnormal_applications: Optional[Dict[str, int]] # 付与する異常効果のスタック数 (例: {"騒光効果": 2})
+    hit_count: Optional[int] # 範囲攻撃で当たる敵の数 (複数の敵の評価で使用)
 
 class BuffEffect(TypedDict):
     """
@@ -164,6 +167,31 @@ class Action(TypedDict):
     triggered_single_target_buffs: Optional[List[str]]
     # NEW: 一時的バフの手動設定（無効化、スタック数）を保持
     transient_buff_manual_settings: Optional[Dict[str, Any]]
+    abnormal_applications: Optional[Dict[str, int]] # skill_data の値をこのアクションだけ上書きする
+    hit_count: Optional[int] # 複数の敵を評価するときに当たる敵の数
+
+class DamageComponents(TypedDict, total=False):
+    # 表示用の文字列は format_calculation_details で必要になったときに作る
+    ref_stat_key: str
+    ref_stat_value: float
+    skill_multiplier: float
+    multiplier_bonus: float
+    final_multiplier: float
+    base_damage: float
+    damage_types: List[str]
+    total_dmg_up: float
+    elemental_dmg_up: float
+    skill_type_dmg_up: float
+    damage_up_bonus: float
+    total_dmg_boost: float
+    damage_boost_bonus: float
+    crit_rate: float
+    crit_damage: float
+    crit_bonus: float
+    defense_bonus: float
+    resistance_bonus: float
+    dmg_taken_bonus: float
+    error: str # 計算中に例外が起きたときだけ
 
 class LogEntry(TypedDict):
     character: str
@@ -172,14 +200,25 @@ class LogEntry(TypedDict):
     damage: float
     total_damage: float
     concerto_energy: float
-    calculation_details: Optional[Dict[str, Any]]
+    calculation_details: Optional[DamageComponents] # 異常効果のアクションでは空
+
+class ActionAnnotation(TypedDict, total=False):
+    action_index: int # フェーズ内のアクションの位置
+    active_buffs: Dict[str, Any]
+    concerto_energy_gain: float
+    resonance_energy_gain: float
+    concerto_energy_total: float
+    resonance_energy_total: float
+    transient_buff_manual_settings: Dict[str, Any]
+    visible_buffs_for_display: Dict[str, Any]
 
-class RotationPhaseResult(TypedDict):
+class RotationPhaseResult(TypedDict, total=False):
     log: List[LogEntry]
     total_damage: float
     total_time: float
     final_concerto_energy: Dict[str, float]
     final_resonance_energy: Dict[str, float]
+    annotations: List[ActionAnnotation] # annotate_actions=False のときだけ
 
 class SimulationStats(TypedDict):
     simulations_count: int
@@ -192,12 +231,227 @@ class SimulationStats(TypedDict):
     dps_max: float
     dps_min: float
 
+class EnemySweepResult(TypedDict):
+    enemy_levels: Any # np.ndarray (レベル数,)
+    enemy_resistances: Any # np.ndarray (耐性数,) 単位は%
+    total_damage: Any # np.ndarray (レベル数, 耐性数)
+    dps: Any # np.ndarray (レベル数, 耐性数)
+    total_time: float
+
+class InfeasibleAction(TypedDict):
+    phase: str # "initial" / "loop" / "loop_2" ...
+    index: int # フェーズ内のアクション番号
+    skill: str
+    kind: str # "共鳴解放" or "終奏スキル"
+    energy: float # 発動時点のエネルギー
+    required: float
+
+class EnergyFeasibilityResult(TypedDict):
+    feasible: bool
+    first_infeasible: Dict[str, InfeasibleAction] # キャラ名 -> 最初の不成立アクション
+    final_concerto_energy: Dict[str, float]
+    final_resonance_energy: Dict[str, float]
+
+class MinEfficiencyResult(TypedDict):
+    character: str
+    required_efficiency: float # 全ての共鳴解放を撃つのに必要な共鳴効率 (バフ抜き, %)
+    current_efficiency: float
+    surplus: float # current - required
+    feasible: bool
+    binding_action: Optional[InfeasibleAction] # 必要量を決めている共鳴解放
+    method: str # "closed_form" or "bisection"
+
+class RotationSearchResult(TypedDict):
+    rotation: List[Action] # 見つかった最良のアクション列
+    total_damage: float
+    num_actions: int
+    states_evaluated: int # メモ化されずに実際に計算した状態遷移の数
+    timed_out: bool
+    final_concerto_energy: Dict[str, float]
+    final_resonance_energy: Dict[str, float]
+
+class OwnedEchoCandidate(TypedDict):
+    cost_combo: str
+    harmony: str # "ハーモニー1+ハーモニー2" (5セットなら同名が2つ)
+    echo_list: List[Echo]
+    linear_score: float # 限界価値による近似スコア + セット効果分
+    damage: float # 実際のローテーション総ダメージ
+
+class OwnedEchoOptimizationResult(TypedDict):
+    best_echo_list: List[Echo]
+    best_damage: float
+    best_cost_combo: str
+    best_harmony: str
+    marginal_values: Dict[str, float] # ステータスキー -> 1あたりのダメージ増分
+    set_bonus_by_harmony: Dict[str, float] # ハーモニー候補 -> セット効果によるダメージ増分
+    echoes_kept: Dict[str, int] # コスト -> 事前絞り込み後の音骸数
+    candidates_evaluated: int
+    energy_filtered: int # エネルギー的に成立しない・共鳴効率が min_efficiency に届かないため評価しなかった組み合わせの数
+    ranking: List[OwnedEchoCandidate]
+
+class BuildSearchEntry(TypedDict):
+    rank: int
+    cost_combo: str
+    echo_list: List[Echo]
+    score: float # metric で選んだ指標の値
+    total_damage: float # 期待値
+    damage_std_dev: float # 会心による標準偏差
+    total_time: float
+    dps: float
+
+class BuildSearchResult(TypedDict):
+    metric: str # "total_damage" / "dps" / "crit_adjusted"
+    candidates_evaluated: int # この呼び出しで進めた候補数 (カーソルの移動量)
+    duplicates_skipped: int # 上位に同じステータス合計のビルドが残っていて評価を省いた件数
+    energy_filtered: int # エネルギー的に成立しない・共鳴効率が min_efficiency に届かないため評価しなかった件数
+    cursor: int # 次に評価する候補の通し番号 (再開位置)
+    total_candidates: int
+    completed: bool
+    results: List[BuildSearchEntry]
+
+class HeuristicSearchResult(TypedDict):
+    metric: str
+    candidates_evaluated: int # 実際に評価した候補数
+    energy_filtered: int # エネルギー的に成立しない・共鳴効率が min_efficiency に届かないため評価しなかった候補数
+    total_candidates: int # 探索空間全体の候補数
+    elapsed_seconds: float
+    results: List[BuildSearchEntry]
+
+class SubstatRollDistributionResult(TypedDict):
+    current_damage: float # 現在のサブステ数値でのダメージ
+    expected_damage: float # サブステ段階を分布で引いたときの期待値
+    damage_std_dev: float
+    percentiles: Dict[float, float] # パーセンタイル -> ダメージ
+    damage_by_tier: List[float] # 全サブステを同じ段階にしたときのダメージ (8段階)
+    tier_probabilities: List[float]
+    num_sub_stats: int
+    num_samples: int
+
+class EchoUpgradeEstimate(TypedDict):
+    slot: int # 入れ替える音骸の位置 (0-4)
+    cost: int # 新しい音骸のコスト
+    current_echo_name: str
+    current_damage: float
+    expected_gain: float # E[新しい音骸のダメージ - 現在]
+    expected_improvement: float # E[max(0, 増分)] (悪ければ入れ替えない場合)
+    improvement_probability: float # 現在より良くなる確率
+    gain_percentiles: Dict[float, float]
+    expected_gain_by_main_stat: Dict[str, float] # メインステ名 -> そのメインステを引いたときの期待増分
+
+class ParetoBuildEntry(TypedDict):
+    cost_combo: str
+    echo_list: List[Echo]
+    total_damage: float # 期待値 (厳密評価)
+    damage_std_dev: float # 会心による標準偏差 (厳密評価)
+    total_time: float
+    dps: float
+    resonance_efficiency: float # バフ抜きの共鳴効率
+    efficiency_surplus: Optional[float] # resonance_efficiency - 必要な共鳴効率 (必要量が決まらなければ None)
+    estimated_total_damage: float # 近似モデルでの値 (足切りに使ったもの)
+    estimated_damage_std_dev: float
+    simulation_stats: Optional[SimulationStats] # num_simulations > 0 のときだけ
+
+class ParetoSearchResult(TypedDict):
+    character: str
+    required_efficiency: Optional[float] # 共鳴エネルギーが足りずどの共鳴効率でも撃てないときは None
+    total_candidates: int # 探索空間全体の候補数
+    candidates_evaluated: int # 近似モデルで評価した候補数
+    energy_filtered: int # 共鳴効率の不足で除いた候補数
+    bound_survivors: int # 近似値の区間で支配されずに残った候補数
+    exact_evaluations: int # ローテーションを計算し直した候補数
+    truncated: bool # max_exact_evaluations で打ち切った (front に未評価の候補に支配される点が残りうる)
+    bounds_violated: bool # 厳密値が近似値 ±bound_tolerance から外れた候補があった (段階1の足切りで前線の点を捨てた可能性がある)
+    max_model_error: float # 厳密評価と近似モデルの相対誤差の最大値 (bound_tolerance の目安)
+    elapsed_seconds: float
+    front: List[ParetoBuildEntry] # 総ダメージの降順
+
+class RotationPlanStep(TypedDict):
+    action_index: int # フェーズ内のアクションの位置
+    character: str
+    skill: str
+    skill_data: Optional[Dict]
+    stacks: int
+    is_abnormal: bool
+    active_buffs: Dict[str, Any] # このアクションで有効な持続バフ
+    effects: List[Tuple] # 適用順の効果レコード ("add", キー, 値) / ("convert", 効果, 武器ランク)
+    transient_additions: List[Tuple[str, float]] # 一時バフによる加算
+    energy: Dict[str, Any] # エネルギー獲得の内訳 (共鳴効率に比例する分は係数)
+    abnormal_applications: Dict[str, int]
+
+class RotationPlan(TypedDict):
+    version: int
+    input_hash: str
+    character_names: List[str]
+    character_attributes: Dict[str, Optional[str]]
+    resonance_energy_required: Dict[str, float]
+    initial: List[RotationPlanStep]
+    loop: List[RotationPlanStep]
+    initial_time: float
+    loop_time: float
+
+class RotationPlanEvaluation(TypedDict):
+    initial_damages: List[float]
+    loop_damages: List[float]
+    initial_damage: float
+    loop_damage: float
+    total_damage: float # 初動 + ループ x num_loops
+    total_time: float
+    dps: float
+    final_concerto_energy: Dict[str, float]
+    final_resonance_energy: Dict[str, float]
+
+class MultiTargetResult(TypedDict):
+    targets: List[Dict[str, Any]] # 評価した敵 (enemy_info と同じ形)
+    per_target_damage: List[float] # 初動 + ループ x num_loops
+    per_target_dps: List[float]
+    total_damage: float # 全ての敵の合計
+    total_time: float
+    dps: float
+    initial_action_damages: Any # np.ndarray (初動のダメージを持つアクション数, 敵の数)
+    loop_action_damages: Any # np.ndarray (ループのダメージを持つアクション数, 敵の数)
+
+class AbnormalTick(TypedDict):
+    time: float # 戦闘開始からの秒数
+    effect: str
+    stacks: int
+    damage: float
+
+class AbnormalTimelineResult(TypedDict):
+    total_damage: float
+    damage_by_effect: Dict[str, float]
+    tick_count_by_effect: Dict[str, int]
+    max_stacks_by_effect: Dict[str, int] # 継続ダメージ型で到達した最大スタック数
+    ticks: List[AbnormalTick] # 時刻順
+    end_time: float
+
+class PhaseProfileReport(TypedDict):
+    phases: int # _process_phase の呼び出し回数
+    actions: int
+    stage_seconds: Dict[str, float] # persistent_buffs / transient_buffs / damage / energy / display
+    stage_calls: Dict[str, int]
+    apply_buffs_calls: int
+    apply_buffs_seconds: float
+    trigger_checks: Dict[str, int] # バフキー -> 発動判定の回数
+    trigger_hits: Dict[str, int] # バフキー -> 発動した回数
+
 class CalculationResult(TypedDict):
     initial_phase: RotationPhaseResult
     loop_phase: RotationPhaseResult
     # NEW: シミュレーション統計情報を追加
     simulation_stats: Optional[SimulationStats]
 
+class ScenarioComparisonRow(TypedDict):
+    name: str
+    rank: int
+    character_names: List[str]
+    total_damage: float
+    total_time: float
+    dps: float
+    damage_by_character: Dict[str, float]
+    damage_share_by_character: Dict[str, float] # 0.0〜1.0
+    simulation_stats: Optional[SimulationStats]
+    error: Optional[str]
+
 # --- AppState ---
 class AppStateData(TypedDict):
     team_builds: List[Build]
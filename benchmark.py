@@ -0,0 +1,175 @@
+# benchmark.py
+"""
+calculator の主要処理を、data/scenarios.json の保存済みシナリオと現在のゲームデータで計測する。
+
+    python benchmark.py --output bench.json
+    python benchmark.py --baseline bench.json --output bench_new.json
+
+結果は JSON で出力し、--baseline を渡すと項目ごとに基準との比 (current / baseline) を付ける。
+"""
+import argparse
+import json
+import platform
+import random
+import statistics
+import sys
+import time
+from collections import defaultdict
+from datetime import datetime
+from itertools import islice
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+from calculator import (
+    calculate_base_stats, apply_buffs, process_rotation, run_simulation_with_rng, gather_team_buffs,
+    generate_build_combinations, generate_owned_echo_builds
+)
+from constants import ECHO_DATA, KEY_CHARACTER_NAME, KEY_CONSTELLATION, KEY_WEAPON_RANK, KEY_ECHO_LIST
+from game_data import GameData, DEFAULT_DATA_DIR
+from scenarios import DEFAULT_SCENARIOS_PATH, load_scenarios, normalize_scenario
+
+BENCHMARK_FORMAT_VERSION = 1
+DEFAULT_SIMULATION_COUNTS = [10, 100, 1000]
+DEFAULT_SLICE_SIZE = 2000
+DEFAULT_REPEATS = 5
+DEFAULT_THRESHOLD = 0.10 # 基準から10%以上遅くなったら regression
+
+# generate_build_combinations の計測に使う固定の探索条件
+BUILD_COMBINATION_CASES = {
+    "priority": dict(selected_costs=["4-3-3-1-1", "4-4-1-1-1"], eff_subs_per_echo=3, sub_level_index=7,
+                     selected_eff_subs={"クリティカル率": "必須", "クリティカルダメージ": "必須", "攻撃力%": "優先", "共鳴解放ダメージアップ": "通常", "攻撃力(数値)": "通常"},
+                     selected_eff_mains={"4": ["クリティカル率", "クリティカルダメージ"], "3": ["攻撃力%", "気動ダメージアップ"], "1": ["攻撃力%"]},
+                     full_search_mode=False),
+    "full_search": dict(selected_costs=["4-3-3-1-1"], eff_subs_per_echo=5, sub_level_index=7,
+                        selected_eff_subs={name: "通常" for name in ECHO_DATA["sub_stat_values"]},
+                        selected_eff_mains={"4": ["クリティカル率", "クリティカルダメージ"], "3": ["攻撃力%", "気動ダメージアップ"], "1": ["攻撃力%"]},
+                        full_search_mode=True),
+}
+
+def time_call(func: Callable[[], object], repeats: int = DEFAULT_REPEATS, inner_loops: int = 1) -> Dict[str, float]:
+    """func を repeats 回 (各 inner_loops 回ずつ) 実行し、1回あたりの秒数の中央値・最小値を返す"""
+    samples = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for _ in range(inner_loops):
+            func()
+        samples.append((time.perf_counter() - start) / inner_loops)
+    return {"median_s": statistics.median(samples), "min_s": min(samples), "repeats": repeats, "inner_loops": inner_loops}
+
+def _synthetic_owned_echoes(team_builds: List[Dict], per_cost: int, seed: int = 0) -> Dict[str, List[Dict]]:
+    """シナリオの音骸を種にした、決まった内容の所持音骸インベントリ (generate_owned_echo_builds 用)"""
+    rng = random.Random(seed)
+    seeds = [e for b in team_builds for e in (b.get(KEY_ECHO_LIST) or []) if e and e.get("cost")]
+    sub_names = list(ECHO_DATA["sub_stat_values"])
+    owned = defaultdict(list)
+    for cost in ("4", "3", "1"):
+        for i in range(per_cost):
+            base = next((e for e in seeds if str(e.get("cost")) == cost), None)
+            main = rng.choice(ECHO_DATA["main_stats"][cost])
+            subs = []
+            for name in rng.sample(sub_names, 5):
+                data = ECHO_DATA["sub_stat_values"][name]
+                subs.append({"name": name, "key": data["key"], "value": rng.choice(data["values"])})
+            owned[cost].append({"name": (base or {}).get("name") or f"Echo{cost}_{i}", "cost": int(cost), "main_stat": dict(main), "sub_stats": subs})
+    return dict(owned)
+
+def run_benchmarks(scenarios_path: str = DEFAULT_SCENARIOS_PATH, names: Optional[List[str]] = None, data_dir: str = DEFAULT_DATA_DIR,
+                   simulation_counts: Optional[List[int]] = None, slice_size: int = DEFAULT_SLICE_SIZE, repeats: int = DEFAULT_REPEATS,
+                   num_loops: int = 1) -> Dict[str, Dict[str, float]]:
+    """各シナリオについて主要処理を計測し、"シナリオ名/項目名" -> 計測値 の辞書を返す"""
+    game_data = GameData.load(data_dir)
+    results: Dict[str, Dict[str, float]] = {}
+    for name, scenario in load_scenarios(scenarios_path, names).items():
+        s = normalize_scenario(scenario, game_data)
+        team_builds = s["team_builds"]
+        all_buffs = gather_team_buffs(team_builds)
+        main_build = next((b for b in team_builds if b.get(KEY_CHARACTER_NAME)), None)
+        if main_build is None: continue
+        char_name = main_build[KEY_CHARACTER_NAME]
+        _, base_raw, _ = calculate_base_stats(main_build)
+        all_active = {k: True for k in all_buffs}
+
+        results[f"{name}/calculate_base_stats"] = time_call(lambda: calculate_base_stats(main_build), repeats, inner_loops=200)
+        results[f"{name}/apply_buffs"] = time_call(
+            lambda: apply_buffs(base_raw, all_active, char_name, all_buffs, main_build.get(KEY_CONSTELLATION, 0), main_build.get(KEY_WEAPON_RANK, 1)),
+            repeats, inner_loops=200)
+        results[f"{name}/process_rotation"] = time_call(
+            lambda: process_rotation(team_builds, s["rotation_initial"], s["rotation_loop"], s["enemy_info"], all_buffs, s["stage_effects_name"],
+                                     game_data, s["time_marks_initial"], s["time_marks_loop"], annotate_actions=False),
+            repeats)
+        for count in (simulation_counts or DEFAULT_SIMULATION_COUNTS):
+            results[f"{name}/run_simulation_with_rng/{count}"] = time_call(
+                lambda: run_simulation_with_rng(count, num_loops, team_builds, s["rotation_initial"], s["rotation_loop"], s["enemy_info"],
+                                                all_buffs, s["time_marks_initial"], s["time_marks_loop"]),
+                max(1, repeats // 2) if count >= 1000 else repeats)
+
+        owned = _synthetic_owned_echoes(team_builds, per_cost=12)
+        results[f"{name}/generate_owned_echo_builds/{slice_size}"] = time_call(
+            lambda: sum(1 for _ in islice(generate_owned_echo_builds(owned, "4-3-3-1-1"), slice_size)), repeats)
+
+    # 探索空間の列挙はシナリオに依存しないので一度だけ計測する
+    for case_name, case in BUILD_COMBINATION_CASES.items():
+        results[f"generate_build_combinations/{case_name}/{slice_size}"] = time_call(
+            lambda: sum(1 for _ in islice(generate_build_combinations(**case), slice_size)), repeats)
+    return results
+
+def compare_with_baseline(results: Dict[str, Dict[str, float]], baseline: Dict, threshold: float = DEFAULT_THRESHOLD) -> Dict[str, Dict]:
+    """中央値どうしを比べ、ratio (current / baseline) と regression / improvement / unchanged / new を付ける"""
+    baseline_results = baseline.get("results", {})
+    comparison = {}
+    for key, current in results.items():
+        base = baseline_results.get(key)
+        if not base or not base.get("median_s"):
+            comparison[key] = {"status": "new", "current_s": current["median_s"]}
+            continue
+        ratio = current["median_s"] / base["median_s"]
+        status = "regression" if ratio > 1 + threshold else "improvement" if ratio < 1 - threshold else "unchanged"
+        comparison[key] = {"status": status, "baseline_s": base["median_s"], "current_s": current["median_s"], "ratio": ratio}
+    for key in baseline_results.keys() - results.keys():
+        comparison[key] = {"status": "missing", "baseline_s": baseline_results[key].get("median_s")}
+    return comparison
+
+def build_report(results: Dict[str, Dict[str, float]], baseline: Optional[Dict] = None, threshold: float = DEFAULT_THRESHOLD) -> Dict:
+    report = {
+        "version": BENCHMARK_FORMAT_VERSION,
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "environment": {"python": sys.version.split()[0], "numpy": np.__version__, "platform": platform.platform()},
+        "results": results,
+    }
+    if baseline is not None:
+        comparison = compare_with_baseline(results, baseline, threshold)
+        report["threshold"] = threshold
+        report["comparison"] = comparison
+        report["regressions"] = sorted(k for k, v in comparison.items() if v["status"] == "regression")
+    return report
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="calculator の主要処理のベンチマーク")
+    parser.add_argument("--scenarios", default=DEFAULT_SCENARIOS_PATH, help="scenarios.json のパス")
+    parser.add_argument("--names", nargs="*", help="計測するシナリオ名 (省略時は全て)")
+    parser.add_argument("--data-dir", default=DEFAULT_DATA_DIR, help="ゲームデータのディレクトリ")
+    parser.add_argument("--simulations", type=int, nargs="*", default=DEFAULT_SIMULATION_COUNTS, help="run_simulation_with_rng のシミュレーション回数")
+    parser.add_argument("--slice-size", type=int, default=DEFAULT_SLICE_SIZE, help="組み合わせ生成で列挙する件数")
+    parser.add_argument("--repeats", type=int, default=DEFAULT_REPEATS)
+    parser.add_argument("--baseline", help="比較する過去の結果 JSON")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="regression とみなす遅くなり方 (0.1 = 10%%)")
+    parser.add_argument("--output", help="結果の書き出し先 (省略時は標準出力)")
+    args = parser.parse_args(argv)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+    results = run_benchmarks(args.scenarios, args.names, args.data_dir, args.simulations, args.slice_size, args.repeats)
+    report = build_report(results, baseline, args.threshold)
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        print(text)
+    return 1 if report.get("regressions") else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,23 +1,29 @@
 # calculator.py
 import copy
+import hashlib
+import json
+import math
+import os
 import traceback
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
+import heapq
 import random
+import time
 import numpy as np
 from constants import (
     ECHO_DATA, DAMAGE_TYPE_TO_KEY_MAP, DAMAGE_TYPE_TO_BOOST_KEY_MAP, ATTRIBUTE_DMG_UP_MAP, ATTRIBUTE_NAME_TO_RES_KEY,
-    ABNORMAL_DAMAGE_BASE_LV90, ABNORMAL_EFFECTS, ABNORMAL_STACK_MULTIPLIERS, EFFECT_NAME_TO_ATTR_DMG_TYPE, EFFECT_NAME_TO_BOOST_KEY,
+    ABNORMAL_DAMAGE_BASE_LV90, ABNORMAL_EFFECTS, ABNORMAL_STACK_MULTIPLIERS, ABNORMAL_EXTRA_STACK_STEP, ABNORMAL_TIMELINE_PARAMS, EFFECT_NAME_TO_ATTR_DMG_TYPE, EFFECT_NAME_TO_BOOST_KEY,
     KEY_NAME, KEY_KEY, KEY_VALUE, KEY_COST, KEY_MAIN_STAT, KEY_SUB_STAT, KEY_SUB_STATS,
     KEY_CHARACTER, KEY_CHARACTER_NAME, KEY_CHARACTER_DATA, KEY_WEAPON_DATA, KEY_WEAPON_NAME, KEY_WEAPON_RANK,
     KEY_ECHO_LIST, KEY_HARMONY1_DATA, KEY_HARMONY2_DATA, KEY_INNATE_STATS, KEY_SKILLS, KEY_SKILL, KEY_SKILL_DATA,
     KEY_MULTIPLIER, KEY_ATTRIBUTE, KEY_ACTIVATION_TYPES, KEY_DAMAGE_TYPES, KEY_CONCERTO_ENERGY,
     KEY_BUFFS, KEY_CONSTELLATION, KEY_CONSTELLATIONS, KEY_ACTIVE_BUFFS, KEY_STACKS, KEY_LEVEL,
     KEY_BASE_HP, KEY_BASE_ATK, KEY_BASE_DEF, KEY_EFFECTS, KEY_TARGET, KEY_RESONANCE_ENERGY_REQUIRED, KEY_RESONANCE_ENERGY_GAIN_FLAT,
-    KEY_RESONANCE_ENERGY_GAIN_SCALING
+    KEY_RESONANCE_ENERGY_GAIN_SCALING, KEY_ECHO_SKILL_DATA, KEY_HARMONY1_NAME, KEY_HARMONY2_NAME
 )
-from app_types import Build, BuffEffect, Action, CalculationResult, RotationPhaseResult, ActiveBuffTarget
+from app_types import Build, BuffEffect, Action, CalculationResult, RotationPhaseResult, SimulationStats, PhaseProfileReport, ActiveBuffTarget, EnemySweepResult, EnergyFeasibilityResult, MinEfficiencyResult, RotationSearchResult, OwnedEchoOptimizationResult, BuildSearchResult, HeuristicSearchResult, SubstatRollDistributionResult, EchoUpgradeEstimate, RotationPlan, RotationPlanEvaluation, ActionAnnotation, AbnormalTimelineResult, MultiTargetResult, DamageComponents, ParetoSearchResult
 from itertools import combinations, product, permutations
-from typing import Dict, List, Tuple, Set, Optional
+from typing import Callable, Dict, List, Tuple, Set, Optional
 
 def _apply_stat_conversion(stats: Dict[str, float], effect: BuffEffect, rank: int) -> Dict[str, float]:
     source_val = stats.get(effect.get("source_stat"), 0)
@@ -87,8 +93,13 @@ def calculate_base_stats(build: Build) -> Tuple[Dict[str, float], Dict[str, floa
     final_display = {"HP": bases["hp"] * (1 + raw["hp_percent"] / 100) + raw["hp_flat"], "攻撃力": bases["atk"] * (1 + raw["atk_percent"] / 100) + raw["atk_flat"], "防御力": bases["def"] * (1 + raw["def_percent"] / 100) + raw["def_flat"], "クリティカル率": raw["crit_rate"], "クリティカルダメージ": raw["crit_damage"], "共鳴効率": raw["resonance_efficiency"],"全属性ダメージアップ": raw["all_damage_up"], "気動ダメージアップ": raw["aero_dmg_up"],"焦熱ダメージアップ": raw["fusion_dmg_up"],"電導ダメージアップ": raw["electro_dmg_up"],"凝縮ダメージアップ": raw["glacio_dmg_up"],"消滅ダメージアップ": raw["havoc_dmg_up"],"回折ダメージアップ": raw["spectro_dmg_up"]}
     return final_display, dict(raw), bases
 
-def apply_buffs(raw_stats: Dict[str, float], active_buffs: Dict[str, any], current_char_name: str, all_buff_data: Dict, constellation: int, weapon_rank: int, ignored_buff_key: Optional[str] = None) -> Dict[str, float]:
-    buffed = defaultdict(float, raw_stats)
+def _resolve_buff_effect_records(active_buffs: Dict[str, any], current_char_name: str, all_buff_data: Dict, constellation: int, weapon_rank: int, ignored_buff_key: Optional[str] = None) -> List[Tuple]:
+    """
+    有効なバフを、適用順に並んだ効果レコードへ展開する。
+      ("add", ステータスキー, 値) / ("convert", ステータス変換の効果, 武器ランク)
+    ステータス変換はその時点の値に依存するため、値にはせずそのまま残す。
+    """
+    records = []
     for buff_key, buff_status in active_buffs.items():
         if buff_key == ignored_buff_key: continue
         info = all_buff_data.get(buff_key)
@@ -105,14 +116,32 @@ def apply_buffs(raw_stats: Dict[str, float], active_buffs: Dict[str, any], curre
         for effect in info.get(KEY_EFFECTS,[]):
             value = effect.get(KEY_VALUE, [0]*5)
             value = value[weapon_rank-1] if isinstance(value, list) else value
-            if effect.get("type") == "単純加算": buffed[effect["stat_to_buff"]] += value
+            if effect.get("type") == "単純加算": records.append(("add", effect["stat_to_buff"], value))
             elif effect.get("type") == "スタック形式":
                 per_stack = effect.get("effect_per_stack", [0]*5)
                 value_per_stack = per_stack[weapon_rank-1] if isinstance(per_stack, list) else per_stack
                 stack_count = buff_status if isinstance(buff_status, int) else 1
-                buffed[effect["stat_to_buff"]] += value_per_stack * stack_count
-            elif effect.get("type") == "ステータス変換": buffed = _apply_stat_conversion(buffed, effect, weapon_rank)
-            elif effect.get("type") == "ダメージ倍率アップ": buffed[effect["stat_to_buff"]] += value
+                records.append(("add", effect["stat_to_buff"], value_per_stack * stack_count))
+            elif effect.get("type") == "ステータス変換": records.append(("convert", effect, weapon_rank))
+            elif effect.get("type") == "ダメージ倍率アップ": records.append(("add", effect["stat_to_buff"], value))
+    return records
+
+def _apply_buff_effect_records(raw_stats: Dict[str, float], records: List[Tuple]) -> Dict[str, float]:
+    """_resolve_buff_effect_records の効果レコードを順に適用する"""
+    buffed = defaultdict(float, raw_stats)
+    for kind, target, value in records:
+        if kind == "add": buffed[target] += value
+        else: buffed = _apply_stat_conversion(buffed, target, value)
+    return buffed
+
+def apply_buffs(raw_stats: Dict[str, float], active_buffs: Dict[str, any], current_char_name: str, all_buff_data: Dict, constellation: int, weapon_rank: int, ignored_buff_key: Optional[str] = None) -> Dict[str, float]:
+    prof = _phase_profiler
+    if prof is not None: start = time.perf_counter()
+    records = _resolve_buff_effect_records(active_buffs, current_char_name, all_buff_data, constellation, weapon_rank, ignored_buff_key)
+    buffed = _apply_buff_effect_records(raw_stats, records)
+    if prof is not None:
+        prof.apply_buffs_calls += 1
+        prof.apply_buffs_seconds += time.perf_counter() - start
     return buffed
 
 def _get_default_target(current_char_name: str, team_builds: List[Build]) -> str:
@@ -128,6 +157,58 @@ def _get_default_target(current_char_name: str, team_builds: List[Build]) -> str
     except ValueError:
         return team_members[0]
 
+def _is_valid_buff_data(buff_data: Dict) -> bool:
+    """_process_phase のトリガー判定に掛けられる形式 (trigger がリスト) のバフか"""
+    return isinstance(buff_data, dict) and isinstance(buff_data.get("trigger", []), list)
+
+def gather_team_buffs(team_builds: List[Build]) -> Dict[str, Dict]:
+    """
+    チーム全員のキャラ・凸・武器・ハーモニー・音骸スキルのバフを、
+    ローテーションの active_buffs と同じキー形式で1つの辞書に集める。
+    ハーモニーのセット効果のうち、has_Nset_effect が立っているものは
+    calculate_base_stats で常時加算済みのため含めない。
+    """
+    all_buffs = {}
+    for build in team_builds:
+        char_name = build.get(KEY_CHARACTER_NAME)
+        if not char_name: continue
+        char_data = build.get(KEY_CHARACTER_DATA, {}) or {}
+        for key, buff_data in char_data.get(KEY_BUFFS, {}).items():
+            if _is_valid_buff_data(buff_data):
+                all_buffs[f"char_{char_name}_{key}"] = {**buff_data, "owner": char_name}
+        for level, const_data in (char_data.get(KEY_CONSTELLATIONS, {}) or {}).items():
+            for key, buff_data in (const_data or {}).get(KEY_BUFFS, {}).items():
+                if _is_valid_buff_data(buff_data):
+                    all_buffs[f"char_{char_name}_C{level}_{key}"] = {**buff_data, "owner": char_name, KEY_CONSTELLATION: int(level)}
+
+        weapon_data = build.get(KEY_WEAPON_DATA, {}) or {}
+        effect_data = weapon_data.get("effect_data")
+        if effect_data and _is_valid_buff_data(effect_data):
+            all_buffs[f"weapon_{char_name}_{weapon_data.get(KEY_NAME, build.get(KEY_WEAPON_NAME, ''))}"] = {**effect_data, "owner": char_name}
+
+        h1_data = build.get(KEY_HARMONY1_DATA, {}) or {}
+        h2_data = build.get(KEY_HARMONY2_DATA, {}) or {}
+        set_keys_by_harmony = {}
+        if h1_data.get(KEY_NAME) and h1_data.get(KEY_NAME) == h2_data.get(KEY_NAME):
+            set_keys_by_harmony[h1_data[KEY_NAME]] = (h1_data, ["2セット効果", "3セット効果", "5セット効果"])
+        else:
+            for h_data in (h1_data, h2_data):
+                if h_data.get(KEY_NAME): set_keys_by_harmony[h_data[KEY_NAME]] = (h_data, ["2セット効果", "3セット効果"])
+        for h_name, (h_data, set_keys) in set_keys_by_harmony.items():
+            for set_key in set_keys:
+                if h_data.get(f"has_{set_key[0]}set_effect", False): continue
+                set_data = h_data.get(KEY_BUFFS, {}).get(set_key)
+                if not isinstance(set_data, dict): continue
+                for key, buff_data in set_data.get(KEY_BUFFS, {}).items():
+                    if _is_valid_buff_data(buff_data):
+                        all_buffs[f"harmony_{char_name}_{h_name}_{set_key}_{key}"] = {**buff_data, "owner": char_name}
+
+        echo_skill_data = build.get(KEY_ECHO_SKILL_DATA, {}) or {}
+        for key, buff_data in echo_skill_data.get(KEY_BUFFS, {}).items():
+            if _is_valid_buff_data(buff_data):
+                all_buffs[f"echo_{char_name}_{echo_skill_data.get(KEY_NAME, '')}_{key}"] = {**buff_data, "owner": char_name}
+    return all_buffs
+
 def _get_character_efficiency(character_name: str, base_raw: Dict, active_buffs: Dict, all_buffs: Dict, build: Build) -> float:
     """
     指定されたキャラクターの、特定のバフ状態における共鳴効率を計算して返す。
@@ -164,77 +245,270 @@ def _calculate_shared_bonuses(buffed_raw_stats: Dict[str, float], enemy_info: Di
     dmg_taken_bonus = 1 + buffed_raw_stats.get("dmg_taken_up", 0) / 100
     return defense_bonus, resistance_bonus, dmg_taken_bonus
 
-def calculate_skill_damage(final_stats_with_buffs: Dict[str, float], buffed_raw_stats: Dict[str, float], skill: Dict, enemy_info: Dict, char_attribute: str = None, rng_mode: bool = False) -> Tuple[float, Dict]:
-    details = {} if not rng_mode else None
+def _action_enemy_modifiers(buffed_raw_stats_list: List[Dict[str, float]], damage_types_list: List[List[str]]) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, List[Optional[str]]]:
+    """
+    アクションごとに、敵に依存しない防御無視・耐性無視・耐性減少・被ダメージ補正と、参照する耐性の属性名 (属性なしは None) を取り出す。
+    _calculate_shared_bonuses_grid / _calculate_shared_bonuses_targets で共用する。
+    """
+    n = len(buffed_raw_stats_list)
+    def_ignore, res_ignore, res_shred, dmg_taken = np.zeros(n), np.zeros(n), np.zeros(n), np.zeros(n)
+    res_names: List[Optional[str]] = []
+    for i, (stats, damage_types) in enumerate(zip(buffed_raw_stats_list, damage_types_list)):
+        def_ignore[i] = stats.get("def_shred", 0) / 100
+        enemy_res_name = next((dt.replace("ダメージ","") for dt in damage_types if dt.endswith("ダメージ")), None)
+        shred = stats.get("res_shred", 0)
+        if enemy_res_name and ATTRIBUTE_NAME_TO_RES_KEY.get(enemy_res_name):
+            shred += stats.get(f"{ATTRIBUTE_NAME_TO_RES_KEY[enemy_res_name]}_res_shred", 0)
+        res_shred[i] = shred
+        res_ignore[i] = stats.get(f"{enemy_res_name}_res_ignore", 0) / 100 if enemy_res_name else 0
+        dmg_taken[i] = 1 + stats.get("dmg_taken_up", 0) / 100
+        res_names.append(enemy_res_name)
+    return def_ignore, res_ignore, res_shred, dmg_taken, res_names
+
+def _calculate_shared_bonuses_grid(buffed_raw_stats_list: List[Dict[str, float]], damage_types_list: List[List[str]], enemy_levels: np.ndarray, enemy_resistances: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    _calculate_shared_bonuses のベクトル版。アクションごとのステータスと、敵レベル・敵耐性のグリッドから
+    防御補正 (アクション数, レベル数)、耐性補正 (アクション数, 耐性数)、被ダメージ補正 (アクション数) を返す。
+    耐性は全属性に同じ値を設定したものとして扱い、属性を持たないアクションは既定値の10%のままとする。
+    """
+    char_lv = 90
+    def_ignore, res_ignore, res_shred, dmg_taken, res_names = _action_enemy_modifiers(buffed_raw_stats_list, damage_types_list)
+    has_attr = np.array([name is not None for name in res_names], dtype=bool)
+
+    levels = np.asarray(enemy_levels, dtype=float)
+    resistances = np.asarray(enemy_resistances, dtype=float)
+    char_term = 800 + 8 * char_lv
+    defense = char_term / (char_term + (8 * levels[None, :] + 792) * (1 - def_ignore[:, None]))
+    enemy_res = np.where(has_attr[:, None], resistances[None, :], 10.0)
+    final_res = enemy_res * (1 - res_ignore[:, None]) - res_shred[:, None]
+    resistance = np.where(final_res >= 0, 1 - final_res / 100, 1 - final_res / 200)
+    return defense, resistance, dmg_taken
+
+def _calculate_shared_bonuses_targets(buffed_raw_stats_list: List[Dict[str, float]], damage_types_list: List[List[str]], targets: List[Dict]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    _calculate_shared_bonuses の複数の敵版。targets は enemy_info と同じ形 (level と属性名ごとの耐性%) のリストで、
+    防御補正 (アクション数, 敵の数)、耐性補正 (アクション数, 敵の数)、被ダメージ補正 (アクション数) を返す。
+    """
+    char_lv = 90
+    def_ignore, res_ignore, res_shred, dmg_taken, res_names = _action_enemy_modifiers(buffed_raw_stats_list, damage_types_list)
+    levels = np.array([t.get(KEY_LEVEL, 90) for t in targets], dtype=float)
+    enemy_res = np.array([[t.get(name, 10) for t in targets] for name in res_names], dtype=float).reshape(len(res_names), len(targets))
+
+    char_term = 800 + 8 * char_lv
+    defense = char_term / (char_term + (8 * levels[None, :] + 792) * (1 - def_ignore[:, None]))
+    final_res = enemy_res * (1 - res_ignore[:, None]) - res_shred[:, None]
+    resistance = np.where(final_res >= 0, 1 - final_res / 100, 1 - final_res / 200)
+    return defense, resistance, dmg_taken
+
+def _calculate_damage_components(final_stats_with_buffs: Dict[str, float], buffed_raw_stats: Dict[str, float], skill: Dict, char_attribute: str = None) -> Dict:
+    """
+    スキルダメージのうち、敵 (レベル・耐性) に依存しない部分の各補正値を計算する。
+    calculate_skill_damage と敵パラメータのスイープで共用する。
+    """
+    ref_map = {"atk": "攻撃力", "hp": "HP", "def": "防御力"}
+    ref_stat_key = ref_map.get(skill.get(KEY_ATTRIBUTE, "atk"), "攻撃力")
+    ref_stat_value = final_stats_with_buffs.get(ref_stat_key, 0)
+
+    multiplier_bonus = buffed_raw_stats.get("skill_multiplier_bonus", 0)
+    skill_multiplier = skill.get(KEY_MULTIPLIER, 0)
+    final_multiplier = (skill_multiplier + multiplier_bonus) / 100
+    base_damage = ref_stat_value * final_multiplier
+
+    # スキルデータの damage_types は書き換えず、キャラ属性を足したコピーを使う
+    damage_types = list(skill.get(KEY_DAMAGE_TYPES, []))
+    if not any(dt.endswith("ダメージ") for dt in damage_types) and char_attribute:
+        damage_types.append(f"{char_attribute}ダメージ")
+
+    total_dmg_up = buffed_raw_stats.get("all_damage_up", 0)
+    elemental_dmg_up = sum(buffed_raw_stats.get(ATTRIBUTE_DMG_UP_MAP.get(t), 0) for t in damage_types if t in ATTRIBUTE_DMG_UP_MAP)
+    skill_type_dmg_up = sum(buffed_raw_stats.get(DAMAGE_TYPE_TO_KEY_MAP.get(t), 0) for t in skill.get(KEY_DAMAGE_TYPES, []))
+    damage_up_bonus = 1 + (total_dmg_up + elemental_dmg_up + skill_type_dmg_up) / 100
+
+    total_dmg_boost = buffed_raw_stats.get("generic_dmg_boost", 0) + sum(buffed_raw_stats.get(key, 0) for t in damage_types for key in DAMAGE_TYPE_TO_BOOST_KEY_MAP.get(t, []))
+    damage_boost_bonus = 1 + total_dmg_boost / 100
+
+    crit_rate = min(buffed_raw_stats.get("crit_rate", 5.0), 100.0)
+    crit_damage_val = buffed_raw_stats.get("crit_damage", 150.0)
+
+    return {
+        "ref_stat_key": ref_stat_key, "ref_stat_value": ref_stat_value,
+        "skill_multiplier": skill_multiplier, "multiplier_bonus": multiplier_bonus, "final_multiplier": final_multiplier,
+        "base_damage": base_damage, "damage_types": damage_types,
+        "total_dmg_up": total_dmg_up, "elemental_dmg_up": elemental_dmg_up, "skill_type_dmg_up": skill_type_dmg_up,
+        "damage_up_bonus": damage_up_bonus, "total_dmg_boost": total_dmg_boost, "damage_boost_bonus": damage_boost_bonus,
+        "crit_rate": crit_rate, "crit_damage": crit_damage_val,
+    }
+
+def calculate_skill_damage(final_stats_with_buffs: Dict[str, float], buffed_raw_stats: Dict[str, float], skill: Dict, enemy_info: Dict, char_attribute: str = None, rng_mode: bool = False) -> Tuple[float, Optional[DamageComponents]]:
+    """
+    スキル1回分のダメージと、その内訳 (補正値そのもの) を返す。rng_mode では内訳は None。
+    内訳の表示用文字列は format_calculation_details で、表示するときにだけ作る。
+    """
     try:
-        ref_map = {"atk": "攻撃力", "hp": "HP", "def": "防御力"}
-        ref_stat_key = ref_map.get(skill.get(KEY_ATTRIBUTE, "atk"), "攻撃力")
-        ref_stat_value = final_stats_with_buffs.get(ref_stat_key, 0)
-        if details is not None: details["参照ステータス"] = f"{ref_stat_key}: {ref_stat_value:,.2f}"
-
-        multiplier_bonus = buffed_raw_stats.get("skill_multiplier_bonus", 0)
-        skill_multiplier = skill.get(KEY_MULTIPLIER, 0)
-        final_multiplier = (skill_multiplier + multiplier_bonus) / 100
-        if details is not None: details["スキル倍率"] = f"({skill_multiplier}% + {multiplier_bonus}%) = {final_multiplier * 100:.2f}%"
-
-        base_damage = ref_stat_value * final_multiplier
-        if details is not None: details["基礎ダメージ"] = f"{base_damage:,.2f}"
-
-        damage_types = skill.get(KEY_DAMAGE_TYPES, [])
-        if not any(dt.endswith("ダメージ") for dt in damage_types) and char_attribute:
-            damage_types.append(f"{char_attribute}ダメージ")
-
-        total_dmg_up = buffed_raw_stats.get("all_damage_up", 0)
-        elemental_dmg_up = sum(buffed_raw_stats.get(ATTRIBUTE_DMG_UP_MAP.get(t), 0) for t in damage_types if t in ATTRIBUTE_DMG_UP_MAP)
-        skill_type_dmg_up = sum(buffed_raw_stats.get(DAMAGE_TYPE_TO_KEY_MAP.get(t), 0) for t in skill.get(KEY_DAMAGE_TYPES, []))
-        damage_up_bonus = 1 + (total_dmg_up + elemental_dmg_up + skill_type_dmg_up) / 100
-        if details is not None: details["与ダメージバフ補正"] = f"1 + ({total_dmg_up:.1f}% + {elemental_dmg_up:.1f}% + {skill_type_dmg_up:.1f}%) = {damage_up_bonus:.3f}"
-
-        total_dmg_boost = buffed_raw_stats.get("generic_dmg_boost", 0) + sum(buffed_raw_stats.get(key, 0) for t in damage_types for key in DAMAGE_TYPE_TO_BOOST_KEY_MAP.get(t, []))
-        damage_boost_bonus = 1 + total_dmg_boost / 100
-        if details is not None: details["ダメージブースト補正"] = f"1 + {total_dmg_boost:.1f}% = {damage_boost_bonus:.3f}"
-
-        crit_rate = min(buffed_raw_stats.get("crit_rate", 5.0), 100.0)
-        crit_damage_val = buffed_raw_stats.get("crit_damage", 150.0)
-        
+        c = _calculate_damage_components(final_stats_with_buffs, buffed_raw_stats, skill, char_attribute)
+
+        crit_rate, crit_damage_val = c["crit_rate"], c["crit_damage"]
         if rng_mode:
             is_crit = random.random() < (crit_rate / 100.0)
             crit_bonus = 1 + (crit_damage_val / 100.0) if is_crit else 1.0
         else:
             crit_bonus = 1 + ((crit_rate / 100) * (crit_damage_val / 100))
-            if details is not None: details["会心補正(期待値)"] = f"1 + ({crit_rate:.1f}% * {crit_damage_val:.1f}%) = {crit_bonus:.3f}"
 
-        defense_bonus, resistance_bonus, dmg_taken_bonus = _calculate_shared_bonuses(buffed_raw_stats, enemy_info, damage_types)
-        if details is not None:
-            details["防御補正"] = f"{defense_bonus:.3f}"
-            details["耐性補正"] = f"{resistance_bonus:.3f}"
-            details["被ダメージアップ補正"] = f"{dmg_taken_bonus:.3f}"
+        defense_bonus, resistance_bonus, dmg_taken_bonus = _calculate_shared_bonuses(buffed_raw_stats, enemy_info, c["damage_types"])
 
-        final_damage = base_damage * damage_up_bonus * damage_boost_bonus * crit_bonus * defense_bonus * resistance_bonus * dmg_taken_bonus
-        return (final_damage if final_damage > 0 else 0, details)
+        final_damage = c["base_damage"] * c["damage_up_bonus"] * c["damage_boost_bonus"] * crit_bonus * defense_bonus * resistance_bonus * dmg_taken_bonus
+        if rng_mode:
+            return (final_damage if final_damage > 0 else 0, None)
+        c["crit_bonus"], c["defense_bonus"], c["resistance_bonus"], c["dmg_taken_bonus"] = crit_bonus, defense_bonus, resistance_bonus, dmg_taken_bonus
+        return (final_damage if final_damage > 0 else 0, c)
     except Exception:
         if not rng_mode: traceback.print_exc()
-        return (0, {"エラー": "計算中に例外発生"} if not rng_mode else None)
+        return (0, {"error": "計算中に例外発生"} if not rng_mode else None)
+
+def format_calculation_details(components: Optional[DamageComponents]) -> Dict[str, str]:
+    """calculate_skill_damage の内訳を、UI に出す項目名 -> 文字列 の辞書にする"""
+    if not components: return {}
+    c = components
+    if "error" in c: return {"エラー": c["error"]}
+    details = {
+        "参照ステータス": f"{c['ref_stat_key']}: {c['ref_stat_value']:,.2f}",
+        "スキル倍率": f"({c['skill_multiplier']}% + {c['multiplier_bonus']}%) = {c['final_multiplier'] * 100:.2f}%",
+        "基礎ダメージ": f"{c['base_damage']:,.2f}",
+        "与ダメージバフ補正": f"1 + ({c['total_dmg_up']:.1f}% + {c['elemental_dmg_up']:.1f}% + {c['skill_type_dmg_up']:.1f}%) = {c['damage_up_bonus']:.3f}",
+        "ダメージブースト補正": f"1 + {c['total_dmg_boost']:.1f}% = {c['damage_boost_bonus']:.3f}",
+    }
+    if "crit_bonus" in c:
+        details["会心補正(期待値)"] = f"1 + ({c['crit_rate']:.1f}% * {c['crit_damage']:.1f}%) = {c['crit_bonus']:.3f}"
+    if "defense_bonus" in c:
+        details["防御補正"] = f"{c['defense_bonus']:.3f}"
+        details["耐性補正"] = f"{c['resistance_bonus']:.3f}"
+        details["被ダメージアップ補正"] = f"{c['dmg_taken_bonus']:.3f}"
+    return details
+
+def get_calculation_details(result: CalculationResult, phase_key: str, index: int) -> Dict[str, str]:
+    """計算結果の1アクション分 (phase_key は "initial_phase" / "loop_phase") の内訳を表示用に整形する"""
+    log = (result.get(phase_key) or {}).get("log") or []
+    if not 0 <= index < len(log): return {}
+    return format_calculation_details(log[index].get("calculation_details"))
+
+def _build_abnormal_multiplier_tables() -> Dict[str, np.ndarray]:
+    """異常効果ごとに、スタック数 (0 ～ 最大) -> 倍率 の配列を作る。表より先は ABNORMAL_EXTRA_STACK_STEP ずつ増やす"""
+    tables = {}
+    for effect_name, effect_info in ABNORMAL_EFFECTS.items():
+        multipliers = ABNORMAL_STACK_MULTIPLIERS.get(effect_name, [1])
+        max_stacks = effect_info.get("max_stacks", len(multipliers))
+        table = np.zeros(max_stacks + 1)
+        n = min(max_stacks, len(multipliers))
+        table[1:n + 1] = multipliers[:n]
+        if max_stacks > n:
+            table[n + 1:] = multipliers[n - 1] + np.arange(1, max_stacks - n + 1) * ABNORMAL_EXTRA_STACK_STEP.get(effect_name, 0.0)
+        tables[effect_name] = table
+    return tables
+
+ABNORMAL_STACK_MULTIPLIER_TABLES = _build_abnormal_multiplier_tables()
+
+def _abnormal_stack_multiplier(effect_name: str, stacks: int) -> float:
+    """スタック数の倍率 (1 ～ 最大スタック数に丸める)"""
+    table = ABNORMAL_STACK_MULTIPLIER_TABLES.get(effect_name)
+    if table is None: return 1.0
+    return float(table[min(max(int(stacks), 1), len(table) - 1)])
+
+def _calculate_abnormal_pre_enemy_damage(effect_name: str, stacks: int, buffed_raw_stats: Dict[str, float]) -> Tuple[float, List[str]]:
+    """異常効果ダメージのうち、敵に依存しない部分 (基礎値 * スタック倍率 * ブースト) と属性を返す"""
+    effect_info = ABNORMAL_EFFECTS[effect_name]
+    initial_damage = ABNORMAL_DAMAGE_BASE_LV90 * effect_info["attr_coeff"] * _abnormal_stack_multiplier(effect_name, stacks)
+    boost_key = EFFECT_NAME_TO_BOOST_KEY.get(effect_name)
+    boost_bonus = 1 + buffed_raw_stats.get(boost_key, 0) / 100
+    damage_types = [EFFECT_NAME_TO_ATTR_DMG_TYPE.get(effect_name)]
+    return initial_damage * boost_bonus, damage_types
 
 def calculate_abnormal_status_damage(effect_name: str, stacks: int, buffed_raw_stats: Dict[str, float], enemy_info: Dict) -> float:
     try:
-        effect_info = ABNORMAL_EFFECTS[effect_name]
-        base_dmg = ABNORMAL_DAMAGE_BASE_LV90
-        attr_coeff = effect_info["attr_coeff"]
-        stack_multipliers = ABNORMAL_STACK_MULTIPLIERS.get(effect_name, [1])
-        if effect_name == "騒光効果" and stacks > 10:
-            stack_mult = stack_multipliers[-1] + (stacks - 10) * 1.812
-        else:
-            stack_mult = stack_multipliers[min(stacks, len(stack_multipliers)) - 1]
-        initial_damage = base_dmg * attr_coeff * stack_mult
-        boost_key = EFFECT_NAME_TO_BOOST_KEY.get(effect_name)
-        boost_bonus = 1 + buffed_raw_stats.get(boost_key, 0) / 100
-        damage_types = [EFFECT_NAME_TO_ATTR_DMG_TYPE.get(effect_name)]
+        pre_enemy_damage, damage_types = _calculate_abnormal_pre_enemy_damage(effect_name, stacks, buffed_raw_stats)
         defense_bonus, resistance_bonus, dmg_taken_bonus = _calculate_shared_bonuses(buffed_raw_stats, enemy_info, damage_types)
-        final_damage = initial_damage * boost_bonus * defense_bonus * resistance_bonus * dmg_taken_bonus
+        final_damage = pre_enemy_damage * defense_bonus * resistance_bonus * dmg_taken_bonus
         return final_damage if final_damage > 0 else 0
     except Exception: traceback.print_exc(); return 0
 
+PROFILE_STAGES = ["persistent_buffs", "transient_buffs", "damage", "energy", "display"]
+
+class PhaseProfiler:
+    """
+    _process_phase の区間ごとの時間・回数と、バフの発動判定回数、apply_buffs の呼び出し回数を集計する。
+    enable_phase_profiling() で有効にしている間だけ記録され、無効時は各フックが None 判定1回で素通りする。
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.phases = 0
+        self.actions = 0
+        self.stage_seconds = {s: 0.0 for s in PROFILE_STAGES}
+        self.stage_calls = {s: 0 for s in PROFILE_STAGES}
+        self.apply_buffs_calls = 0
+        self.apply_buffs_seconds = 0.0
+        self.trigger_checks = defaultdict(int)
+        self.trigger_hits = defaultdict(int)
+
+    def add_stage(self, stage: str, start: float) -> float:
+        """start からの経過時間を stage に加算し、次の区間の開始時刻を返す"""
+        now = time.perf_counter()
+        self.stage_seconds[stage] += now - start
+        self.stage_calls[stage] += 1
+        return now
+
+    def count_trigger(self, buff_key: str, triggered: bool):
+        self.trigger_checks[buff_key] += 1
+        if triggered: self.trigger_hits[buff_key] += 1
+
+    def report(self) -> PhaseProfileReport:
+        """JSON / Pyodide の toJs にそのまま渡せる素の dict で返す"""
+        return {
+            "phases": self.phases,
+            "actions": self.actions,
+            "stage_seconds": dict(self.stage_seconds),
+            "stage_calls": dict(self.stage_calls),
+            "apply_buffs_calls": self.apply_buffs_calls,
+            "apply_buffs_seconds": self.apply_buffs_seconds,
+            "trigger_checks": dict(self.trigger_checks),
+            "trigger_hits": dict(self.trigger_hits),
+        }
+
+_phase_profiler: Optional[PhaseProfiler] = None
+
+def enable_phase_profiling(reset: bool = True) -> PhaseProfiler:
+    """プロファイリングを有効にする (script.js からは calculatorModule.enable_phase_profiling())"""
+    global _phase_profiler
+    if _phase_profiler is None: _phase_profiler = PhaseProfiler()
+    elif reset: _phase_profiler.reset()
+    return _phase_profiler
+
+def disable_phase_profiling() -> Optional[PhaseProfileReport]:
+    """プロファイリングを無効にし、それまでの集計を返す"""
+    global _phase_profiler
+    report = _phase_profiler.report() if _phase_profiler is not None else None
+    _phase_profiler = None
+    return report
+
+def get_phase_profile() -> Optional[PhaseProfileReport]:
+    """現在の集計を返す。無効なら None"""
+    return _phase_profiler.report() if _phase_profiler is not None else None
+
+def _is_buff_triggered(buff_data: Dict, current_char_name: str, team_char_names: Set[str], activation_types: List[str], skill_name: str, is_healing: bool, default_timing: Optional[str] = "発動時") -> bool:
+    """このアクションの発動時にバフがトリガーされるか。_process_phase・_plan_phase・エネルギー追跡で共通の判定"""
+    owner = buff_data.get("owner")
+    for trigger in buff_data.get("trigger", []):
+        event, source, timing = trigger.get("event"), trigger.get("source"), trigger.get("timing", default_timing)
+        source_match = (source == "自身発動" and owner == current_char_name) or \
+                       (source == "チーム内キャラ発動" and owner in team_char_names)
+        event_match = (event == "常時") or \
+                      (event in activation_types) or \
+                      (event.startswith("スキル: ") and event.replace("スキル: ", "") == skill_name) or \
+                      (event == "回復効果" and is_healing)
+        if source_match and event_match and (timing == "発動時" or event == "常時"):
+            return True
+    return False
+
 def _process_phase(phase_sequence: List[Action],
                     team_builds: List[Build],
                     team_stats: Dict,
@@ -246,7 +520,15 @@ def _process_phase(phase_sequence: List[Action],
                     rng_mode: bool = False,
                     ignored_buff_key: Optional[str] = None,
                     manually_disabled: Optional[Set[str]] = None,
-                    manually_set_stacks: Optional[Dict[str, int]] = None) -> RotationPhaseResult:
+                    manually_set_stacks: Optional[Dict[str, int]] = None,
+                    damage_records: Optional[List[Dict]] = None,
+                    annotate_actions: bool = True) -> RotationPhaseResult:
+    """
+    1フェーズ分のアクションを順に計算する。
+    annotate_actions が True (UI) なら、バフ状態・エネルギーなどの注釈を各 Action に書き込む。
+    False なら入力の Action は一切書き換えず、注釈は戻り値の "annotations" に
+    (アクションの位置 "action_index" 付きで) 返す。同じ入力を複数の評価で共有するときに使う。
+    """
     
     # ▼▼▼ ここからが修正点 ▼▼▼
     # 関数冒頭で、空のシーケンスの場合のデフォルトリターン値を定義
@@ -256,7 +538,8 @@ def _process_phase(phase_sequence: List[Action],
             "total_damage": 0.0, 
             "total_time": 0.0,
             "final_concerto_energy": initial_concerto_energy,
-            "final_resonance_energy": initial_resonance_energy
+            "final_resonance_energy": initial_resonance_energy,
+            **({} if annotate_actions else {"annotations": []})
         }
     # ▲▲▲ ここまで ▲▲▲
     log, total_dmg, concerto_energy = [], 0, initial_concerto_energy
@@ -266,8 +549,12 @@ def _process_phase(phase_sequence: List[Action],
     team_char_names = {b[KEY_CHARACTER_NAME] for b in team_builds if b.get(KEY_CHARACTER_NAME)} 
     char_concerto_energy = initial_concerto_energy.copy()
     char_resonance_energy = initial_resonance_energy.copy()
+    annotations = []
+    prof = _phase_profiler # 無効時は None (以降のフックは None 判定のみ)
+    if prof is not None: prof.phases += 1
 
-    for action in phase_sequence:
+    for action_index, action in enumerate(phase_sequence):
+        annotation = {"action_index": action_index} # このアクションの計算結果の注釈
         # --- ▼▼▼ ここから修正 ▼▼▼ ---
         # 変数名を current_char_name に統一
         current_char_name = action.get(KEY_CHARACTER)
@@ -286,6 +573,9 @@ def _process_phase(phase_sequence: List[Action],
         skill_name_for_current_action = action.get(KEY_SKILL, "")
         activation_types_for_current_action = skill_data_for_current_action.get(KEY_ACTIVATION_TYPES, []) if skill_data_for_current_action else []
         is_healing_skill_executed = skill_data_for_current_action.get("is_healing", False) if skill_data_for_current_action else False
+        if prof is not None:
+            prof.actions += 1
+            stage_start = time.perf_counter()
 
         # --- ▼▼▼ ここから修正 ▼▼▼ ---
         # 1. バフの適用 (持続バフと一時バフ) は、ダメージ計算より前に行う
@@ -297,22 +587,8 @@ def _process_phase(phase_sequence: List[Action],
             for buff_key, buff_data in all_buffs.items():
                 if buff_data.get("is_transient"): continue # 持続バフのみ対象
                 
-                is_triggered_by_this_action_on_cast = False
-                owner = buff_data.get("owner")
-                for trigger in buff_data.get("trigger", []):
-                    event, source, timing = trigger.get("event"), trigger.get("source"), trigger.get("timing", "発動時")
-                    
-                    source_match = (source == "自身発動" and owner == current_char_name) or \
-                                 (source == "チーム内キャラ発動" and owner in team_char_names)
-
-                    event_match = (event == "常時") or \
-                                  (event in activation_types_for_current_action) or \
-                                  (event.startswith("スキル: ") and event.replace("スキル: ", "") == skill_name_for_current_action) or \
-                                  (event == "回復効果" and is_healing_skill_executed)
-
-                    if source_match and event_match and (timing == "発動時" or event == "常時"):
-                        is_triggered_by_this_action_on_cast = True
-                        break 
+                is_triggered_by_this_action_on_cast = _is_buff_triggered(buff_data, current_char_name, team_char_names, activation_types_for_current_action, skill_name_for_current_action, is_healing_skill_executed)
+                if prof is not None: prof.count_trigger(buff_key, is_triggered_by_this_action_on_cast)
                 
                 if is_triggered_by_this_action_on_cast:
                     if buff_key not in manually_disabled:
@@ -331,7 +607,8 @@ def _process_phase(phase_sequence: List[Action],
                         if buff_key in active_persistent_buffs:
                             del active_persistent_buffs[buff_key]
             
-            action[KEY_ACTIVE_BUFFS] = active_persistent_buffs # このアクションに適用される持続バフの状態
+            annotation[KEY_ACTIVE_BUFFS] = active_persistent_buffs # このアクションに適用される持続バフの状態
+        if prof is not None: stage_start = prof.add_stage("persistent_buffs", stage_start)
 
         # 1b. 一時的バフの適用 (このアクションがトリガーする一時バフを final_buffed_raw_stats に適用)
         #     この部分は、active_persistent_buffs をベースに一時バフを加算する
@@ -348,20 +625,8 @@ def _process_phase(phase_sequence: List[Action],
                 if not buff_data.get("is_transient"): continue # 一時的バフのみを対象
                 if buff_key in manual_settings.get('disabled', set()): continue # 手動で無効化されていたらスキップ
 
-                is_triggered_by_this_action_on_cast = False
-                owner = buff_data.get("owner")
-                for trigger in buff_data.get("trigger", []):
-                    event, source, timing = trigger.get("event"), trigger.get("source"), trigger.get("timing", "発動時")
-                    source_match = (source == "自身発動" and owner == current_char_name) or \
-                                   (source == "チーム内キャラ発動" and owner in team_char_names)
-                    event_match = (event == "常時") or \
-                                  (event in activation_types_for_current_action) or \
-                                  (event.startswith("スキル: ") and event.replace("スキル: ", "") == skill_name_for_current_action) or \
-                                  (event == "回復効果" and is_healing_skill_executed)
-
-                    if source_match and event_match and (timing == "発動時" or event == "常時"):
-                        is_triggered_by_this_action_on_cast = True
-                        break 
+                is_triggered_by_this_action_on_cast = _is_buff_triggered(buff_data, current_char_name, team_char_names, activation_types_for_current_action, skill_name_for_current_action, is_healing_skill_executed)
+                if prof is not None: prof.count_trigger(buff_key, is_triggered_by_this_action_on_cast)
                 
                 if is_triggered_by_this_action_on_cast:
                     for effect in buff_data.get(KEY_EFFECTS, []):
@@ -376,13 +641,18 @@ def _process_phase(phase_sequence: List[Action],
                             value = value[build.get(KEY_WEAPON_RANK, 1)-1] if isinstance(value, list) else value
                             final_buffed_raw_stats[effect["stat_to_buff"]] += value
         
+        if prof is not None: stage_start = prof.add_stage("transient_buffs", stage_start)
+
         # 2. ダメージ計算
         damage = 0
-        details = {} if not rng_mode else None # rng_modeならdetailsはNone
+        details = {} if not rng_mode else None # rng_modeならdetailsはNone。通常は補正値の内訳 (文字列化は表示時)
         
         if skill_name_for_current_action in ABNORMAL_EFFECTS:
             stacks = action.get(KEY_STACKS, 1)
             damage = calculate_abnormal_status_damage(skill_name_for_current_action, stacks, final_buffed_raw_stats, enemy_info)
+            if damage_records is not None:
+                pre_enemy_damage, record_damage_types = _calculate_abnormal_pre_enemy_damage(skill_name_for_current_action, stacks, final_buffed_raw_stats)
+                damage_records.append({"action_index": action_index, KEY_CHARACTER: current_char_name, KEY_SKILL: skill_name_for_current_action, "pre_enemy_damage": pre_enemy_damage, KEY_DAMAGE_TYPES: record_damage_types, "buffed_raw_stats": final_buffed_raw_stats})
         else:
             if skill_data_for_current_action: # skill_dataがNoneでない場合のみダメージ計算を試みる
                 final_stats_with_all_buffs = {
@@ -393,8 +663,15 @@ def _process_phase(phase_sequence: List[Action],
                 char_attribute = build.get(KEY_CHARACTER_DATA, {}).get(KEY_ATTRIBUTE)
                 
                 damage, details = calculate_skill_damage(final_stats_with_all_buffs, final_buffed_raw_stats, skill_data_for_current_action, enemy_info, char_attribute, rng_mode=rng_mode)
+                if damage_records is not None:
+                    # 内訳を返すモードなら、calculate_skill_damage が計算した補正値をそのまま使う
+                    c = details if details is not None and "error" not in details else _calculate_damage_components(final_stats_with_all_buffs, final_buffed_raw_stats, skill_data_for_current_action, char_attribute)
+                    crit_bonus = 1 + ((c["crit_rate"] / 100) * (c["crit_damage"] / 100))
+                    damage_records.append({"action_index": action_index, KEY_CHARACTER: current_char_name, KEY_SKILL: skill_name_for_current_action, "pre_enemy_damage": c["base_damage"] * c["damage_up_bonus"] * c["damage_boost_bonus"] * crit_bonus, KEY_DAMAGE_TYPES: c["damage_types"], "buffed_raw_stats": final_buffed_raw_stats, "crit_rate": c["crit_rate"], "crit_damage": c["crit_damage"], "components": c, "base_values": base_values})
             # else: skill_data_for_current_actionがNoneならdamageは0のまま (これは正しくない)
 
+        if prof is not None: stage_start = prof.add_stage("damage", stage_start)
+
         # 3. エネルギー計算
         concerto_energy_gain = skill_data_for_current_action.get(KEY_CONCERTO_ENERGY, 0) if skill_data_for_current_action else 0
         
@@ -414,18 +691,9 @@ def _process_phase(phase_sequence: List[Action],
             if buff_data.get("is_transient"): continue # エネルギー獲得バフは一時的でないもののみ
             if buff_key in manually_disabled: continue 
 
-            is_triggered_for_energy = False
             owner = buff_data.get("owner")
-            for trigger in buff_data.get("trigger", []):
-                event, source = trigger.get("event"), trigger.get("source")
-                source_match = (source == "自身発動" and owner == current_char_name) or (source == "チーム内キャラ発動" and owner in team_char_names)
-                event_match = (event == "常時") or \
-                              (event in activation_types_for_current_action) or \
-                              (event.startswith("スキル: ") and event.replace("スキル: ", "") == skill_name_for_current_action) or \
-                              (event == "回復効果" and is_healing_skill_executed)
-
-                if source_match and event_match and (trigger.get("timing") == "発動時" or event == "常時"):
-                    is_triggered_for_energy = True; break
+            is_triggered_for_energy = _is_buff_triggered(buff_data, current_char_name, team_char_names, activation_types_for_current_action, skill_name_for_current_action, is_healing_skill_executed, default_timing=None)
+            if prof is not None: prof.count_trigger(buff_key, is_triggered_for_energy)
             
             if is_triggered_for_energy:
                 target_type = buff_data.get(KEY_TARGET, "自身")
@@ -433,7 +701,7 @@ def _process_phase(phase_sequence: List[Action],
                 if target_type == "自身": target_chars_for_energy_gain.append(owner)
                 elif target_type == "チーム全員": target_chars_for_energy_gain = list(team_char_names)
                 elif target_type == "チーム内キャラクター1人":
-                    target_char = action.get("target_selections", {}).get(buff_key) or _get_default_target(current_char_name)
+                    target_char = action.get("target_selections", {}).get(buff_key) or _get_default_target(current_char_name, team_builds)
                     target_chars_for_energy_gain.append(target_char)
 
                 for effect in buff_data.get(KEY_EFFECTS, []):
@@ -451,15 +719,15 @@ def _process_phase(phase_sequence: List[Action],
                             if char == current_char_name: calculated_resonance_gain += energy_gain
                             else: total_gain_for_teammates[char] += energy_gain
             
-        action["concerto_energy_gain"] = action.get("manual_concerto_gain", concerto_energy_gain)
-        action["resonance_energy_gain"] = action.get("manual_resonance_gain", calculated_resonance_gain) # calculated_resonance_gainは既にmanual_gainを含む
+        annotation["concerto_energy_gain"] = action.get("manual_concerto_gain", concerto_energy_gain)
+        annotation["resonance_energy_gain"] = action.get("manual_resonance_gain", calculated_resonance_gain) # calculated_resonance_gainは既にmanual_gainを含む
 
         if current_char_name:
             if "終奏スキル" in activation_types_for_current_action:
                 char_concerto_energy[current_char_name] = 0
-            char_concerto_energy[current_char_name] += action["concerto_energy_gain"]
+            char_concerto_energy[current_char_name] += annotation["concerto_energy_gain"]
             
-            char_resonance_energy[current_char_name] += action["resonance_energy_gain"]
+            char_resonance_energy[current_char_name] += annotation["resonance_energy_gain"]
         
         for char, gain in total_gain_for_teammates.items():
             char_resonance_energy[char] += gain
@@ -476,13 +744,15 @@ def _process_phase(phase_sequence: List[Action],
         if current_char_name:
             char_concerto_energy[current_char_name] = min(char_concerto_energy.get(current_char_name, 0), 100.0)
         
-        action["concerto_energy_total"] = char_concerto_energy.get(current_char_name, 0)
-        action["resonance_energy_total"] = char_resonance_energy.get(current_char_name, 0)
+        annotation["concerto_energy_total"] = char_concerto_energy.get(current_char_name, 0)
+        annotation["resonance_energy_total"] = char_resonance_energy.get(current_char_name, 0)
+
+        if prof is not None: stage_start = prof.add_stage("energy", stage_start)
 
         # 4. UI表示用バフと一時的バフを決定 (visible_buffs_for_display)
         visible_buffs_for_display = active_persistent_buffs.copy()
         
-        action['transient_buff_manual_settings'] = {
+        annotation['transient_buff_manual_settings'] = {
             'disabled': {k for k in manually_disabled if all_buffs.get(k, {}).get("is_transient")},
             'stacks': {k: v for k, v in manually_set_stacks.items() if all_buffs.get(k, {}).get("is_transient")}
         }
@@ -491,22 +761,8 @@ def _process_phase(phase_sequence: List[Action],
             for buff_key, buff_data in all_buffs.items():
                 if not buff_data.get("is_transient"): continue
 
-                is_triggered_by_this_action_on_cast = False
-                owner = buff_data.get("owner")
-                for trigger in buff_data.get("trigger", []):
-                    event, source, timing = trigger.get("event"), trigger.get("source"), trigger.get("timing", "発動時")
-                    
-                    source_match = (source == "自身発動" and owner == current_char_name) or \
-                                   (source == "チーム内キャラ発動" and owner in team_char_names)
-                    
-                    event_match = (event == "常時") or \
-                                  (event in activation_types_for_current_action) or \
-                                  (event.startswith("スキル: ") and event.replace("スキル: ", "") == skill_name_for_current_action) or \
-                                  (event == "回復効果" and is_healing_skill_executed)
-                    
-                    if source_match and event_match and (timing == "発動時" or event == "常時"):
-                        is_triggered_by_this_action_on_cast = True
-                        break
+                is_triggered_by_this_action_on_cast = _is_buff_triggered(buff_data, current_char_name, team_char_names, activation_types_for_current_action, skill_name_for_current_action, is_healing_skill_executed)
+                if prof is not None: prof.count_trigger(buff_key, is_triggered_by_this_action_on_cast)
                 
                 if is_triggered_by_this_action_on_cast:
                     if buff_key not in manually_disabled:
@@ -525,23 +781,31 @@ def _process_phase(phase_sequence: List[Action],
                         if buff_key in visible_buffs_for_display:
                             del visible_buffs_for_display[buff_key]
             
-            action['visible_buffs_for_display'] = visible_buffs_for_display
+            annotation['visible_buffs_for_display'] = visible_buffs_for_display
+        if prof is not None: prof.add_stage("display", stage_start)
+
+        if annotate_actions:
+            action.update({k: v for k, v in annotation.items() if k != "action_index"})
+        else:
+            annotations.append(annotation)
 
         total_dmg += damage
         if not rng_mode:
             log.append({KEY_CHARACTER: current_char_name, KEY_SKILL: skill_name_for_current_action, KEY_SKILL_DATA: skill_data_for_current_action, "damage": damage, "total_damage": total_dmg, "concerto_energy": concerto_energy, "calculation_details": details})
     
-        total_time = float(time_marks.count(True)) if time_marks else len(phase_sequence) * 1.5
-        return {
-            "log": log, 
-            "total_damage": total_dmg, 
-            "total_time": total_time,
-            "final_concerto_energy": char_concerto_energy,
-            "final_resonance_energy": char_resonance_energy
-        }
+    total_time = float(time_marks.count(True)) if time_marks else len(phase_sequence) * 1.5
+    return {
+        "log": log, 
+        "total_damage": total_dmg, 
+        "total_time": total_time,
+        "final_concerto_energy": char_concerto_energy,
+        "final_resonance_energy": char_resonance_energy,
+        **({} if annotate_actions else {"annotations": annotations})
+    }
 
-def process_rotation(team_builds: List[Build], initial_sequence: List[Action], loop_sequence: List[Action], enemy_info: Dict, all_buff_data_pre_gathered: Dict, stage_effects_name: str, data_manager, time_marks_initial: List[bool], time_marks_loop: List[bool], ignore_buff: Optional[str] = None) -> CalculationResult:
+def process_rotation(team_builds: List[Build], initial_sequence: List[Action], loop_sequence: List[Action], enemy_info: Dict, all_buff_data_pre_gathered: Dict, stage_effects_name: str, data_manager, time_marks_initial: List[bool], time_marks_loop: List[bool], ignore_buff: Optional[str] = None, annotate_actions: bool = True) -> CalculationResult:
     all_buffs = all_buff_data_pre_gathered if all_buff_data_pre_gathered is not None else {}
+    if not annotate_actions: all_buffs = dict(all_buffs) # 副作用なしモードでは渡されたバフ辞書にステージ効果を足さない
     if stage_effects_name and data_manager:
         stage_data = data_manager.get_data("stage_effects", {}).get(stage_effects_name, {})
         for k, v in stage_data.get(KEY_BUFFS, {}).items(): all_buffs[f"stage_{k}"] = {**v, "owner": "Stage"}
@@ -551,12 +815,12 @@ def process_rotation(team_builds: List[Build], initial_sequence: List[Action], l
     initial_concerto_energy = defaultdict(float)
     initial_resonance_energy = defaultdict(float)
     
-    initial_phase_result = _process_phase(initial_sequence, team_builds, team_stats, all_buffs, enemy_info, initial_concerto_energy, initial_resonance_energy, time_marks=time_marks_initial, ignored_buff_key=ignore_buff)
+    initial_phase_result = _process_phase(initial_sequence, team_builds, team_stats, all_buffs, enemy_info, initial_concerto_energy, initial_resonance_energy, time_marks=time_marks_initial, ignored_buff_key=ignore_buff, annotate_actions=annotate_actions)
     
     final_concerto_energy = initial_phase_result.get("final_concerto_energy", defaultdict(float))
     final_resonance_energy = initial_phase_result.get("final_resonance_energy", defaultdict(float))
     
-    loop_phase_result = _process_phase(loop_sequence, team_builds, team_stats, all_buffs, enemy_info, final_concerto_energy, final_resonance_energy, time_marks=time_marks_loop, ignored_buff_key=ignore_buff)
+    loop_phase_result = _process_phase(loop_sequence, team_builds, team_stats, all_buffs, enemy_info, final_concerto_energy, final_resonance_energy, time_marks=time_marks_loop, ignored_buff_key=ignore_buff, annotate_actions=annotate_actions)
     
     # ▼▼▼ ここが修正点 ▼▼▼
     # もし結果がNoneや期待しない形だった場合でも、デフォルトの空の結果を返すようにする
@@ -567,47 +831,868 @@ def process_rotation(team_builds: List[Build], initial_sequence: List[Action], l
     }
     # ▲▲▲ ここまで ▲▲▲
 
-def run_simulation_with_rng(num_simulations: int, num_loops: int, team_builds: List, initial_sequence: List, loop_sequence: List, enemy_info: Dict, all_buffs: Dict, time_marks_initial: List[bool], time_marks_loop: List[bool]):
-    total_damages = []
-    team_stats_cache = {b[KEY_CHARACTER_NAME]: calculate_base_stats(b) for b in team_builds if b.get(KEY_CHARACTER_NAME)}
-    
-    # 時間計算
+ROTATION_PLAN_VERSION = 2
+_ROTATION_PLAN_CACHE_SIZE = 32
+_rotation_plan_cache: "OrderedDict[str, RotationPlan]" = OrderedDict()
+
+# _plan_phase が Action から読むフィールド (足したらここにも足す)。UI が書き込む注釈はハッシュに含めない
+_PLAN_ACTION_KEYS = (KEY_CHARACTER, KEY_SKILL, KEY_SKILL_DATA, KEY_STACKS, "manual_resonance_gain", "manual_concerto_gain", "target_selections", "transient_buff_manual_settings", "abnormal_applications")
+
+def _hash_json_default(o):
+    return sorted(o) if isinstance(o, set) else str(o)
+
+def _action_hash_inputs(phase_sequence: List[Action]) -> List[Dict]:
+    return [{k: a.get(k) for k in _PLAN_ACTION_KEYS if k in a} for a in phase_sequence]
+
+def _rotation_plan_input_hash(team_builds: List[Build], phases: List[List[Action]], all_buffs: Dict, time_marks: List[Optional[List[bool]]], ignored_buff_key: Optional[str]) -> str:
+    """
+    ローテーション計画の入力のハッシュ。バフのトリガーは音骸に依存しないため、echo_list は含めない
+    (音骸だけが違うビルドでは同じ計画を使い回せる)。
+    """
+    builds = [{k: v for k, v in b.items() if k != KEY_ECHO_LIST} for b in team_builds]
+    actions = [_action_hash_inputs(phase) for phase in phases]
+    payload = json.dumps([ROTATION_PLAN_VERSION, builds, actions, all_buffs, time_marks, ignored_buff_key], ensure_ascii=False, sort_keys=True, default=_hash_json_default)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+def _plan_phase(phase_sequence: List[Action], team_builds: List[Build], team_stats: Dict, all_buffs: Dict, ignored_buff_key: Optional[str]) -> List[Dict]:
+    """_process_phase と同じ規則で、各アクションのバフ状態とエネルギーの内訳だけを求める (入力は書き換えない)"""
+    team_char_names = {b[KEY_CHARACTER_NAME] for b in team_builds if b.get(KEY_CHARACTER_NAME)}
+    builds_by_name = {b[KEY_CHARACTER_NAME]: b for b in team_builds if b.get(KEY_CHARACTER_NAME)}
+    steps = []
+    for action_index, action in enumerate(phase_sequence):
+        current_char_name = action.get(KEY_CHARACTER)
+        if not current_char_name:
+            if action.get(KEY_SKILL) in ABNORMAL_EFFECTS:
+                current_char_name = team_builds[0][KEY_CHARACTER_NAME] if team_builds else ""
+            else: continue
+        build = builds_by_name.get(current_char_name)
+        if not build: continue
+        _, base_raw, _ = team_stats[current_char_name]
+        skill_data = action.get(KEY_SKILL_DATA)
+        skill_name = action.get(KEY_SKILL, "")
+        activation_types = skill_data.get(KEY_ACTIVATION_TYPES, []) if skill_data else []
+        is_healing = skill_data.get("is_healing", False) if skill_data else False
+        weapon_rank = build.get(KEY_WEAPON_RANK, 1)
+
+        # 持続バフ (このアクションで発動するもの) と一時バフ
+        active_buffs = {}
+        transient_additions = []
+        manual_settings = action.get('transient_buff_manual_settings', {'disabled': set(), 'stacks': {}})
+        for buff_key, buff_data in all_buffs.items():
+            if not _is_buff_triggered(buff_data, current_char_name, team_char_names, activation_types, skill_name, is_healing): continue
+            effects = buff_data.get(KEY_EFFECTS, [])
+            if not buff_data.get("is_transient"):
+                is_stackable = effects and effects[0].get("type") == "スタック形式"
+                active_buffs[buff_key] = effects[0].get("max_stacks", 1) if is_stackable else True
+                if is_stackable and active_buffs[buff_key] <= 0: del active_buffs[buff_key]
+            elif buff_key not in manual_settings.get('disabled', set()):
+                for effect in effects:
+                    if effect.get("type") == "スタック形式":
+                        stack_count = manual_settings.get('stacks', {}).get(buff_key, effect.get("max_stacks", 1))
+                        if stack_count > 0:
+                            per_stack = effect.get("effect_per_stack", [0]*5)
+                            transient_additions.append((effect["stat_to_buff"], (per_stack[weapon_rank-1] if isinstance(per_stack, list) else per_stack) * stack_count))
+                    elif "stat_to_buff" in effect:
+                        value = effect.get(KEY_VALUE, [0]*5)
+                        transient_additions.append((effect["stat_to_buff"], value[weapon_rank-1] if isinstance(value, list) else value))
+
+        # エネルギー: 共鳴効率に比例する分は係数のまま持ち、評価時のステータスで計算する
+        energy = {
+            "concerto_gain": action.get("manual_concerto_gain", 0 if "終奏スキル" in activation_types else (skill_data.get(KEY_CONCERTO_ENERGY, 0) if skill_data else 0)),
+            "concerto_reset": "終奏スキル" in activation_types,
+            "resonance_reset": "共鳴解放" in activation_types,
+            "manual_resonance_gain": action.get("manual_resonance_gain"),
+            "gain_flat": (skill_data.get(KEY_RESONANCE_ENERGY_GAIN_FLAT, 0) if skill_data else 0) + action.get("manual_resonance_gain", 0),
+            "gain_scaling": skill_data.get(KEY_RESONANCE_ENERGY_GAIN_SCALING, 0) if skill_data else 0,
+            "has_skill_data": bool(skill_data),
+            "team_fixed": defaultdict(float), # キャラ -> 固定獲得量
+            "team_variable": defaultdict(float), # キャラ -> 共鳴効率に比例する獲得量の係数
+            "efficiency_bonus": {}, # キャラ -> このアクションのバフによる共鳴効率の上乗せ
+        }
+        for buff_key, buff_data in all_buffs.items():
+            if buff_data.get("is_transient"): continue
+            if not _is_buff_triggered(buff_data, current_char_name, team_char_names, activation_types, skill_name, is_healing, default_timing=None): continue
+            owner = buff_data.get("owner")
+            target_type = buff_data.get(KEY_TARGET, "自身")
+            if target_type == "自身": targets = [owner]
+            elif target_type == "チーム全員": targets = list(team_char_names)
+            elif target_type == "チーム内キャラクター1人": targets = [action.get("target_selections", {}).get(buff_key) or _get_default_target(current_char_name, team_builds)]
+            else: targets = []
+            for effect in buff_data.get(KEY_EFFECTS, []):
+                if effect.get("type") == "共鳴エネルギー獲得(固定)":
+                    for char in targets: energy["team_fixed"][char] += effect.get(KEY_VALUE, 0)
+                elif effect.get("type") == "共鳴エネルギー獲得(変動)":
+                    for char in targets: energy["team_variable"][char] += effect.get(KEY_VALUE, 0)
+        for char in set(energy["team_variable"]) | {current_char_name}:
+            receiver_build = builds_by_name.get(char)
+            if receiver_build is None: continue
+            _, receiver_base_raw, _ = team_stats[char]
+            efficiency = _get_character_efficiency(char, receiver_base_raw, active_buffs, all_buffs, receiver_build)
+            energy["efficiency_bonus"][char] = efficiency - receiver_base_raw.get("resonance_efficiency", 100.0)
+        energy["team_fixed"], energy["team_variable"] = dict(energy["team_fixed"]), dict(energy["team_variable"])
+
+        steps.append({
+            "action_index": action_index,
+            KEY_CHARACTER: current_char_name,
+            KEY_SKILL: skill_name,
+            KEY_SKILL_DATA: skill_data,
+            KEY_STACKS: action.get(KEY_STACKS, 1),
+            "is_abnormal": skill_name in ABNORMAL_EFFECTS,
+            "abnormal_applications": action.get("abnormal_applications") or (skill_data.get("abnormal_applications") if skill_data else None) or {},
+            KEY_ACTIVE_BUFFS: active_buffs,
+            "effects": _resolve_buff_effect_records(active_buffs, current_char_name, all_buffs, build.get(KEY_CONSTELLATION, 0), weapon_rank, ignored_buff_key),
+            "transient_additions": transient_additions,
+            "energy": energy,
+        })
+    return steps
+
+def build_rotation_plan(team_builds: List[Build], initial_sequence: List[Action], loop_sequence: List[Action], all_buffs: Dict,
+                        time_marks_initial: Optional[List[bool]] = None, time_marks_loop: Optional[List[bool]] = None,
+                        ignored_buff_key: Optional[str] = None, use_cache: bool = True) -> RotationPlan:
+    """
+    (チーム, ローテーション) から、ビルド・敵・乱数に依存しない「ローテーション計画」を作る。
+    各アクションについて、行動キャラ・スキル・有効な持続バフの効果レコード・一時バフの加算・エネルギーの内訳を持つ。
+    入力のハッシュでキャッシュし、同じ入力なら同じ計画を返す (計画は読み取り専用として扱うこと)。
+    JSON にそのまま書き出せるが、効果レコードはタプルのため読み込み後はリストになる (評価はどちらでも動く)。
+    """
+    input_hash = _rotation_plan_input_hash(team_builds, [initial_sequence, loop_sequence], all_buffs, [time_marks_initial, time_marks_loop], ignored_buff_key)
+    if use_cache and input_hash in _rotation_plan_cache:
+        _rotation_plan_cache.move_to_end(input_hash)
+        return _rotation_plan_cache[input_hash]
+
+    team_stats = {b[KEY_CHARACTER_NAME]: calculate_base_stats(b) for b in team_builds if b.get(KEY_CHARACTER_NAME)}
+    def _phase_time(sequence, time_marks):
+        return float(time_marks.count(True)) if time_marks else len(sequence) * 1.5
+    plan = {
+        "version": ROTATION_PLAN_VERSION,
+        "input_hash": input_hash,
+        "character_names": [b[KEY_CHARACTER_NAME] for b in team_builds if b.get(KEY_CHARACTER_NAME)],
+        "character_attributes": {b[KEY_CHARACTER_NAME]: b.get(KEY_CHARACTER_DATA, {}).get(KEY_ATTRIBUTE) for b in team_builds if b.get(KEY_CHARACTER_NAME)},
+        "resonance_energy_required": {b[KEY_CHARACTER_NAME]: b.get(KEY_CHARACTER_DATA, {}).get(KEY_RESONANCE_ENERGY_REQUIRED, 1) for b in team_builds if b.get(KEY_CHARACTER_NAME)},
+        "initial": _plan_phase(initial_sequence, team_builds, team_stats, all_buffs, ignored_buff_key) if initial_sequence else [],
+        "loop": _plan_phase(loop_sequence, team_builds, team_stats, all_buffs, ignored_buff_key) if loop_sequence else [],
+        "initial_time": _phase_time(initial_sequence, time_marks_initial) if initial_sequence else 0.0,
+        "loop_time": _phase_time(loop_sequence, time_marks_loop) if loop_sequence else 0.0,
+    }
+    if use_cache:
+        _rotation_plan_cache[input_hash] = plan
+        if len(_rotation_plan_cache) > _ROTATION_PLAN_CACHE_SIZE: _rotation_plan_cache.popitem(last=False)
+    return plan
+
+def _evaluate_plan_phase(steps: List[Dict], plan: RotationPlan, team_stats: Dict, enemy_info: Dict, concerto_energy: Dict[str, float], resonance_energy: Dict[str, float], rng=None) -> Dict:
+    """計画の1フェーズを評価する。rng (random.random を持つもの) を渡すと会心を乱数で判定する"""
+    char_concerto_energy = defaultdict(float, concerto_energy)
+    char_resonance_energy = defaultdict(float, resonance_energy)
+    damages = []
+    for step in steps:
+        char = step[KEY_CHARACTER]
+        _, base_raw, base_values = team_stats[char]
+        buffed = _apply_buff_effect_records(base_raw, step["effects"])
+        executor_efficiency = buffed.get("resonance_efficiency", 100.0)
+        for stat_key, value in step["transient_additions"]: buffed[stat_key] += value
+
+        # ダメージ (calculate_skill_damage / calculate_abnormal_status_damage と同じ式)
+        damage = 0.0
+        skill_data = step[KEY_SKILL_DATA]
+        if step["is_abnormal"]:
+            damage = calculate_abnormal_status_damage(step[KEY_SKILL], step[KEY_STACKS], buffed, enemy_info)
+        elif skill_data:
+            final_stats = {
+                "HP": base_values["hp"] * (1 + buffed.get("hp_percent", 0) / 100) + buffed.get("hp_flat", 0),
+                "攻撃力": base_values["atk"] * (1 + buffed.get("atk_percent", 0) / 100) + buffed.get("atk_flat", 0),
+                "防御力": base_values["def"] * (1 + buffed.get("def_percent", 0) / 100) + buffed.get("def_flat", 0)
+            }
+            c = _calculate_damage_components(final_stats, buffed, skill_data, plan["character_attributes"].get(char))
+            if rng is not None:
+                crit_bonus = 1 + c["crit_damage"] / 100.0 if rng.random() < c["crit_rate"] / 100.0 else 1.0
+            else:
+                crit_bonus = 1 + (c["crit_rate"] / 100) * (c["crit_damage"] / 100)
+            defense_bonus, resistance_bonus, dmg_taken_bonus = _calculate_shared_bonuses(buffed, enemy_info, c["damage_types"])
+            damage = max(c["base_damage"] * c["damage_up_bonus"] * c["damage_boost_bonus"] * crit_bonus * defense_bonus * resistance_bonus * dmg_taken_bonus, 0.0)
+        damages.append(damage)
+
+        # エネルギー (_process_phase と同じ順序で加算・リセット・上限処理)
+        e = step["energy"]
+        resonance_gain = e["gain_flat"] if e["has_skill_data"] else (e["manual_resonance_gain"] or 0)
+        if e["has_skill_data"]: resonance_gain += e["gain_scaling"] * executor_efficiency / 100.0
+        teammate_gain = defaultdict(float)
+        for receiver, value in e["team_fixed"].items():
+            if receiver == char: resonance_gain += value
+            else: teammate_gain[receiver] += value
+        for receiver, value in e["team_variable"].items():
+            if receiver not in team_stats: continue
+            efficiency = team_stats[receiver][1].get("resonance_efficiency", 100.0) + e["efficiency_bonus"].get(receiver, 0.0)
+            if receiver == char: resonance_gain += value * efficiency / 100.0
+            else: teammate_gain[receiver] += value * efficiency / 100.0
+        if e["manual_resonance_gain"] is not None: resonance_gain = e["manual_resonance_gain"]
+        if e["concerto_reset"]: char_concerto_energy[char] = 0
+        char_concerto_energy[char] += e["concerto_gain"]
+        char_resonance_energy[char] += resonance_gain
+        for receiver, gain in teammate_gain.items(): char_resonance_energy[receiver] += gain
+        if e["resonance_reset"]: char_resonance_energy[char] = 0
+        for receiver in list(char_resonance_energy):
+            if receiver in plan["resonance_energy_required"]:
+                char_resonance_energy[receiver] = min(char_resonance_energy[receiver], plan["resonance_energy_required"][receiver])
+        char_concerto_energy[char] = min(char_concerto_energy[char], 100.0)
+    return {"damages": damages, "total_damage": float(sum(damages)), "final_concerto_energy": char_concerto_energy, "final_resonance_energy": char_resonance_energy}
+
+def evaluate_rotation_plan(plan: RotationPlan, team_builds: List[Build], enemy_info: Dict, num_loops: int = 1, rng=None,
+                           team_stats: Optional[Dict] = None) -> RotationPlanEvaluation:
+    """
+    ローテーション計画を、ビルド (team_builds / team_stats)・敵・乱数を変えて評価する。バフのトリガー判定は行わない。
+    rng を省略すると会心は期待値、random.Random などを渡すと乱数で判定する。
+    """
+    team_stats = team_stats or {b[KEY_CHARACTER_NAME]: calculate_base_stats(b) for b in team_builds if b.get(KEY_CHARACTER_NAME)}
+    initial = _evaluate_plan_phase(plan["initial"], plan, team_stats, enemy_info, defaultdict(float), defaultdict(float), rng)
+    loop = _evaluate_plan_phase(plan["loop"], plan, team_stats, enemy_info, initial["final_concerto_energy"], initial["final_resonance_energy"], rng)
+    total_time = plan["initial_time"] + plan["loop_time"] * num_loops
+    total_damage = initial["total_damage"] + loop["total_damage"] * num_loops
+    return {
+        "initial_damages": initial["damages"], "loop_damages": loop["damages"],
+        "initial_damage": initial["total_damage"], "loop_damage": loop["total_damage"],
+        "total_damage": total_damage, "total_time": total_time, "dps": total_damage / total_time if total_time > 0 else 0.0,
+        "final_concerto_energy": dict(loop["final_concerto_energy"]), "final_resonance_energy": dict(loop["final_resonance_energy"]),
+    }
+
+def merge_phase_annotations(phase_sequence: List[Action], annotations: List[ActionAnnotation]) -> None:
+    """annotate_actions=False で得た注釈を、UI 用に元の Action へ書き戻す"""
+    for annotation in annotations:
+        phase_sequence[annotation["action_index"]].update({k: v for k, v in annotation.items() if k != "action_index"})
+
+def _action_start_times(phase_sequence: List[Action], time_marks: Optional[List[bool]]) -> List[float]:
+    """フェーズ先頭からの各アクションの開始時刻。time_marks があれば前までの True の数、無ければ1アクション1.5秒"""
+    if not time_marks: return [i * 1.5 for i in range(len(phase_sequence))]
+    times, elapsed = [], 0.0
+    for i in range(len(phase_sequence)):
+        times.append(elapsed)
+        if i < len(time_marks) and time_marks[i]: elapsed += 1.0
+    return times
+
+def simulate_abnormal_timeline(applications: List[Dict], end_time: float, enemy_info: Dict, params: Optional[Dict[str, Dict]] = None) -> AbnormalTimelineResult:
+    """
+    異常効果の付与イベント {"time", "effect", "stacks", "buffed_raw_stats"} の列から、スタックの増減と
+    ダメージ間隔ごとのダメージを end_time まで追う。
+      stacking_dot (騒光効果 / 風蝕効果): 付与でスタック加算 (最大まで) と持続時間の更新、tick_interval ごとに
+        その時点のスタック数でダメージを与え、stacks_lost_per_tick だけスタックが減る。持続が切れるかスタックが尽きたら終了
+      detonation (斉爆効果 / 虚滅効果): 付与の時点で1回だけダメージを与える
+    ダメージのステータスは最後に付与したアクションのものを使う。スタック倍率は ABNORMAL_STACK_MULTIPLIER_TABLES を
+    配列のまま引き、ステータスごとの係数とまとめて掛けるので、60スタックの長い戦闘でもダメージ回数に比例するだけで済む。
+    """
+    params = {**ABNORMAL_TIMELINE_PARAMS, **(params or {})}
+    snapshot_index: Dict[int, int] = {} # id(buffed_raw_stats) -> snapshots の位置
+    snapshots: List[Dict[str, float]] = []
+    by_effect = defaultdict(list)
+    for app in applications:
+        if app["effect"] not in ABNORMAL_EFFECTS or app.get("stacks", 0) <= 0: continue
+        stats = app.get("buffed_raw_stats") or {}
+        if id(stats) not in snapshot_index:
+            snapshot_index[id(stats)] = len(snapshots)
+            snapshots.append(stats)
+        by_effect[app["effect"]].append((float(app["time"]), int(app["stacks"]), snapshot_index[id(stats)]))
+
+    tick_times, tick_effects, tick_stacks, tick_snapshots = [], [], [], []
+    max_stacks_by_effect = {}
+    for effect_name, effect_apps in by_effect.items():
+        effect_apps.sort(key=lambda a: a[0])
+        effect_info = ABNORMAL_EFFECTS[effect_name]
+        cap = len(ABNORMAL_STACK_MULTIPLIER_TABLES[effect_name]) - 1
+        if effect_info.get("type") != "stacking_dot":
+            for t, stacks, snap in effect_apps:
+                if t > end_time: break
+                tick_times.append(t); tick_effects.append(effect_name); tick_stacks.append(min(stacks, cap)); tick_snapshots.append(snap)
+            continue
+        p = params.get(effect_name, {})
+        interval, duration, lost = p.get("tick_interval", 3.0), p.get("duration", 15.0), p.get("stacks_lost_per_tick", 0)
+        stacks, expire, next_tick, snap, peak = 0, float("-inf"), None, 0, 0
+        i = 0
+        while True:
+            next_app = effect_apps[i][0] if i < len(effect_apps) else None
+            if next_app is not None and (next_tick is None or next_app <= next_tick):
+                if next_app > end_time: break
+                t, added, snap = effect_apps[i]
+                i += 1
+                if t > expire: # 次のダメージより前に持続が切れていたら、残りスタックは捨てて新しく付与し直す
+                    stacks, next_tick = 0, None
+                stacks = min(stacks + added, cap)
+                peak = max(peak, stacks)
+                expire = t + duration
+                if next_tick is None: next_tick = t + interval
+            elif next_tick is not None:
+                if next_tick > end_time: break
+                t, next_tick = next_tick, next_tick + interval
+                if t > expire or stacks <= 0:
+                    stacks, next_tick = 0, None
+                    continue
+                tick_times.append(t); tick_effects.append(effect_name); tick_stacks.append(stacks); tick_snapshots.append(snap)
+                stacks -= lost
+                if stacks <= 0: stacks, next_tick = 0, None
+            else:
+                break
+        max_stacks_by_effect[effect_name] = peak
+
+    # ステータス・効果ごとの係数 (基礎値 * 属性係数 * ブースト * 敵の補正) は一度だけ計算する
+    scale_cache: Dict[Tuple[str, int], float] = {}
+    scales = np.empty(len(tick_times))
+    multipliers = np.empty(len(tick_times))
+    for n, (effect_name, stacks, snap) in enumerate(zip(tick_effects, tick_stacks, tick_snapshots)):
+        key = (effect_name, snap)
+        if key not in scale_cache:
+            unit_damage, damage_types = _calculate_abnormal_pre_enemy_damage(effect_name, 1, snapshots[snap])
+            defense_bonus, resistance_bonus, dmg_taken_bonus = _calculate_shared_bonuses(snapshots[snap], enemy_info, damage_types)
+            scale_cache[key] = max(unit_damage / _abnormal_stack_multiplier(effect_name, 1) * defense_bonus * resistance_bonus * dmg_taken_bonus, 0.0)
+        scales[n] = scale_cache[key]
+        multipliers[n] = ABNORMAL_STACK_MULTIPLIER_TABLES[effect_name][stacks]
+    damages = scales * multipliers
+
+    damage_by_effect, tick_count_by_effect = defaultdict(float), defaultdict(int)
+    for effect_name, damage in zip(tick_effects, damages):
+        damage_by_effect[effect_name] += float(damage)
+        tick_count_by_effect[effect_name] += 1
+    order = sorted(range(len(tick_times)), key=lambda n: tick_times[n])
+    return {
+        "total_damage": float(damages.sum()),
+        "damage_by_effect": dict(damage_by_effect),
+        "tick_count_by_effect": dict(tick_count_by_effect),
+        "max_stacks_by_effect": max_stacks_by_effect,
+        "ticks": [{"time": tick_times[n], "effect": tick_effects[n], "stacks": tick_stacks[n], "damage": float(damages[n])} for n in order],
+        "end_time": end_time,
+    }
+
+def simulate_rotation_abnormal_timeline(team_builds: List[Build], initial_sequence: List[Action], loop_sequence: List[Action], all_buffs: Dict, enemy_info: Dict,
+                                        time_marks_initial: Optional[List[bool]] = None, time_marks_loop: Optional[List[bool]] = None,
+                                        num_loops: int = 1, params: Optional[Dict[str, Dict]] = None) -> AbnormalTimelineResult:
+    """
+    ローテーション (初動 + ループ x num_loops) の異常効果を simulate_abnormal_timeline で追う。
+    付与は Action / skill_data の "abnormal_applications" ({異常効果名: スタック数}) と、異常効果名の Action
+    (stacks 個の付与として扱う) から集める。付与時のステータスはローテーション計画と同じバフ状態で求める。
+    """
+    plan = build_rotation_plan(team_builds, initial_sequence, loop_sequence, all_buffs, time_marks_initial, time_marks_loop)
+    team_stats = {b[KEY_CHARACTER_NAME]: calculate_base_stats(b) for b in team_builds if b.get(KEY_CHARACTER_NAME)}
+
+    def _phase_applications(steps: List[Dict], sequence: List[Action], time_marks: Optional[List[bool]]) -> List[Tuple[float, str, int, Dict]]:
+        start_times = _action_start_times(sequence, time_marks)
+        result = []
+        for step in steps:
+            applied = dict(step.get("abnormal_applications") or {})
+            if step["is_abnormal"]: applied[step[KEY_SKILL]] = applied.get(step[KEY_SKILL], 0) + step[KEY_STACKS]
+            if not applied: continue
+            _, base_raw, _ = team_stats[step[KEY_CHARACTER]]
+            buffed = _apply_buff_effect_records(base_raw, step["effects"])
+            for stat_key, value in step["transient_additions"]: buffed[stat_key] += value
+            for effect_name, stacks in applied.items():
+                result.append((start_times[step["action_index"]], effect_name, stacks, buffed))
+        return result
+
+    applications = [{"time": t, "effect": e, "stacks": n, "buffed_raw_stats": b} for t, e, n, b in _phase_applications(plan["initial"], initial_sequence, time_marks_initial)]
+    loop_applications = _phase_applications(plan["loop"], loop_sequence, time_marks_loop)
+    for k in range(num_loops):
+        offset = plan["initial_time"] + plan["loop_time"] * k
+        applications.extend({"time": offset + t, "effect": e, "stacks": n, "buffed_raw_stats": b} for t, e, n, b in loop_applications)
+    return simulate_abnormal_timeline(applications, plan["initial_time"] + plan["loop_time"] * num_loops, enemy_info, params)
+
+def simulation_total_time(num_loops: int, initial_sequence: List, loop_sequence: List, time_marks_initial: List[bool], time_marks_loop: List[bool]) -> float:
+    """シミュレーションの DPS に使う総時間。時間マークがなければ1アクション1.5秒として数える"""
     total_time = time_marks_initial.count(True) + (time_marks_loop.count(True) * num_loops)
     if total_time == 0:
         total_time = (len(initial_sequence) + len(loop_sequence) * num_loops) * 1.5
     if total_time == 0: total_time = 1 # ゼロ除算防止
+    return total_time
 
-    for i in range(num_simulations):
-        # _process_phaseをRNGモードで呼び出す
-        initial_phase_result = _process_phase(initial_sequence, team_builds, team_stats_cache, all_buffs, enemy_info, 0.0, time_marks=time_marks_initial, rng_mode=True)
-        loop_phase_result = _process_phase(loop_sequence, team_builds, team_stats_cache, all_buffs, enemy_info, 0.0, time_marks=time_marks_loop, rng_mode=True)
-        
-        total_damage = initial_phase_result["total_damage"] + (loop_phase_result["total_damage"] * num_loops)
-        total_damages.append(total_damage)
-    
+def simulate_rotation_damages(num_simulations: int, num_loops: int, team_builds: List, initial_sequence: List, loop_sequence: List, enemy_info: Dict, all_buffs: Dict,
+                              time_marks_initial: List[bool], time_marks_loop: List[bool], seed: Optional[int] = None) -> List[float]:
+    """
+    会心を乱数で決めたシミュレーションを num_simulations 回行い、各回の総ダメージを返す。
+    seed を渡すとその乱数列で再現できる (分割して並列に回すときはチャンクごとに別の seed を渡す)。
+    """
+    team_stats_cache = {b[KEY_CHARACTER_NAME]: calculate_base_stats(b) for b in team_builds if b.get(KEY_CHARACTER_NAME)}
+    rng = random.Random(seed) if seed is not None else random
+    # バフのトリガー判定は一度だけ行い、各シミュレーションでは会心の乱数だけを変えて評価する
+    plan = build_rotation_plan(team_builds, initial_sequence, loop_sequence, all_buffs, time_marks_initial, time_marks_loop)
+    return [evaluate_rotation_plan(plan, team_builds, enemy_info, num_loops, rng=rng, team_stats=team_stats_cache)["total_damage"] for _ in range(num_simulations)]
+
+def summarize_simulation_damages(total_damages: List[float], total_time: float) -> SimulationStats:
     damages_np = np.array(total_damages)
-    stats = {
-        "simulations_count": num_simulations,
+    return {
+        "simulations_count": len(total_damages),
         "total_damage_avg": np.mean(damages_np), "total_damage_max": np.max(damages_np),
         "total_damage_min": np.min(damages_np), "total_damage_median": np.median(damages_np),
         "total_damage_std_dev": np.std(damages_np), "dps_avg": np.mean(damages_np) / total_time,
         "dps_max": np.max(damages_np) / total_time, "dps_min": np.min(damages_np) / total_time,
     }
-    return stats
 
-def generate_build_combinations(
+def run_simulation_with_rng(num_simulations: int, num_loops: int, team_builds: List, initial_sequence: List, loop_sequence: List, enemy_info: Dict, all_buffs: Dict, time_marks_initial: List[bool], time_marks_loop: List[bool]):
+    total_time = simulation_total_time(num_loops, initial_sequence, loop_sequence, time_marks_initial, time_marks_loop)
+    total_damages = simulate_rotation_damages(num_simulations, num_loops, team_builds, initial_sequence, loop_sequence, enemy_info, all_buffs, time_marks_initial, time_marks_loop)
+    return summarize_simulation_damages(total_damages, total_time)
+
+def sweep_enemy_parameters(team_builds: List[Build], initial_sequence: List[Action], loop_sequence: List[Action], all_buffs: Dict, time_marks_initial: List[bool], time_marks_loop: List[bool], enemy_levels=None, enemy_resistances=None, num_loops: int = 1, base_enemy_info: Optional[Dict] = None) -> EnemySweepResult:
+    """
+    バフのタイムラインは敵に依存しないため、ローテーションを一度だけ計算し、
+    敵レベル × 敵耐性 (全属性共通, %) のグリッド上の総ダメージ面を NumPy で一括評価する。
+    戻り値の total_damage[i, j] は enemy_levels[i], enemy_resistances[j] に対応する (初動 + num_loops ループ)。
+    """
+    levels = np.asarray(enemy_levels if enemy_levels is not None else np.arange(80, 101), dtype=float)
+    resistances = np.asarray(enemy_resistances if enemy_resistances is not None else np.arange(-20, 61, 5), dtype=float)
+    enemy_info = base_enemy_info or {KEY_LEVEL: 90}
+    team_stats = {b[KEY_CHARACTER_NAME]: calculate_base_stats(b) for b in team_builds if b.get(KEY_CHARACTER_NAME)}
+
+    initial_records, loop_records = [], []
+    initial_result = _process_phase(initial_sequence, team_builds, team_stats, all_buffs, enemy_info, defaultdict(float), defaultdict(float), time_marks=time_marks_initial, damage_records=initial_records, annotate_actions=False)
+    loop_result = _process_phase(loop_sequence, team_builds, team_stats, all_buffs, enemy_info, initial_result["final_concerto_energy"], initial_result["final_resonance_energy"], time_marks=time_marks_loop, damage_records=loop_records, annotate_actions=False)
+
+    records = initial_records + loop_records
+    total_time = initial_result["total_time"] + loop_result["total_time"] * num_loops
+    if not records:
+        total_damage = np.zeros((len(levels), len(resistances)))
+    else:
+        weights = np.array([1.0] * len(initial_records) + [float(num_loops)] * len(loop_records))
+        pre_enemy = np.array([r["pre_enemy_damage"] for r in records])
+        defense, resistance, dmg_taken = _calculate_shared_bonuses_grid([r["buffed_raw_stats"] for r in records], [r[KEY_DAMAGE_TYPES] for r in records], levels, resistances)
+        # 単発計算と同様に、耐性が100%を超えてマイナスになるアクションは0ダメージとして扱う
+        total_damage = np.einsum("a,al,ar->lr", weights * pre_enemy * dmg_taken, defense, np.maximum(resistance, 0))
+    return {
+        "enemy_levels": levels,
+        "enemy_resistances": resistances,
+        "total_damage": total_damage,
+        "dps": total_damage / total_time if total_time > 0 else np.zeros_like(total_damage),
+        "total_time": total_time,
+    }
+
+def evaluate_multi_target_rotation(team_builds: List[Build], initial_sequence: List[Action], loop_sequence: List[Action], all_buffs: Dict, targets: List[Dict],
+                                   time_marks_initial: List[bool], time_marks_loop: List[bool], num_loops: int = 1,
+                                   hit_counts: Optional[Dict[str, int]] = None, default_hit_count: int = 1) -> MultiTargetResult:
+    """
+    ローテーションを複数の敵 (targets: enemy_info のリスト、先頭ほど優先して狙う) に対して評価する。
+    バフ状態とアクションごとのステータスは敵に依存しないので _process_phase は一度だけ回し、
+    全アクション × 全ての敵のダメージを NumPy でまとめて計算する。
+    各アクションが当たる敵の数は Action の "hit_count" > hit_counts[スキル名] > skill_data の "hit_count" > default_hit_count の順で決め、
+    先頭からその数の敵に当たるものとする。
+    """
+    if not targets: raise ValueError("targets が空です")
+    hit_counts = hit_counts or {}
+    team_stats = {b[KEY_CHARACTER_NAME]: calculate_base_stats(b) for b in team_builds if b.get(KEY_CHARACTER_NAME)}
+    main_target = targets[0]
+
+    initial_records, loop_records = [], []
+    initial_result = _process_phase(initial_sequence, team_builds, team_stats, all_buffs, main_target, defaultdict(float), defaultdict(float), time_marks=time_marks_initial, damage_records=initial_records, annotate_actions=False)
+    loop_result = _process_phase(loop_sequence, team_builds, team_stats, all_buffs, main_target, initial_result["final_concerto_energy"], initial_result["final_resonance_energy"], time_marks=time_marks_loop, damage_records=loop_records, annotate_actions=False)
+    total_time = initial_result["total_time"] + loop_result["total_time"] * num_loops
+
+    def _phase_damages(records: List[Dict], sequence: List[Action]) -> np.ndarray:
+        if not records: return np.zeros((0, len(targets)))
+        pre_enemy = np.array([r["pre_enemy_damage"] for r in records])
+        defense, resistance, dmg_taken = _calculate_shared_bonuses_targets([r["buffed_raw_stats"] for r in records], [r[KEY_DAMAGE_TYPES] for r in records], targets)
+        counts = []
+        for r in records:
+            action = sequence[r["action_index"]]
+            skill_data = action.get(KEY_SKILL_DATA) or {}
+            count = next((c for c in (action.get("hit_count"), hit_counts.get(r[KEY_SKILL]), skill_data.get("hit_count")) if c is not None), default_hit_count)
+            counts.append(count)
+        hit_mask = np.arange(len(targets))[None, :] < np.array(counts)[:, None]
+        # 単体計算と同様に、マイナスになるダメージは0として扱う
+        return np.maximum((pre_enemy * dmg_taken)[:, None] * defense * resistance, 0.0) * hit_mask
+
+    initial_damages = _phase_damages(initial_records, initial_sequence)
+    loop_damages = _phase_damages(loop_records, loop_sequence)
+    per_target = initial_damages.sum(axis=0) + loop_damages.sum(axis=0) * num_loops
+    total_damage = float(per_target.sum())
+    return {
+        "targets": targets,
+        "per_target_damage": per_target.tolist(),
+        "per_target_dps": (per_target / total_time).tolist() if total_time > 0 else [0.0] * len(targets),
+        "total_damage": total_damage,
+        "total_time": total_time,
+        "dps": total_damage / total_time if total_time > 0 else 0.0,
+        "initial_action_damages": initial_damages,
+        "loop_action_damages": loop_damages,
+    }
+
+def build_energy_timeline(team_builds: List[Build], phases: List[List[Action]], all_buffs: Dict) -> List[List[Dict]]:
+    """
+    エネルギー計算だけに必要な情報 (持続バフの状態・獲得量の内訳) を、フェーズごと・アクションごとに前計算する。
+    ビルド (音骸) に依存しないため、最適化中は一度作れば使い回せる。
+    """
+    team_char_names = {b[KEY_CHARACTER_NAME] for b in team_builds if b.get(KEY_CHARACTER_NAME)}
+    build_by_name = {b[KEY_CHARACTER_NAME]: b for b in team_builds if b.get(KEY_CHARACTER_NAME)}
+    buff_state_ids: Dict[Tuple, int] = {}
+    timeline = []
+    for phase_sequence in phases:
+        steps = []
+        for index, action in enumerate(phase_sequence or []):
+            current_char_name = action.get(KEY_CHARACTER)
+            if not current_char_name:
+                if action.get(KEY_SKILL) in ABNORMAL_EFFECTS:
+                    current_char_name = team_builds[0][KEY_CHARACTER_NAME] if team_builds else ""
+                else: continue
+            if current_char_name not in build_by_name: continue
+
+            skill_data = action.get(KEY_SKILL_DATA) or {}
+            skill_name = action.get(KEY_SKILL, "")
+            activation_types = skill_data.get(KEY_ACTIVATION_TYPES, [])
+            is_healing = skill_data.get("is_healing", False)
+
+            active_buffs = {}
+            energy_buffs = []
+            for buff_key, buff_data in all_buffs.items():
+                if buff_data.get("is_transient"): continue
+                if _is_buff_triggered(buff_data, current_char_name, team_char_names, activation_types, skill_name, is_healing):
+                    effects = buff_data.get(KEY_EFFECTS, [])
+                    if effects and effects[0].get("type") == "スタック形式":
+                        stack_count = effects[0].get("max_stacks", 1)
+                        if stack_count > 0: active_buffs[buff_key] = stack_count
+                    else:
+                        active_buffs[buff_key] = True
+                # エネルギー獲得バフは timing 未指定なら「常時」以外トリガーしない (_process_phase と同じ)
+                if _is_buff_triggered(buff_data, current_char_name, team_char_names, activation_types, skill_name, is_healing, default_timing=None):
+                    target_type = buff_data.get(KEY_TARGET, "自身")
+                    if target_type == "自身": targets = [buff_data.get("owner")]
+                    elif target_type == "チーム全員": targets = list(team_char_names)
+                    elif target_type == "チーム内キャラクター1人":
+                        targets = [action.get("target_selections", {}).get(buff_key) or _get_default_target(current_char_name, team_builds)]
+                    else: targets = []
+                    for effect in buff_data.get(KEY_EFFECTS, []):
+                        if effect.get("type") in ("共鳴エネルギー獲得(固定)", "共鳴エネルギー獲得(変動)"):
+                            energy_buffs.append((effect["type"], effect.get(KEY_VALUE, 0), targets))
+
+            state_key = tuple(sorted(active_buffs.items()))
+            state_id = buff_state_ids.setdefault(state_key, len(buff_state_ids))
+            steps.append({
+                "index": index, KEY_CHARACTER: current_char_name, KEY_SKILL: skill_name,
+                KEY_ACTIVATION_TYPES: activation_types, KEY_ACTIVE_BUFFS: active_buffs, "buff_state_id": state_id,
+                "has_skill_data": bool(action.get(KEY_SKILL_DATA)),
+                "gain_flat": skill_data.get(KEY_RESONANCE_ENERGY_GAIN_FLAT, 0) or 0,
+                "gain_scaling": skill_data.get(KEY_RESONANCE_ENERGY_GAIN_SCALING, 0) or 0,
+                "concerto_gain": 0 if "終奏スキル" in activation_types else skill_data.get(KEY_CONCERTO_ENERGY, 0),
+                "manual_resonance_gain": action.get("manual_resonance_gain"),
+                "manual_concerto_gain": action.get("manual_concerto_gain"),
+                "energy_buffs": energy_buffs,
+            })
+        timeline.append(steps)
+    return timeline
+
+def simulate_rotation_energy(timeline: List[List[Dict]], team_builds: List[Build], team_stats: Dict, all_buffs: Dict,
+                             initial_concerto_energy: Optional[Dict[str, float]] = None,
+                             initial_resonance_energy: Optional[Dict[str, float]] = None,
+                             check_concerto: bool = False,
+                             phase_names: Optional[List[str]] = None,
+                             stop_at_first: Optional[str] = None) -> EnergyFeasibilityResult:
+    """
+    ダメージ計算を行わず、_process_phase と同じ規則でエネルギーだけを追跡する。
+    共鳴解放の発動時点で共鳴エネルギーが必要量に足りない (check_concerto なら終奏スキル時に協奏エネルギーが100未満)
+    アクションを、キャラクターごとに最初の1件だけ記録する。
+    stop_at_first にキャラ名を渡すと、そのキャラが不成立になった時点で打ち切る (最適化の枝刈り用)。
+    """
+    build_by_name = {b[KEY_CHARACTER_NAME]: b for b in team_builds if b.get(KEY_CHARACTER_NAME)}
+    max_energy = {name: b.get(KEY_CHARACTER_DATA, {}).get(KEY_RESONANCE_ENERGY_REQUIRED, 1) for name, b in build_by_name.items()}
+    char_concerto_energy = defaultdict(float, initial_concerto_energy or {})
+    char_resonance_energy = defaultdict(float, initial_resonance_energy or {})
+    phase_names = phase_names or ["initial", "loop"] + [f"loop_{i}" for i in range(2, len(timeline))]
+    efficiency_cache: Dict[Tuple[str, int], float] = {}
+    first_infeasible = {}
+
+    def efficiency(char: str, step: Dict) -> float:
+        cache_key = (char, step["buff_state_id"])
+        if cache_key not in efficiency_cache:
+            _, base_raw, _ = team_stats[char]
+            efficiency_cache[cache_key] = _get_character_efficiency(char, base_raw, step[KEY_ACTIVE_BUFFS], all_buffs, build_by_name.get(char))
+        return efficiency_cache[cache_key]
+
+    for phase_index, steps in enumerate(timeline):
+        for step in steps:
+            char = step[KEY_CHARACTER]
+            activation_types = step[KEY_ACTIVATION_TYPES]
+
+            if char not in first_infeasible:
+                if "共鳴解放" in activation_types and char_resonance_energy[char] + 1e-6 < max_energy.get(char, 1):
+                    first_infeasible[char] = {"phase": phase_names[phase_index], "index": step["index"], KEY_SKILL: step[KEY_SKILL], "kind": "共鳴解放", "energy": char_resonance_energy[char], "required": max_energy.get(char, 1)}
+                elif check_concerto and "終奏スキル" in activation_types and char_concerto_energy[char] + 1e-6 < 100.0:
+                    first_infeasible[char] = {"phase": phase_names[phase_index], "index": step["index"], KEY_SKILL: step[KEY_SKILL], "kind": "終奏スキル", "energy": char_concerto_energy[char], "required": 100.0}
+                if stop_at_first is not None and stop_at_first in first_infeasible:
+                    return {"feasible": False, "first_infeasible": first_infeasible, "final_concerto_energy": dict(char_concerto_energy), "final_resonance_energy": dict(char_resonance_energy)}
+
+            resonance_gain = step["manual_resonance_gain"] or 0
+            if step["has_skill_data"]:
+                resonance_gain += step["gain_scaling"] * (efficiency(char, step) / 100.0) + step["gain_flat"]
+            teammate_gain = defaultdict(float)
+            for effect_type, value, targets in step["energy_buffs"]:
+                for target in targets:
+                    gain = value if effect_type == "共鳴エネルギー獲得(固定)" else value * (efficiency(target, step) / 100.0) if target in team_stats else 0
+                    if target == char: resonance_gain += gain
+                    else: teammate_gain[target] += gain
+            if step["manual_resonance_gain"] is not None: resonance_gain = step["manual_resonance_gain"]
+            concerto_gain = step["manual_concerto_gain"] if step["manual_concerto_gain"] is not None else step["concerto_gain"]
+
+            if "終奏スキル" in activation_types: char_concerto_energy[char] = 0
+            char_concerto_energy[char] = min(char_concerto_energy[char] + concerto_gain, 100.0)
+            char_resonance_energy[char] += resonance_gain
+            for target, gain in teammate_gain.items(): char_resonance_energy[target] += gain
+            if "共鳴解放" in activation_types: char_resonance_energy[char] = 0
+            for name in list(char_resonance_energy):
+                if name in max_energy: char_resonance_energy[name] = min(char_resonance_energy[name], max_energy[name])
+
+    return {"feasible": not first_infeasible, "first_infeasible": first_infeasible, "final_concerto_energy": dict(char_concerto_energy), "final_resonance_energy": dict(char_resonance_energy)}
+
+def check_rotation_energy(team_builds: List[Build], initial_sequence: List[Action], loop_sequence: List[Action], all_buffs: Dict,
+                          num_loops: int = 1, check_concerto: bool = False,
+                          initial_concerto_energy: Optional[Dict[str, float]] = None,
+                          initial_resonance_energy: Optional[Dict[str, float]] = None) -> EnergyFeasibilityResult:
+    """ローテーションがエネルギー的に成立するかを検証し、キャラごとの最初の不成立アクションを返す"""
+    timeline = build_energy_timeline(team_builds, [initial_sequence] + [loop_sequence] * num_loops, all_buffs)
+    team_stats = {b[KEY_CHARACTER_NAME]: calculate_base_stats(b) for b in team_builds if b.get(KEY_CHARACTER_NAME)}
+    return simulate_rotation_energy(timeline, team_builds, team_stats, all_buffs, initial_concerto_energy, initial_resonance_energy, check_concerto)
+
+def filter_energy_feasible_builds(build_candidates, team_builds: List[Build], character_name: str, initial_sequence: List[Action], loop_sequence: List[Action], all_buffs: Dict, num_loops: int = 1, **energy_options):
+    """
+    generate_build_combinations などが生成する候補 ({"echo_list": [...]} を含む辞書) のうち、
+    character_name のローテーションがエネルギー的に成立するものだけを返すジェネレータ。
+    タイムラインは一度だけ作り、候補ごとには基礎ステータスとエネルギー追跡だけを行う。
+    """
+    if not any(b.get(KEY_CHARACTER_NAME) == character_name for b in team_builds): return
+    is_feasible = _make_energy_feasibility_check(team_builds, character_name, initial_sequence, loop_sequence, all_buffs, num_loops, **energy_options)
+    for candidate in build_candidates:
+        if is_feasible(candidate[KEY_ECHO_LIST]):
+            yield candidate
+
+def _make_energy_feasibility_check(team_builds: List[Build], character_name: str, initial_sequence: List[Action], loop_sequence: List[Action],
+                                   all_buffs: Dict, num_loops: int = 1, **energy_options) -> Callable[[List[Dict]], bool]:
+    """
+    音骸リスト -> character_name のローテーションがエネルギー的に成立するか を返す関数。
+    タイムラインは一度だけ作るので、最適化の候補ごとにダメージを計算する前の足切りに使える。
+    """
+    timeline = build_energy_timeline(team_builds, [initial_sequence] + [loop_sequence] * num_loops, all_buffs)
+    team_stats = {b[KEY_CHARACTER_NAME]: calculate_base_stats(b) for b in team_builds if b.get(KEY_CHARACTER_NAME)}
+    base_build = next(b for b in team_builds if b.get(KEY_CHARACTER_NAME) == character_name)
+    def is_feasible(echo_list: List[Dict]) -> bool:
+        trial_stats = {**team_stats, character_name: calculate_base_stats({**base_build, KEY_ECHO_LIST: echo_list})}
+        result = simulate_rotation_energy(timeline, team_builds, trial_stats, all_buffs, stop_at_first=character_name, **energy_options)
+        return character_name not in result["first_infeasible"]
+    return is_feasible
+
+def _segment_gain_terms(step: Dict, char: str, base_efficiency: float, efficiency_of) -> Tuple[float, float, float]:
+    """
+    1アクションで char が得る共鳴エネルギーを、基礎共鳴効率 x に対する一次式 (scaling * (x + delta) / 100 + flat) の
+    係数 (scaling, scaling * delta, flat) に分解する。delta はそのアクション時点のバフによる共鳴効率の上乗せ分。
+    """
+    scaling = scaled_delta = flat = 0.0
+    def add_scaling(coef: float, target: str):
+        nonlocal scaling, scaled_delta
+        scaling += coef
+        scaled_delta += coef * (efficiency_of(target, step) - base_efficiency)
+
+    if step[KEY_CHARACTER] == char and step["manual_resonance_gain"] is not None:
+        return 0.0, 0.0, float(step["manual_resonance_gain"])
+    if step[KEY_CHARACTER] == char and step["has_skill_data"]:
+        add_scaling(step["gain_scaling"], char)
+        flat += step["gain_flat"]
+    for effect_type, value, targets in step["energy_buffs"]:
+        for target in targets:
+            if target != char: continue
+            if effect_type == "共鳴エネルギー獲得(固定)": flat += value
+            else: add_scaling(value, char)
+    return scaling, scaled_delta, flat
+
+def solve_min_resonance_efficiency(team_builds: List[Build], initial_sequence: List[Action], loop_sequence: List[Action], all_buffs: Dict,
+                                   num_loops: int = 1, initial_resonance_energy: Optional[Dict[str, float]] = None) -> Dict[str, MinEfficiencyResult]:
+    """
+    キャラクターごとに、全ての共鳴解放を予定どおり撃てる最小の共鳴効率 (バフ抜きの resonance_efficiency) を求める。
+    共鳴エネルギーは共鳴効率に対して一次なので、共鳴解放ごとの区間で必要量を閉形式で解き、その最大値を取る。
+    ステータス変換などで一次にならない場合は、エネルギー追跡で検証して二分探索に切り替える。
+    """
+    initial_resonance_energy = initial_resonance_energy or {}
+    timeline = build_energy_timeline(team_builds, [initial_sequence] + [loop_sequence] * num_loops, all_buffs)
+    phase_names = ["initial", "loop"] + [f"loop_{i}" for i in range(2, len(timeline))]
+    team_stats = {b[KEY_CHARACTER_NAME]: calculate_base_stats(b) for b in team_builds if b.get(KEY_CHARACTER_NAME)}
+    build_by_name = {b[KEY_CHARACTER_NAME]: b for b in team_builds if b.get(KEY_CHARACTER_NAME)}
+    efficiency_cache: Dict[Tuple[str, int], float] = {}
+
+    def efficiency_of(target: str, step: Dict) -> float:
+        cache_key = (target, step["buff_state_id"])
+        if cache_key not in efficiency_cache:
+            _, base_raw, _ = team_stats[target]
+            efficiency_cache[cache_key] = _get_character_efficiency(target, base_raw, step[KEY_ACTIVE_BUFFS], all_buffs, build_by_name.get(target))
+        return efficiency_cache[cache_key]
+
+    results = {}
+    for char, build in build_by_name.items():
+        base_efficiency = team_stats[char][1].get("resonance_efficiency", 100.0)
+        max_energy = build.get(KEY_CHARACTER_DATA, {}).get(KEY_RESONANCE_ENERGY_REQUIRED, 1)
+        energy_start = initial_resonance_energy.get(char, 0.0)
+        seg_scaling = seg_scaled_delta = seg_flat = 0.0
+        required, binding = 0.0, None
+        for phase_index, steps in enumerate(timeline):
+            for step in steps:
+                if step[KEY_CHARACTER] == char and "共鳴解放" in step[KEY_ACTIVATION_TYPES]:
+                    deficit = max_energy - energy_start - seg_flat
+                    if deficit > 1e-9:
+                        need = (100.0 * deficit - seg_scaled_delta) / seg_scaling if seg_scaling > 0 else float("inf")
+                        if need > required:
+                            required = need
+                            binding = {"phase": phase_names[phase_index], "index": step["index"], KEY_SKILL: step[KEY_SKILL], "kind": "共鳴解放", "energy": energy_start + seg_flat + seg_scaling * (base_efficiency / 100.0) + seg_scaled_delta / 100.0, "required": max_energy}
+                    # 共鳴解放でエネルギーは0に戻るので、次の区間を新たに積算する
+                    energy_start = 0.0
+                    seg_scaling = seg_scaled_delta = seg_flat = 0.0
+                    continue
+                scaling, scaled_delta, flat = _segment_gain_terms(step, char, base_efficiency, efficiency_of)
+                seg_scaling += scaling; seg_scaled_delta += scaled_delta; seg_flat += flat
+
+        method = "closed_form"
+        if binding is not None and required != float("inf"):
+            # 閉形式の解で実際に成立するかを検証し、非線形なバフがあれば二分探索で補正する
+            def is_feasible(efficiency_value: float) -> bool:
+                trial_raw = dict(team_stats[char][1]); trial_raw["resonance_efficiency"] = efficiency_value
+                trial_stats = {**team_stats, char: (team_stats[char][0], trial_raw, team_stats[char][2])}
+                result = simulate_rotation_energy(timeline, team_builds, trial_stats, all_buffs, initial_resonance_energy=initial_resonance_energy, phase_names=phase_names, stop_at_first=char)
+                return char not in result["first_infeasible"]
+            if not is_feasible(required + 1e-6):
+                method = "bisection"
+                low, high = required, max(required * 2, required + 100.0)
+                while not is_feasible(high) and high < 10000.0: high *= 2
+                for _ in range(40):
+                    mid = (low + high) / 2
+                    if is_feasible(mid): high = mid
+                    else: low = mid
+                required = high
+        results[char] = {
+            "character": char, "required_efficiency": required, "current_efficiency": base_efficiency,
+            "surplus": base_efficiency - required, "feasible": base_efficiency + 1e-6 >= required,
+            "binding_action": binding, "method": method,
+        }
+    return results
+
+def filter_builds_by_min_efficiency(build_candidates, base_build: Build, required_efficiency: float):
+    """
+    solve_min_resonance_efficiency で求めた必要共鳴効率を満たさない音骸ビルド候補を、
+    ダメージ評価の前に共鳴効率の合計だけで除外するジェネレータ。
+    """
+    meets_efficiency = _make_min_efficiency_check(base_build, required_efficiency)
+    for candidate in build_candidates:
+        if meets_efficiency(_echo_list_stat_row(candidate[KEY_ECHO_LIST])):
+            yield candidate
+
+def _make_min_efficiency_check(base_build: Build, min_efficiency: float) -> Callable[[np.ndarray], bool]:
+    """
+    音骸ステータスの合計 (ECHO_STAT_KEYS の並び) -> 共鳴効率が min_efficiency 以上か を返す関数。
+    音骸以外 (キャラ・武器など) の共鳴効率は一度だけ求めるので、探索の候補ごとには足し算1回で判定できる。
+    """
+    other_efficiency = calculate_base_stats({**base_build, KEY_ECHO_LIST: []})[1].get("resonance_efficiency", 100.0)
+    efficiency_index = ECHO_STAT_KEYS.index("resonance_efficiency")
+    return lambda row: other_efficiency + row[efficiency_index] + 1e-6 >= min_efficiency
+
+def _echo_list_stat_row(echo_list: List[Dict]) -> np.ndarray:
+    """音骸リストが与えるステータスの合計 (ECHO_STAT_KEYS の並び)"""
+    return sum((_echo_stat_delta_row(e) for e in echo_list), np.zeros(len(ECHO_STAT_KEYS)))
+
+def _make_search_action(char_name: str, skill: Dict) -> Action:
+    return {KEY_CHARACTER: char_name, KEY_SKILL: skill.get(KEY_NAME, ""), "source": "character", KEY_SKILL_DATA: skill,
+            KEY_ACTIVE_BUFFS: {}, "target_selections": {}, "triggered_single_target_buffs": [],
+            "transient_buff_manual_settings": {"disabled": set(), "stacks": {}}}
+
+def search_rotation(team_builds: List[Build], all_buffs: Dict, enemy_info: Optional[Dict] = None,
+                    max_actions: int = 30, beam_width: int = 64, time_budget: float = 5.0,
+                    skill_pools: Optional[Dict[str, List[str]]] = None,
+                    max_skill_uses: Optional[Dict[str, Dict[str, int]]] = None,
+                    initial_concerto_energy: Optional[Dict[str, float]] = None,
+                    initial_resonance_energy: Optional[Dict[str, float]] = None) -> RotationSearchResult:
+    """
+    各キャラクターの CharacterData.skills (skill_pools で絞り込み可) から、総ダメージが最大になるアクション列をビームサーチで探す。
+    1手ごとの状態遷移は _process_phase に1アクションだけ渡して計算し、(キャラ, スキル, エネルギー状態) 単位でメモ化する。
+    制約:
+      - 共鳴解放は共鳴エネルギーが必要量に達しているときのみ
+      - 終奏スキルは協奏エネルギーが100のときのみ。終奏の直後は別キャラの変奏スキルのみ
+      - 変奏スキルは別キャラの終奏スキルの直後、またはローテーションの先頭のみ
+      - max_skill_uses (キャラ名 -> スキル名 -> 回数) で指定したスキルはその回数まで
+    time_budget 秒を超えた場合は、その時点の最良の列を返す。
+    """
+    deadline = time.monotonic() + time_budget
+    enemy_info = enemy_info or {KEY_LEVEL: 90}
+    team_stats = {b[KEY_CHARACTER_NAME]: calculate_base_stats(b) for b in team_builds if b.get(KEY_CHARACTER_NAME)}
+    max_resonance = {b[KEY_CHARACTER_NAME]: b.get(KEY_CHARACTER_DATA, {}).get(KEY_RESONANCE_ENERGY_REQUIRED) or 1 for b in team_builds if b.get(KEY_CHARACTER_NAME)}
+
+    candidates = [] # (キャラ名, スキル名, 発動種別, Action)
+    for build in team_builds:
+        char_name = build.get(KEY_CHARACTER_NAME)
+        if not char_name: continue
+        allowed = set(skill_pools[char_name]) if skill_pools and char_name in skill_pools else None
+        for skill in build.get(KEY_CHARACTER_DATA, {}).get(KEY_SKILLS, []):
+            if allowed is not None and skill.get(KEY_NAME) not in allowed: continue
+            candidates.append((char_name, skill.get(KEY_NAME, ""), set(skill.get(KEY_ACTIVATION_TYPES, [])), _make_search_action(char_name, copy.deepcopy(skill))))
+
+    # 使用回数の上限があるスキルは、候補番号 -> 上限 として状態に回数を持たせる
+    use_limits = {i: max_skill_uses[c[0]][c[1]] for i, c in enumerate(candidates) if max_skill_uses and c[1] in max_skill_uses.get(c[0], {})}
+    limited_indices = sorted(use_limits)
+
+    transition_cache: Dict[Tuple, Tuple[float, Dict[str, float], Dict[str, float]]] = {}
+    evaluated = 0
+
+    def energy_key(energies: Dict[str, float]) -> Tuple:
+        return tuple(sorted((k, round(v, 2)) for k, v in energies.items() if v))
+
+    def transition(candidate_index: int, concerto: Dict[str, float], resonance: Dict[str, float]):
+        nonlocal evaluated
+        cache_key = (candidate_index, energy_key(concerto), energy_key(resonance))
+        if cache_key not in transition_cache:
+            action = candidates[candidate_index][3]
+            result = _process_phase([action], team_builds, team_stats, all_buffs, enemy_info, defaultdict(float, concerto), defaultdict(float, resonance), time_marks=[], annotate_actions=False)
+            transition_cache[cache_key] = (result["total_damage"], dict(result["final_concerto_energy"]), dict(result["final_resonance_energy"]))
+            evaluated += 1
+        return transition_cache[cache_key]
+
+    # 状態: (総ダメージ, アクション番号の列, 協奏E, 共鳴E, 直前のキャラ, 直前が終奏か, 上限付きスキルの使用回数)
+    start = (0.0, (), dict(initial_concerto_energy or {}), dict(initial_resonance_energy or {}), None, False, (0,) * len(limited_indices))
+    beam = [start]
+    best = start
+    timed_out = False
+    for _ in range(max_actions):
+        expanded: Dict[Tuple, Tuple] = {}
+        for total, sequence, concerto, resonance, last_char, after_outro, uses in beam:
+            for i, (char_name, _skill_name, activation_types, _action) in enumerate(candidates):
+                if i in use_limits and uses[limited_indices.index(i)] >= use_limits[i]: continue
+                is_intro, is_outro = "変奏スキル" in activation_types, "終奏スキル" in activation_types
+                if after_outro and not (is_intro and char_name != last_char): continue
+                if is_intro and sequence and not (after_outro and char_name != last_char): continue
+                if "共鳴解放" in activation_types and resonance.get(char_name, 0.0) + 1e-6 < max_resonance.get(char_name, 1): continue
+                if is_outro and concerto.get(char_name, 0.0) + 1e-6 < 100.0: continue
+                damage, next_concerto, next_resonance = transition(i, concerto, resonance)
+                next_uses = uses
+                if i in use_limits:
+                    pos = limited_indices.index(i)
+                    next_uses = uses[:pos] + (uses[pos] + 1,) + uses[pos + 1:]
+                state = (total + damage, sequence + (i,), next_concerto, next_resonance, char_name, is_outro, next_uses)
+                # 同じ (キャラ, 終奏直後か, エネルギー, 使用回数) に到達した部分列は、ダメージが高い方だけ残す
+                memo_key = (char_name, is_outro, energy_key(next_concerto), energy_key(next_resonance), next_uses)
+                if memo_key not in expanded or expanded[memo_key][0] < state[0]:
+                    expanded[memo_key] = state
+            if time.monotonic() > deadline:
+                timed_out = True; break
+        if not expanded: break
+        beam = sorted(expanded.values(), key=lambda s: s[0], reverse=True)[:beam_width]
+        if beam[0][0] > best[0]: best = beam[0]
+        if timed_out: break
+
+    best_sequence = [copy.deepcopy(candidates[i][3]) for i in best[1]]
+    return {
+        "rotation": best_sequence, "total_damage": best[0], "num_actions": len(best_sequence),
+        "states_evaluated": evaluated, "timed_out": timed_out,
+        "final_concerto_energy": best[2], "final_resonance_energy": best[3],
+    }
+
+def _build_combination_space(
     selected_costs: List[str],
     eff_subs_per_echo: int,
     sub_level_index: int,
-    selected_eff_subs: Dict[str, str], # name -> priority ("通常", "優先", "必須")
+    selected_eff_subs: Dict[str, str],
     selected_eff_mains: Dict[str, List[str]],
     full_search_mode: bool
-):
+) -> Optional[Dict]:
     """
-    【v3】各音骸が完全に独立したサブステを持つ組み合わせを生成する。
-    メインステとサブステの重複は許容する。
+    generate_build_combinations の探索空間を、辞書を作らずにインデックスだけで表す。
+      sub_pool: サブステ候補 (必須 → 優先 → 通常 の順)
+      sub_set: 音骸1つ分のサブステセットの表し方。どの音骸でも共通で、
+               prefix (必ず含む sub_pool のインデックス) + sub_pool[offset:offset+n] から k 個を選ぶ組み合わせ。
+               count 個の組み合わせは組み合わせ数系 (itertools.combinations と同じ辞書順) で番号付けする
+      cost_combos: [{"cost_combo", "costs", "main_options": 音骸ごとの ECHO_DATA["main_stats"][cost] のインデックス}]
+    サブステ候補がなければ None を返す。
     """
-    
     # 1. サブステプールを優先度別に分類
     sub_pools = {"必須": [], "優先": [], "通常": []}
     for sub_name, priority in selected_eff_subs.items():
@@ -618,120 +1703,1173 @@ def generate_build_combinations(
 
     all_subs_pool = sub_pools["必須"] + sub_pools["優先"] + sub_pools["通常"]
     if not all_subs_pool:
-        return
+        return None
 
-    # 2. コスト組み合わせごとにループ
+    # 2. 音骸1つ分のサブステセット (メインとサブの重複は許容する)
+    num_must = len(sub_pools["必須"])
+    if full_search_mode:
+        # 全探索モード: プール全体から組み合わせを生成
+        sub_set = {"prefix": (), "offset": 0, "n": len(all_subs_pool), "k": eff_subs_per_echo}
+    elif num_must > eff_subs_per_echo:
+        sub_set = {"prefix": (), "offset": 0, "n": 0, "k": 1}
+    else:
+        # 優先度モード: 必須を全て含み、残りを優先 + 通常から埋める
+        sub_set = {"prefix": tuple(range(num_must)), "offset": num_must, "n": len(all_subs_pool) - num_must, "k": eff_subs_per_echo - num_must}
+    sub_set["count"] = math.comb(sub_set["n"], sub_set["k"]) if sub_set["k"] >= 0 else 0
+
+    # 3. コスト組み合わせごとに、各音骸のメインステータス候補を作る
+    cost_combos = []
     for cost_combo_str in selected_costs:
         costs = [int(c) for c in cost_combo_str.split('-')]
-        
-        # 3. 各音骸のメインステータスの候補リストを作成
-        main_stat_options_per_echo = []
+        main_options = []
         for cost in costs:
             cost_str = str(cost)
             valid_mains = selected_eff_mains.get(cost_str, [])
-            options = [s for s in ECHO_DATA["main_stats"].get(cost_str, []) if s["name"] in valid_mains]
+            options = [i for i, s in enumerate(ECHO_DATA["main_stats"].get(cost_str, [])) if s["name"] in valid_mains]
             if not options: break
-            main_stat_options_per_echo.append(options)
-        
-        if len(main_stat_options_per_echo) != 5: continue
+            main_options.append(options)
+        if len(main_options) != 5: continue
+        radices = [len(options) for options in main_options] + [sub_set["count"]] * 5
+        cost_combos.append({"cost_combo": cost_combo_str, "costs": costs, "main_options": main_options, "radices": radices, "size": math.prod(radices)})
 
-        # 4. メインステータスの全組み合わせを生成
-        main_stat_builds = product(*main_stat_options_per_echo)
+    return {"sub_pool": all_subs_pool, "sub_set": sub_set, "cost_combos": cost_combos}
 
-        for main_stat_set in main_stat_builds:
-            # --- 5. サブステータスの組み合わせ生成 (各音骸で独立) ---
-            sub_stat_options_for_all_echos = []
+def _unrank_combination(n: int, k: int, index: int) -> Tuple[int, ...]:
+    """range(n) から k 個選ぶ組み合わせのうち、辞書順で index 番目のもの"""
+    result, x = [], 0
+    for remaining in range(k, 0, -1):
+        # x を先頭に選ぶ組み合わせは comb(n - x - 1, remaining - 1) 個
+        while True:
+            block = math.comb(n - x - 1, remaining - 1)
+            if index < block: break
+            index -= block; x += 1
+        result.append(x); x += 1
+    return tuple(result)
 
-            for i in range(5): # 5つの音骸それぞれに対してループ
-                # --- ▼▼▼ ここからが新しいロジック ▼▼▼ ---
-                # **メインとサブの重複を許容するため、重複チェックは行わない**
-                
-                sub_sets_for_this_echo = []
-                
-                if full_search_mode:
-                    # 全探索モード: プール全体から組み合わせを生成
-                    if len(all_subs_pool) >= eff_subs_per_echo:
-                        sub_sets_for_this_echo = list(combinations(all_subs_pool, eff_subs_per_echo))
-                else:
-                    # 優先度モード
-                    must_haves = sub_pools["必須"]
-                    if len(must_haves) > eff_subs_per_echo: continue
-
-                    num_needed = eff_subs_per_echo - len(must_haves)
-                    if num_needed == 0:
-                        sub_sets_for_this_echo = [tuple(must_haves)]
-                    elif num_needed > 0:
-                        priority_pool = [s for s in sub_pools["優先"] if s not in must_haves]
-                        normal_pool = [s for s in sub_pools["通常"] if s not in must_haves]
-                        
-                        fill_pool = priority_pool + normal_pool
-                        if len(fill_pool) >= num_needed:
-                            fill_combos = combinations(fill_pool, num_needed)
-                            for combo in fill_combos:
-                                sub_sets_for_this_echo.append(tuple(must_haves) + combo)
-                
-                if not sub_sets_for_this_echo:
-                    # この音骸で有効なサブステセットが作れなければ、このメインステセットは無効
-                    break
-                
-                sub_stat_options_for_all_echos.append(sub_sets_for_this_echo)
-            
-            # 5つの音骸すべてでサブステ候補が作れたかチェック
-            if len(sub_stat_options_for_all_echos) != 5:
-                continue
-            
-            # --- ▲▲▲ 新しいロジックここまで ▲▲▲ ---
+def _rank_combination(n: int, k: int, combo: Tuple[int, ...]) -> int:
+    """_unrank_combination の逆"""
+    index, x = 0, 0
+    for position, value in enumerate(combo):
+        remaining = k - position
+        for skipped in range(x, value):
+            index += math.comb(n - skipped - 1, remaining - 1)
+        x = value + 1
+    return index
 
-            # 6. 5つの音骸、それぞれのサブステ候補リストから組み合わせを生成
-            all_sub_stat_builds = product(*sub_stat_options_for_all_echos)
-            
-            for sub_stat_tuple_of_tuples in all_sub_stat_builds:
-                echo_list = []
-                for i in range(5):
-                    echo_list.append({
-                        "name": f"OptimizedEcho{i+1}", "cost": costs[i],
-                        "main_stat": main_stat_set[i],
-                        "sub_stats": list(sub_stat_tuple_of_tuples[i])
-                    })
-                
-                yield {"cost_combo": cost_combo_str, "echo_list": echo_list}
+def _sub_set_at(space: Dict, sub_index: int) -> Tuple[int, ...]:
+    """サブステセット番号 -> sub_pool のインデックスのタプル"""
+    spec = space["sub_set"]
+    return spec["prefix"] + tuple(spec["offset"] + j for j in _unrank_combination(spec["n"], spec["k"], sub_index))
+
+def count_build_combinations(space: Optional[Dict]) -> int:
+    """探索空間の候補数"""
+    if not space or not space["sub_set"]["count"]: return 0
+    return sum(combo["size"] for combo in space["cost_combos"])
+
+def _locate_build_combination(space: Dict, index: int) -> Tuple[int, List[int]]:
+    """通し番号 -> (コスト組み合わせ番号, 混合基数の桁 [メインステ候補の位置 x5, サブステセット番号 x5])"""
+    if not 0 <= index < count_build_combinations(space): raise IndexError(f"候補の番号が範囲外です: {index}")
+    for combo_index, combo in enumerate(space["cost_combos"]):
+        if index >= combo["size"]:
+            index -= combo["size"]; continue
+        radices = combo["radices"]
+        digits = [0] * len(radices)
+        for i in range(len(radices) - 1, -1, -1):
+            index, digits[i] = divmod(index, radices[i])
+        return combo_index, digits
+
+def unrank_build_combination(space: Dict, index: int) -> Tuple:
+    """通し番号 index (0 <= index < count) の候補のコンパクトなキーを返す"""
+    combo_index, digits = _locate_build_combination(space, index)
+    main_options = space["cost_combos"][combo_index]["main_options"]
+    return (combo_index, tuple(main_options[i][digits[i]] for i in range(5)), tuple(digits[5:]))
+
+def rank_build_combination(space: Dict, compact_key: Tuple) -> int:
+    """unrank_build_combination の逆。キーの通し番号を返す"""
+    combo_index, main_indices, sub_indices = compact_key
+    index = sum(combo["size"] for combo in space["cost_combos"][:combo_index])
+    combo = space["cost_combos"][combo_index]
+    digits = [combo["main_options"][i].index(main_indices[i]) for i in range(5)] + list(sub_indices)
+    offset = 0
+    for digit, radix in zip(digits, combo["radices"]):
+        offset = offset * radix + digit
+    return index + offset
+
+def iter_compact_build_combinations(space: Optional[Dict], start: int = 0, stop: Optional[int] = None):
+    """
+    探索空間の各候補を (コスト組み合わせ番号, メインステのインデックス x5, サブステセット番号 x5) の
+    整数タプルとして、generate_build_combinations と同じ順序で生成する。
+    start / stop を渡すと、その通し番号の範囲 [start, stop) だけを列挙する。
+    """
+    total = count_build_combinations(space)
+    stop = total if stop is None else min(stop, total)
+    if start >= stop: return
+    remaining = stop - start
+    combo_index, digits = _locate_build_combination(space, start)
+    combo = space["cost_combos"][combo_index]
+    while remaining > 0:
+        radices, main_options = combo["radices"], combo["main_options"]
+        while remaining > 0:
+            yield (combo_index, tuple(main_options[i][digits[i]] for i in range(5)), tuple(digits[5:]))
+            remaining -= 1
+            # 末尾の桁から繰り上げる
+            i = len(digits) - 1
+            while i >= 0:
+                digits[i] += 1
+                if digits[i] < radices[i]: break
+                digits[i] = 0; i -= 1
+            if i < 0: break
+        combo_index += 1
+        if combo_index >= len(space["cost_combos"]): break
+        combo = space["cost_combos"][combo_index]
+        digits = [0] * len(combo["radices"])
+
+def split_build_combination_range(space: Optional[Dict], num_parts: int) -> List[Tuple[int, int]]:
+    """探索空間を、ほぼ同じ件数の [start, stop) 区間 num_parts 個に分ける (ワーカーへの割り振り用)"""
+    total = count_build_combinations(space)
+    num_parts = max(1, num_parts)
+    bounds = [total * i // num_parts for i in range(num_parts + 1)]
+    return [(bounds[i], bounds[i + 1]) for i in range(num_parts) if bounds[i] < bounds[i + 1]]
+
+def sample_build_combinations(space: Optional[Dict], k: int, rng: Optional[random.Random] = None) -> List[Tuple]:
+    """探索空間から重複なく一様に k 件の候補キーを選ぶ (プレビュー用)"""
+    total = count_build_combinations(space)
+    rng = rng or random.Random()
+    return [unrank_build_combination(space, i) for i in rng.sample(range(total), min(k, total))]
+
+def materialize_build_combination(space: Dict, compact_key: Tuple) -> Dict:
+    """コンパクトな候補キーを、generate_build_combinations が返す {"cost_combo", "echo_list"} に戻す"""
+    combo_index, main_indices, sub_indices = compact_key
+    combo = space["cost_combos"][combo_index]
+    sub_pool = space["sub_pool"]
+    echo_list = []
+    for i in range(5):
+        echo_list.append({
+            "name": f"OptimizedEcho{i+1}", "cost": combo["costs"][i],
+            "main_stat": ECHO_DATA["main_stats"][str(combo["costs"][i])][main_indices[i]],
+            "sub_stats": [sub_pool[j] for j in _sub_set_at(space, sub_indices[i])]
+        })
+    return {"cost_combo": combo["cost_combo"], "echo_list": echo_list}
+
+def generate_build_combinations(
+    selected_costs: List[str],
+    eff_subs_per_echo: int,
+    sub_level_index: int,
+    selected_eff_subs: Dict[str, str], # name -> priority ("通常", "優先", "必須")
+    selected_eff_mains: Dict[str, List[str]],
+    full_search_mode: bool,
+    start: int = 0,
+    stop: Optional[int] = None
+):
+    """
+    【v3】各音骸が完全に独立したサブステを持つ組み合わせを生成する。
+    メインステとサブステの重複は許容する。
+    start / stop で通し番号の範囲 [start, stop) だけを生成できる (split_build_combination_range と組み合わせて分割実行)。
+    """
+    space = _build_combination_space(selected_costs, eff_subs_per_echo, sub_level_index, selected_eff_subs, selected_eff_mains, full_search_mode)
+    for compact_key in iter_compact_build_combinations(space, start, stop):
+        yield materialize_build_combination(space, compact_key)
+
+def _rotation_damage_moments(team_builds: List[Build], team_stats: Dict, initial_sequence: List[Action], loop_sequence: List[Action], all_buffs: Dict, enemy_info: Dict, num_loops: int = 1,
+                             time_marks_initial: Optional[List[bool]] = None, time_marks_loop: Optional[List[bool]] = None) -> Dict[str, float]:
+    """
+    ローテーション総ダメージの期待値と、会心の有無による標準偏差 (各ヒットの会心は独立) を解析的に求める。
+    会心なしのダメージを N とすると、1ヒットの分散は N^2 * p(1-p) * (会心ダメージ/100)^2。
+    """
+    initial_records, loop_records = [], []
+    initial_result = _process_phase(initial_sequence, team_builds, team_stats, all_buffs, enemy_info, defaultdict(float), defaultdict(float), time_marks=time_marks_initial or [], damage_records=initial_records, annotate_actions=False)
+    loop_result = _process_phase(loop_sequence, team_builds, team_stats, all_buffs, enemy_info, initial_result["final_concerto_energy"], initial_result["final_resonance_energy"], time_marks=time_marks_loop or [], damage_records=loop_records, annotate_actions=False) if loop_sequence and num_loops > 0 else None
+
+    def _phase_moments(records: List[Dict]) -> Tuple[float, float]:
+        mean, variance = 0.0, 0.0
+        for r in records:
+            defense_bonus, resistance_bonus, dmg_taken_bonus = _calculate_shared_bonuses(r["buffed_raw_stats"], enemy_info, r[KEY_DAMAGE_TYPES])
+            expected = max(r["pre_enemy_damage"] * defense_bonus * resistance_bonus * dmg_taken_bonus, 0.0)
+            p = min(max(r.get("crit_rate", 0.0) / 100, 0.0), 1.0)
+            crit_multiplier = r.get("crit_damage", 0.0) / 100
+            non_crit = expected / (1 + p * crit_multiplier) if p > 0 else expected
+            mean += expected
+            variance += non_crit ** 2 * p * (1 - p) * crit_multiplier ** 2
+        return mean, variance
+
+    mean, variance = _phase_moments(initial_records)
+    total_time = initial_result["total_time"]
+    if loop_result is not None:
+        loop_mean, loop_variance = _phase_moments(loop_records)
+        mean += loop_mean * num_loops
+        variance += loop_variance * num_loops
+        total_time += loop_result["total_time"] * num_loops
+    return {"total_damage": mean, "damage_std_dev": float(np.sqrt(variance)), "total_time": total_time, "dps": mean / total_time if total_time > 0 else 0.0}
+
+BUILD_SEARCH_METRICS = ["total_damage", "dps", "crit_adjusted"]
+
+class TopBuildCollector:
+    """
+    最適化の評価結果を上位 n 件だけ最小ヒープで保持する。
+    候補はコンパクトなキー (インデックスのタプル) のまま保持し、音骸の辞書は最後に勝ち残ったものだけ作る。
+    metric: "total_damage" / "dps" / "crit_adjusted" (期待値 - risk_aversion * 標準偏差)
+    offer に identity (音骸ステータスの合計など) を渡すと、同じ identity の候補は先に入ったものだけ残す。
+    """
+    def __init__(self, n: int = 10, metric: str = "total_damage", risk_aversion: float = 1.0):
+        if metric not in BUILD_SEARCH_METRICS: raise ValueError(f"未対応の評価指標です: {metric}")
+        self.n, self.metric, self.risk_aversion = n, metric, risk_aversion
+        self._heap: List[Tuple[float, int, Tuple, Dict[str, float], Optional[Tuple]]] = []
+        self._identities: Set[Tuple] = set()
+        self._counter = 0
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def score(self, metrics: Dict[str, float]) -> float:
+        if self.metric == "crit_adjusted":
+            return metrics["total_damage"] - self.risk_aversion * metrics.get("damage_std_dev", 0.0)
+        return metrics[self.metric]
+
+    @property
+    def threshold(self) -> float:
+        """上位 n 件に入るために超える必要があるスコア (まだ埋まっていなければ -inf)"""
+        return self._heap[0][0] if len(self._heap) >= self.n else float("-inf")
+
+    def contains(self, identity: Optional[Tuple]) -> bool:
+        """同じ identity の候補が上位に残っているか (評価する前に重複を飛ばすのに使う)"""
+        return identity is not None and identity in self._identities
+
+    def offer(self, compact_key: Tuple, metrics: Dict[str, float], identity: Optional[Tuple] = None) -> bool:
+        """候補を追加する。上位 n 件に入った場合は True"""
+        # 同じ identity の候補は同じスコアになる。上位から落ちたものは閾値以下なので、残っているものとだけ比べればよい
+        if self.contains(identity): return False
+        score = self.score(metrics)
+        if score <= self.threshold: return False
+        self._counter += 1
+        # 同点なら先に見つかった候補を残す (連番が小さいほど優先)
+        entry = (score, -self._counter, compact_key, metrics, identity)
+        if len(self._heap) < self.n:
+            heapq.heappush(self._heap, entry)
+        else:
+            removed = heapq.heapreplace(self._heap, entry)
+            self._identities.discard(removed[4])
+        if identity is not None: self._identities.add(identity)
+        return True
+
+    def results(self) -> List[Tuple[float, Tuple, Dict[str, float]]]:
+        """(スコア, キー, 評価値) をスコア降順で返す"""
+        return [(score, key, metrics) for score, _, key, metrics, _ in sorted(self._heap, key=lambda e: (e[0], e[1]), reverse=True)]
+
+    def to_state(self) -> Dict:
+        """チェックポイント用の JSON 化できる状態"""
+        return {"n": self.n, "metric": self.metric, "risk_aversion": self.risk_aversion, "counter": self._counter,
+                "entries": [[score, order, [key[0], list(key[1]), list(key[2])], metrics, list(identity) if identity is not None else None]
+                            for score, order, key, metrics, identity in self._heap]}
+
+    @classmethod
+    def from_state(cls, state: Dict) -> "TopBuildCollector":
+        collector = cls(state["n"], state["metric"], state.get("risk_aversion", 1.0))
+        collector._counter = state.get("counter", 0)
+        for entry in state.get("entries", []):
+            score, order, key, metrics = entry[:4]
+            identity = tuple(entry[4]) if len(entry) > 4 and entry[4] is not None else None
+            collector._heap.append((score, order, (key[0], tuple(key[1]), tuple(key[2])), metrics, identity))
+            if identity is not None: collector._identities.add(identity)
+        heapq.heapify(collector._heap)
+        return collector
+
+def _build_search_signature(team_builds: List[Build], character_name: str, initial_sequence: List[Action], loop_sequence: List[Action], all_buffs: Dict,
+                            enemy_info: Dict, selected_costs: List[str], eff_subs_per_echo: int, sub_level_index: int,
+                            selected_eff_subs: Dict[str, str], selected_eff_mains: Dict[str, List[str]], full_search_mode: bool, num_loops: int,
+                            top_n: int, metric: str, risk_aversion: float, energy_check: bool = False,
+                            min_efficiency: Optional[float] = None) -> str:
+    """
+    探索条件のハッシュ。条件が違うチェックポイントから再開しないために使う。
+    探索対象のキャラの echo_list は候補で置き換えるので含めないが、チーム・ローテーション・バフ・敵・上位 N 件の条件は含める。
+    """
+    builds = [{k: v for k, v in b.items() if not (k == KEY_ECHO_LIST and b.get(KEY_CHARACTER_NAME) == character_name)} for b in team_builds]
+    params = [character_name, builds, _action_hash_inputs(initial_sequence), _action_hash_inputs(loop_sequence), all_buffs, enemy_info,
+              selected_costs, eff_subs_per_echo, sub_level_index, selected_eff_subs, selected_eff_mains, full_search_mode, num_loops,
+              top_n, metric, risk_aversion, energy_check, min_efficiency]
+    return hashlib.sha1(json.dumps(params, ensure_ascii=False, sort_keys=True, default=_hash_json_default).encode("utf-8")).hexdigest()
+
+def save_search_checkpoint(path: str, checkpoint: Dict):
+    """チェックポイントを書き出す。途中で落ちても前回のファイルが壊れないよう、一時ファイル経由で置き換える"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(checkpoint, f, ensure_ascii=False, separators=(",", ":"))
+    os.replace(tmp_path, path)
+
+def load_search_checkpoint(path: str) -> Optional[Dict]:
+    """チェックポイントを読み込む。なければ None"""
+    if not os.path.exists(path): return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def search_top_builds(team_builds: List[Build], character_name: str, initial_sequence: List[Action], loop_sequence: List[Action], all_buffs: Dict,
+                      selected_costs: List[str], eff_subs_per_echo: int, sub_level_index: int, selected_eff_subs: Dict[str, str],
+                      selected_eff_mains: Dict[str, List[str]], full_search_mode: bool, top_n: int = 10, metric: str = "total_damage",
+                      enemy_info: Optional[Dict] = None, num_loops: int = 1, risk_aversion: float = 1.0, max_candidates: Optional[int] = None,
+                      checkpoint: Optional[Dict] = None, checkpoint_path: Optional[str] = None, checkpoint_interval: int = 1000,
+                      on_checkpoint: Optional[Callable[[Dict], None]] = None, energy_check: bool = False,
+                      min_efficiency: Optional[float] = None) -> BuildSearchResult:
+    """
+    generate_build_combinations と同じ探索空間を順に評価し、上位 top_n 件だけを返す。
+    探索中は候補をインデックスで扱い TopBuildCollector に流すため、探索空間の大きさによらずメモリは一定。
+
+    列挙順は決まっているため、通し番号 (カーソル) と上位 N 件だけで途中状態を表せる。
+    checkpoint_interval 件ごとに {cursor, 上位 N 件} を checkpoint_path に書き出し、on_checkpoint にも渡す
+    (ブラウザでは on_checkpoint から IndexedDB に保存する)。checkpoint (または checkpoint_path の既存ファイル) を
+    渡すとそのカーソルから再開する。max_candidates はこの呼び出しで評価する件数の上限。
+    energy_check なら、ローテーションがエネルギー的に成立しない候補 (共鳴解放・終奏を撃てない) をダメージ計算の前に除く。
+    min_efficiency (solve_min_resonance_efficiency の required_efficiency など) を渡すと、共鳴効率がそれに届かない候補を
+    音骸ステータスの合計だけで先に除く。どちらで除いた候補も energy_filtered に数える。
+    """
+    enemy_info = enemy_info or {KEY_LEVEL: 90}
+    build = next((b for b in team_builds if b.get(KEY_CHARACTER_NAME) == character_name), None)
+    if build is None: raise ValueError(f"チームに {character_name} がいません")
+    space = _build_combination_space(selected_costs, eff_subs_per_echo, sub_level_index, selected_eff_subs, selected_eff_mains, full_search_mode)
+    total_candidates = count_build_combinations(space)
+    signature = _build_search_signature(team_builds, character_name, initial_sequence, loop_sequence, all_buffs, enemy_info, selected_costs, eff_subs_per_echo,
+                                        sub_level_index, selected_eff_subs, selected_eff_mains, full_search_mode, num_loops, top_n, metric, risk_aversion,
+                                        energy_check, min_efficiency)
+
+    if checkpoint is None and checkpoint_path:
+        checkpoint = load_search_checkpoint(checkpoint_path)
+    if checkpoint is not None:
+        top_state = checkpoint.get("top", {})
+        stored = (top_state.get("n"), top_state.get("metric"), top_state.get("risk_aversion", 1.0))
+        if stored != (top_n, metric, risk_aversion):
+            raise ValueError(f"チェックポイントの上位件数・評価指標・リスク回避度 {stored} が、指定された {(top_n, metric, risk_aversion)} と一致しません")
+        if checkpoint.get("signature") != signature: raise ValueError("チェックポイントの探索条件 (チーム・ローテーション・バフ・敵を含む) が現在の条件と一致しません")
+        collector = TopBuildCollector.from_state(top_state)
+        cursor = checkpoint["cursor"]
+    else:
+        collector = TopBuildCollector(top_n, metric, risk_aversion)
+        cursor = 0
+
+    def _checkpoint() -> Dict:
+        state = {"signature": signature, "cursor": cursor, "total_candidates": total_candidates, "top": collector.to_state()}
+        if checkpoint_path: save_search_checkpoint(checkpoint_path, state)
+        if on_checkpoint: on_checkpoint(state)
+        return state
+
+    evaluate = _make_build_evaluator(team_builds, build, space, initial_sequence, loop_sequence, all_buffs, enemy_info, num_loops)
+    stat_row = _make_build_stat_row(space)
+    is_feasible = _make_energy_feasibility_check(team_builds, character_name, initial_sequence, loop_sequence, all_buffs, num_loops) if energy_check else None
+    meets_efficiency = _make_min_efficiency_check(build, min_efficiency) if min_efficiency is not None else None
+    evaluated = duplicates = energy_filtered = 0
+    for compact_key in iter_compact_build_combinations(space, cursor):
+        if max_candidates is not None and evaluated >= max_candidates: break
+        row = stat_row(compact_key)
+        # 音骸の並び順が違うだけでステータスの合計が同じ候補は、上位に残っているものがあれば評価しない
+        identity = _stat_row_identity(row)
+        if collector.contains(identity): duplicates += 1
+        elif meets_efficiency is not None and not meets_efficiency(row): energy_filtered += 1
+        elif is_feasible is not None and not is_feasible(materialize_build_combination(space, compact_key)[KEY_ECHO_LIST]): energy_filtered += 1
+        else: collector.offer(compact_key, evaluate(compact_key), identity)
+        evaluated += 1
+        cursor += 1
+        if checkpoint_interval and evaluated % checkpoint_interval == 0: _checkpoint()
+    if checkpoint_path or on_checkpoint: _checkpoint()
+
+    return {"metric": collector.metric, "candidates_evaluated": evaluated, "duplicates_skipped": duplicates, "energy_filtered": energy_filtered, "cursor": cursor,
+            "total_candidates": total_candidates, "completed": cursor >= total_candidates, "results": _materialize_search_results(space, collector)}
+
+def _make_build_evaluator(team_builds: List[Build], build: Build, space: Dict, initial_sequence: List[Action], loop_sequence: List[Action],
+                          all_buffs: Dict, enemy_info: Dict, num_loops: int, time_marks_initial: Optional[List[bool]] = None,
+                          time_marks_loop: Optional[List[bool]] = None) -> Callable[[Tuple], Dict[str, float]]:
+    """コンパクトな候補キー -> ローテーションの評価値 (期待値・標準偏差・DPS) を返す関数。厳密探索と近似探索で共通"""
+    character_name = build[KEY_CHARACTER_NAME]
+    team_stats = {b[KEY_CHARACTER_NAME]: calculate_base_stats(b) for b in team_builds if b.get(KEY_CHARACTER_NAME)}
+    def evaluate(compact_key: Tuple) -> Dict[str, float]:
+        echo_list = materialize_build_combination(space, compact_key)[KEY_ECHO_LIST]
+        trial_stats = {**team_stats, character_name: calculate_base_stats({**build, KEY_ECHO_LIST: echo_list})}
+        return _rotation_damage_moments(team_builds, trial_stats, initial_sequence, loop_sequence, all_buffs, enemy_info, num_loops, time_marks_initial, time_marks_loop)
+    return evaluate
+
+def _make_build_stat_row(space: Dict) -> Callable[[Tuple], np.ndarray]:
+    """コンパクトな候補キー -> 5つの音骸が与えるステータスの合計 (ECHO_STAT_KEYS の並び)。メイン・サブセットの行は使い回す"""
+    cache: Dict = {}
+    return lambda compact_key: _compact_key_stat_rows(space, [compact_key], cache)[0]
+
+def _stat_row_identity(row: np.ndarray) -> Tuple:
+    """ステータスの合計を、同じビルドかどうかの判定に使うタプルにする (足す順による誤差は丸めて吸収する)"""
+    return tuple(np.round(row, 6).tolist())
+
+def _materialize_search_results(space: Dict, collector: TopBuildCollector) -> List[Dict]:
+    """上位に残った候補だけを音骸の辞書に戻して順位を付ける"""
+    results = []
+    for rank, (score, compact_key, metrics) in enumerate(collector.results(), start=1):
+        materialized = materialize_build_combination(space, compact_key)
+        results.append({"rank": rank, "cost_combo": materialized["cost_combo"], KEY_ECHO_LIST: materialized[KEY_ECHO_LIST], "score": score, **metrics})
+    return results
 
-def generate_owned_echo_builds(owned_echos: Dict[str, List[Dict]], cost_combo_str: str):
+def _random_neighbor_key(space: Dict, compact_key: Tuple, rng: random.Random) -> Tuple:
+    """
+    焼きなまし用の近傍: 音骸1つのメインステを変える / サブステを1つ入れ替える / (たまに) コスト組み合わせを変える。
+    """
+    combo_index, main_indices, sub_indices = compact_key
+    cost_combos = space["cost_combos"]
+    if len(cost_combos) > 1 and rng.random() < 0.05:
+        # コスト組み合わせごと引き直す (その組み合わせ内で一様)
+        new_combo_index = rng.choice([i for i in range(len(cost_combos)) if i != combo_index])
+        start = sum(c["size"] for c in cost_combos[:new_combo_index])
+        return unrank_build_combination(space, start + rng.randrange(cost_combos[new_combo_index]["size"]))
+
+    combo = cost_combos[combo_index]
+    spec = space["sub_set"]
+    movable_mains = [i for i in range(5) if len(combo["main_options"][i]) > 1]
+    can_swap_sub = spec["n"] > spec["k"] > 0
+    if movable_mains and (not can_swap_sub or rng.random() < 0.3):
+        i = rng.choice(movable_mains)
+        main_indices = list(main_indices)
+        main_indices[i] = rng.choice([m for m in combo["main_options"][i] if m != main_indices[i]])
+        return (combo_index, tuple(main_indices), sub_indices)
+    if can_swap_sub:
+        i = rng.randrange(5)
+        chosen = list(_unrank_combination(spec["n"], spec["k"], sub_indices[i]))
+        chosen[rng.randrange(len(chosen))] = rng.choice([x for x in range(spec["n"]) if x not in chosen])
+        sub_indices = list(sub_indices)
+        sub_indices[i] = _rank_combination(spec["n"], spec["k"], tuple(sorted(chosen)))
+        return (combo_index, main_indices, tuple(sub_indices))
+    return compact_key
+
+def anneal_top_builds(team_builds: List[Build], character_name: str, initial_sequence: List[Action], loop_sequence: List[Action], all_buffs: Dict,
+                      selected_costs: List[str], eff_subs_per_echo: int, sub_level_index: int, selected_eff_subs: Dict[str, str],
+                      selected_eff_mains: Dict[str, List[str]], full_search_mode: bool, top_n: int = 10, metric: str = "total_damage",
+                      enemy_info: Optional[Dict] = None, num_loops: int = 1, risk_aversion: float = 1.0,
+                      max_evaluations: int = 2000, time_limit: float = 5.0, restarts: int = 4, seed: Optional[int] = None,
+                      energy_check: bool = False, min_efficiency: Optional[float] = None) -> HeuristicSearchResult:
+    """
+    全探索が現実的でない大きな探索空間向けの近似最適化 (焼きなまし法)。
+    search_top_builds と同じ探索空間・同じ評価関数・同じ指標を使い、
+    評価回数 max_evaluations か経過時間 time_limit 秒のどちらかに達したら打ち切る。
+    restarts 回に分けてランダムな初期解から始め、一度評価した候補は再評価しない。
+    energy_check なら、エネルギー的に成立しない候補は評価せず (評価回数にも数えず)、移動先にも初期解にもしない。
+    min_efficiency を渡すと、共鳴効率がそれに届かない候補も同じように扱う (音骸ステータスの合計だけで判定)。
+    """
+    enemy_info = enemy_info or {KEY_LEVEL: 90}
+    build = next((b for b in team_builds if b.get(KEY_CHARACTER_NAME) == character_name), None)
+    if build is None: raise ValueError(f"チームに {character_name} がいません")
+    space = _build_combination_space(selected_costs, eff_subs_per_echo, sub_level_index, selected_eff_subs, selected_eff_mains, full_search_mode)
+    total_candidates = count_build_combinations(space)
+    collector = TopBuildCollector(top_n, metric, risk_aversion)
+    rng = random.Random(seed)
+    start_time = time.perf_counter()
+    if total_candidates == 0:
+        return {"metric": metric, "candidates_evaluated": 0, "energy_filtered": 0, "total_candidates": 0, "elapsed_seconds": 0.0, "results": []}
+
+    evaluate = _make_build_evaluator(team_builds, build, space, initial_sequence, loop_sequence, all_buffs, enemy_info, num_loops)
+    stat_row = _make_build_stat_row(space)
+    is_feasible = _make_energy_feasibility_check(team_builds, character_name, initial_sequence, loop_sequence, all_buffs, num_loops) if energy_check else None
+    scores: Dict[int, float] = {} # 通し番号 -> スコア (評価済みの候補)
+    meets_efficiency = _make_min_efficiency_check(build, min_efficiency) if min_efficiency is not None else None
+    infeasible: Set[int] = set() # エネルギー的に成立しなかった (共鳴効率が足りなかった) 候補の通し番号
+
+    def score_of(compact_key: Tuple) -> Optional[float]:
+        """候補のスコア。打ち切りなら None、エネルギー的に成立しなければ (共鳴効率が足りなければ) -inf"""
+        index = rank_build_combination(space, compact_key)
+        if index in infeasible: return float("-inf")
+        if index not in scores:
+            if len(scores) >= max_evaluations or time.perf_counter() - start_time > time_limit: return None
+            if (meets_efficiency is not None and not meets_efficiency(stat_row(compact_key))) or \
+               (is_feasible is not None and not is_feasible(materialize_build_combination(space, compact_key)[KEY_ECHO_LIST])):
+                infeasible.add(index)
+                return float("-inf")
+            metrics = evaluate(compact_key)
+            # 並び順が違うだけの同じビルドは上位に1つだけ残す
+            collector.offer(compact_key, metrics, _stat_row_identity(stat_row(compact_key)))
+            scores[index] = collector.score(metrics)
+        return scores[index]
+
+    budget_per_restart = max(1, max_evaluations // max(1, restarts))
+    for _ in range(max(1, restarts)):
+        # 初期解はエネルギー的に成立する候補から選ぶ (見つからなければこの回は飛ばす)
+        for _ in range(1000):
+            current = unrank_build_combination(space, rng.randrange(total_candidates))
+            current_score = score_of(current)
+            if current_score is None or current_score != float("-inf"): break
+        if current_score is None: break
+        if current_score == float("-inf"): continue
+        # 温度はスコアの大きさに合わせ、1回の焼きなましの間に 5% -> 0.01% 相当まで指数的に下げる
+        t_start, t_end = abs(current_score) * 0.05 or 1.0, abs(current_score) * 1e-4 or 1e-3
+        for step in range(budget_per_restart * 4): # 評価済みの近傍は数えないため多めに回す
+            temperature = t_start * (t_end / t_start) ** (step / (budget_per_restart * 4))
+            candidate = _random_neighbor_key(space, current, rng)
+            candidate_score = score_of(candidate)
+            if candidate_score is None: break
+            if candidate_score == float("-inf"): continue
+            delta = candidate_score - current_score
+            if delta >= 0 or rng.random() < math.exp(delta / temperature):
+                current, current_score = candidate, candidate_score
+        if len(scores) >= max_evaluations or time.perf_counter() - start_time > time_limit: break
+
+    return {"metric": metric, "candidates_evaluated": len(scores), "energy_filtered": len(infeasible), "total_candidates": total_candidates,
+            "elapsed_seconds": time.perf_counter() - start_time, "results": _materialize_search_results(space, collector)}
+
+def _set_deficit(set_counts: Dict[Optional[str], int], set_requirements: Optional[Dict[str, int]]) -> int:
+    """セット条件を満たすのにあと何個の音骸が必要か"""
+    if not set_requirements: return 0
+    return sum(max(0, need - set_counts.get(name, 0)) for name, need in set_requirements.items())
+
+def generate_owned_echo_builds(owned_echos: Dict[str, List[Dict]], cost_combo_str: str, set_requirements: Optional[Dict[str, int]] = None):
     """
     所持している音骸のプールから、指定されたコスト組み合わせに合致する
     全ての装備パターンを生成するジェネレータ。
+    set_requirements (ハーモニー名 -> 必要数) を渡すと、音骸の harmony_name で数を数え、
+    残りのスロットでは条件を満たせなくなった時点でその枝の列挙を打ち切る。
     """
     costs_to_find = [int(c) for c in cost_combo_str.split('-')]
+    if len(costs_to_find) != 5: return
     
     # 各コストで必要な音骸の数をカウント
     required_counts = {4: costs_to_find.count(4), 3: costs_to_find.count(3), 1: costs_to_find.count(1)}
     
     # 各コストのプールから、必要な数だけ音骸を選ぶ組み合わせを生成
-    cost4_combos = list(combinations(owned_echos.get("4", []), required_counts[4]))
-    cost3_combos = list(combinations(owned_echos.get("3", []), required_counts[3]))
-    cost1_combos = list(combinations(owned_echos.get("1", []), required_counts[1]))
-    
-    # 組み合わせが存在しない場合は終了
-    if not cost4_combos and required_counts[4] > 0: return
-    if not cost3_combos and required_counts[3] > 0: return
-    if not cost1_combos and required_counts[1] > 0: return
-
-    # productを使って、各コストの組み合わせをさらに組み合わせる
-    # 例: c4の組み合わせ * c3の組み合わせ * c1の組み合わせ
-    all_cost_product = product(
-        cost4_combos if required_counts[4] > 0 else [()],
-        cost3_combos if required_counts[3] > 0 else [()],
-        cost1_combos if required_counts[1] > 0 else [()]
-    )
+    cost_combos = []
+    for cost in (4, 3, 1):
+        combos = list(combinations(owned_echos.get(str(cost), []), required_counts[cost])) if required_counts[cost] > 0 else [()]
+        # 組み合わせが存在しない場合は終了
+        if not combos: return
+        cost_combos.append(combos)
 
-    for product_tuple in all_cost_product:
-        # product_tupleの中身をフラットなリストにする
-        final_echo_list = [echo for combo in product_tuple for echo in combo]
-        if len(final_echo_list) == 5:
-            yield final_echo_list
-                
-                
-                
-                
-                
-                
\ No newline at end of file
+    def _extend(level: int, chosen: List[Dict], set_counts: Dict[Optional[str], int]):
+        if level == len(cost_combos):
+            yield list(chosen)
+            return
+        remaining_after = sum(required_counts[c] for c in (4, 3, 1)[level + 1:])
+        for combo in cost_combos[level]:
+            counts = set_counts
+            if set_requirements:
+                counts = dict(set_counts)
+                for echo in combo: counts[echo.get("harmony_name")] = counts.get(echo.get("harmony_name"), 0) + 1
+                if _set_deficit(counts, set_requirements) > remaining_after: continue
+            chosen.extend(combo)
+            yield from _extend(level + 1, chosen, counts)
+            del chosen[len(chosen) - len(combo):]
+
+    yield from _extend(0, [], {})
+
+# 音骸のメイン・サブステータスに現れるステータスキー (限界価値・ステータス感度モデルの列の並び)
+ECHO_STAT_KEYS = sorted({s["key"] for s in ECHO_DATA["sub_stat_values"].values()} | {s["key"] for stats in ECHO_DATA["main_stats"].values() for s in stats})
+
+def _evaluate_rotation_damage(team_builds: List[Build], team_stats: Dict, initial_sequence: List[Action], loop_sequence: List[Action], all_buffs: Dict, enemy_info: Dict, num_loops: int = 1) -> float:
+    """与えられた team_stats でローテーションの総ダメージ (初動 + num_loops ループ) だけを計算する"""
+    initial_result = _process_phase(initial_sequence, team_builds, team_stats, all_buffs, enemy_info, defaultdict(float), defaultdict(float), time_marks=[], annotate_actions=False)
+    if not loop_sequence or num_loops <= 0:
+        return initial_result["total_damage"]
+    loop_result = _process_phase(loop_sequence, team_builds, team_stats, all_buffs, enemy_info, initial_result["final_concerto_energy"], initial_result["final_resonance_energy"], time_marks=[], annotate_actions=False)
+    return initial_result["total_damage"] + loop_result["total_damage"] * num_loops
+
+def compute_stat_marginal_values(team_builds: List[Build], character_name: str, initial_sequence: List[Action], loop_sequence: List[Action], all_buffs: Dict,
+                                 enemy_info: Optional[Dict] = None, stat_keys: Optional[List[str]] = None, num_loops: int = 1, step: float = 1.0) -> Dict[str, float]:
+    """
+    character_name のステータスを1ずつ増やしたときのローテーション総ダメージの増分 (限界価値) を、ステータスキーごとに返す。
+    """
+    enemy_info = enemy_info or {KEY_LEVEL: 90}
+    if stat_keys is None: stat_keys = ECHO_STAT_KEYS
+    team_stats = {b[KEY_CHARACTER_NAME]: calculate_base_stats(b) for b in team_builds if b.get(KEY_CHARACTER_NAME)}
+    base_damage = _evaluate_rotation_damage(team_builds, team_stats, initial_sequence, loop_sequence, all_buffs, enemy_info, num_loops)
+    display, raw, bases = team_stats[character_name]
+    marginal = {}
+    for key in stat_keys:
+        trial_raw = dict(raw); trial_raw[key] = trial_raw.get(key, 0) + step
+        trial_stats = {**team_stats, character_name: (display, trial_raw, bases)}
+        marginal[key] = (_evaluate_rotation_damage(team_builds, trial_stats, initial_sequence, loop_sequence, all_buffs, enemy_info, num_loops) - base_damage) / step
+    return marginal
+
+def _echo_stat_vector(echo: Dict) -> Dict[str, float]:
+    """音骸1つが与えるステータス (メイン・固定メイン・サブ) を合計する"""
+    stats = defaultdict(float)
+    if echo.get(KEY_MAIN_STAT): stats[echo[KEY_MAIN_STAT][KEY_KEY]] += echo[KEY_MAIN_STAT][KEY_VALUE]
+    fixed_stat = ECHO_DATA["fixed_main_stats"].get(str(echo.get(KEY_COST)))
+    if fixed_stat: stats[fixed_stat[KEY_KEY]] += fixed_stat[KEY_VALUE]
+    for sub in echo.get(KEY_SUB_STATS, []): stats[sub[KEY_KEY]] += sub[KEY_VALUE]
+    return stats
+
+def _pareto_filter(items: List[Tuple[float, Dict[str, float], Dict]], keys: List[str]) -> List[Tuple[float, Dict[str, float], Dict]]:
+    """keys 上のステータスで他の音骸に完全に劣る (全て以下かつどれかが未満) 音骸を除く"""
+    kept = []
+    for i, (_, vec_i, _) in enumerate(items):
+        dominated = False
+        for j, (_, vec_j, _) in enumerate(items):
+            if i == j: continue
+            if all(vec_j.get(k, 0) >= vec_i.get(k, 0) for k in keys) and any(vec_j.get(k, 0) > vec_i.get(k, 0) for k in keys):
+                dominated = True; break
+        if not dominated: kept.append(items[i])
+    return kept
+
+def _harmony_set_requirements(build: Build) -> Dict[str, int]:
+    """ビルドの harmony1_name / harmony2_name から、セット名 -> 必要な音骸数 を返す (同名2つなら5セット)"""
+    h1_name, h2_name = build.get(KEY_HARMONY1_NAME), build.get(KEY_HARMONY2_NAME)
+    if h1_name and h1_name == h2_name:
+        return {h1_name: 5}
+    requirements = {}
+    for name, data in ((h1_name, build.get(KEY_HARMONY1_DATA) or {}), (h2_name, build.get(KEY_HARMONY2_DATA) or {})):
+        if not name: continue
+        # 3セット効果が有効なハーモニーは3つ必要
+        requirements[name] = 3 if data.get("has_3set_effect") else 2
+    return requirements
+
+def prefilter_owned_echoes(owned_echos: Dict[str, List[Dict]], marginal_values: Dict[str, float], top_k: int = 8) -> Dict[str, List[Tuple[float, Dict]]]:
+    """
+    所持音骸を限界価値で採点し、(コスト, メインステータス, ハーモニー) ごとに
+    パレート最適なものの中から上位 top_k 個だけを残す。戻り値はコスト -> [(スコア, 音骸)] (スコア降順)。
+    """
+    useful_keys = [k for k, v in marginal_values.items() if v > 0]
+    groups = defaultdict(list)
+    for cost, echoes in owned_echos.items():
+        for echo in echoes:
+            if not echo: continue
+            vec = _echo_stat_vector(echo)
+            score = sum(value * marginal_values.get(key, 0.0) for key, value in vec.items())
+            main_key = echo.get(KEY_MAIN_STAT, {}).get(KEY_KEY) if echo.get(KEY_MAIN_STAT) else None
+            groups[(str(cost), main_key, echo.get("harmony_name"))].append((score, vec, echo))
+
+    pools = defaultdict(list)
+    for (cost, _, _), items in groups.items():
+        kept = _pareto_filter(items, useful_keys)
+        kept.sort(key=lambda item: item[0], reverse=True)
+        pools[cost].extend((score, echo) for score, _, echo in kept[:top_k])
+    for cost in pools:
+        pools[cost].sort(key=lambda item: item[0], reverse=True)
+    return dict(pools)
+
+def _search_top_echo_combinations(pools: Dict[str, List[Tuple[float, Dict]]], costs: List[int], limit: int,
+                                  set_requirements: Optional[Dict[str, int]] = None, score_offset: float = 0.0) -> List[Tuple[float, List[Dict]]]:
+    """
+    コストごとのスコア降順プールから、線形スコアの合計が上位 limit 件の組み合わせを分枝限定法で探す。
+    組み合わせは必要になった分だけ辿り、残りスロットの最大スコアを足しても上位に入らない枝は打ち切る。
+    set_requirements があれば、残りのスロットでセット数を満たせなくなった枝もその場で打ち切るため、
+    条件を満たさない組み合わせは結果に含まれない。score_offset は全候補のスコアに足される (セット効果分)。
+    """
+    required = {str(c): costs.count(c) for c in set(costs)}
+    cost_order = [c for c in ("4", "3", "1") if required.get(c)]
+    if any(len(pools.get(c, [])) < required[c] for c in cost_order): return []
+    total_slots = len(costs)
+
+    def best_remaining(cost_index: int, start: int, picked_in_cost: int) -> float:
+        total = 0.0
+        for ci in range(cost_index, len(cost_order)):
+            c = cost_order[ci]
+            pool = pools[c]
+            need = required[c] - (picked_in_cost if ci == cost_index else 0)
+            from_index = start if ci == cost_index else 0
+            total += sum(score for score, _ in pool[from_index:from_index + need])
+        return total
+
+    top: List[Tuple[float, int, List[Dict]]] = [] # 最小ヒープ (スコア, 連番, 音骸リスト)
+    counter = 0
+    set_counts: Dict[Optional[str], int] = defaultdict(int)
+
+    def dfs(cost_index: int, start: int, picked_in_cost: int, score: float, chosen: List[Dict]):
+        nonlocal counter
+        if _set_deficit(set_counts, set_requirements) > total_slots - len(chosen):
+            return
+        if cost_index == len(cost_order):
+            counter += 1
+            if len(top) < limit: heapq.heappush(top, (score, counter, list(chosen)))
+            elif score > top[0][0]: heapq.heapreplace(top, (score, counter, list(chosen)))
+            return
+        if len(top) >= limit and score + best_remaining(cost_index, start, picked_in_cost) <= top[0][0]:
+            return
+        c = cost_order[cost_index]
+        pool = pools[c]
+        if picked_in_cost == required[c]:
+            dfs(cost_index + 1, 0, 0, score, chosen); return
+        remaining_needed = required[c] - picked_in_cost
+        for i in range(start, len(pool) - remaining_needed + 1):
+            echo_score, echo = pool[i]
+            chosen.append(echo); set_counts[echo.get("harmony_name")] += 1
+            dfs(cost_index, i + 1, picked_in_cost + 1, score + echo_score, chosen)
+            chosen.pop(); set_counts[echo.get("harmony_name")] -= 1
+            # プールはスコア降順なので、ここから先は上限がさらに下がるだけ
+            if len(top) >= limit and score + best_remaining(cost_index, i + 1, picked_in_cost) <= top[0][0]:
+                break
+
+    dfs(0, 0, 0, 0.0, [])
+    return [(score + score_offset, echoes) for score, _, echoes in sorted(top, key=lambda t: t[0], reverse=True)]
+
+def _build_with_harmony(build: Build, h1_name: Optional[str], h2_name: Optional[str], harmony_effects: Optional[Dict[str, Dict]] = None) -> Build:
+    """ハーモニーを差し替えたビルドのコピーを返す。データは harmony_effects、なければビルドに埋め込まれたものを使う"""
+    embedded = {build.get(KEY_HARMONY1_NAME): build.get(KEY_HARMONY1_DATA), build.get(KEY_HARMONY2_NAME): build.get(KEY_HARMONY2_DATA)}
+    def _resolve(name):
+        if not name: return {}
+        return (harmony_effects or {}).get(name) or embedded.get(name) or {KEY_NAME: name}
+    return {**build, KEY_HARMONY1_NAME: h1_name or "", KEY_HARMONY1_DATA: _resolve(h1_name), KEY_HARMONY2_NAME: h2_name or "", KEY_HARMONY2_DATA: _resolve(h2_name)}
+
+def _replace_character_harmony_buffs(all_buffs: Dict, build: Build) -> Dict:
+    """all_buffs のうち build のキャラのハーモニーバフだけを、build のハーモニーのものに入れ替える"""
+    prefix = f"harmony_{build.get(KEY_CHARACTER_NAME)}_"
+    replaced = {k: v for k, v in all_buffs.items() if not k.startswith(prefix)}
+    replaced.update({k: v for k, v in gather_team_buffs([build]).items() if k.startswith(prefix)})
+    return replaced
+
+def optimize_owned_echoes(team_builds: List[Build], character_name: str, initial_sequence: List[Action], loop_sequence: List[Action], all_buffs: Dict,
+                          owned_echos: Dict[str, List[Dict]], cost_combos: Optional[List[str]] = None, enemy_info: Optional[Dict] = None,
+                          top_k: int = 8, max_evaluations: int = 200, num_loops: int = 1, respect_harmony: bool = True,
+                          harmony_options: Optional[List[Tuple[str, Optional[str]]]] = None, harmony_effects: Optional[Dict[str, Dict]] = None,
+                          energy_check: bool = False, min_efficiency: Optional[float] = None) -> OwnedEchoOptimizationResult:
+    """
+    所持音骸インベントリから、character_name のローテーション総ダメージが最大になる5つの組み合わせを探す。
+      1. 現在のビルドでのステータス限界価値を求め、各音骸を線形に採点する
+      2. (コスト, メインステータス, ハーモニー) ごとにパレート最適 + 上位 top_k 個だけ残す
+      3. 線形スコア上位 max_evaluations 件の組み合わせを分枝限定法で遅延列挙し、それだけを実際のローテーションで評価する
+    respect_harmony なら、音骸の harmony_name でセット数 (5 / 2+2 / 2+3) を数え、満たせない組み合わせは列挙の時点で除く。
+    harmony_options に (harmony1_name, harmony2_name) の候補を渡すと、セットごとにセット効果 (常時ステータスと
+    トリガー付きバフ) によるダメージ増分を線形スコアに加え、全候補をまとめて順位付けする。省略時はビルドのハーモニーのみ。
+    energy_check なら、ローテーションがエネルギー的に成立しない組み合わせ (ハーモニーごとに判定) は評価せずに除く。
+    min_efficiency を渡すと、共鳴効率がそれに届かない組み合わせも評価せずに除く。どちらも energy_filtered に数える。
+    """
+    enemy_info = enemy_info or {KEY_LEVEL: 90}
+    cost_combos = cost_combos or ["4-3-3-1-1", "4-4-1-1-1"]
+    build = next((b for b in team_builds if b.get(KEY_CHARACTER_NAME) == character_name), None)
+    if build is None: raise ValueError(f"チームに {character_name} がいません")
+    if not respect_harmony: harmony_options = [(build.get(KEY_HARMONY1_NAME), build.get(KEY_HARMONY2_NAME))]
+    harmony_options = harmony_options or [(build.get(KEY_HARMONY1_NAME), build.get(KEY_HARMONY2_NAME))]
+
+    marginal = compute_stat_marginal_values(team_builds, character_name, initial_sequence, loop_sequence, all_buffs, enemy_info, num_loops=num_loops)
+    pools = prefilter_owned_echoes(owned_echos, marginal, top_k)
+    team_stats = {b[KEY_CHARACTER_NAME]: calculate_base_stats(b) for b in team_builds if b.get(KEY_CHARACTER_NAME)}
+
+    def _evaluate(option_build: Build, option_buffs: Dict, echo_list: List[Dict]) -> float:
+        option_team = [option_build if b.get(KEY_CHARACTER_NAME) == character_name else b for b in team_builds]
+        trial_stats = {**team_stats, character_name: calculate_base_stats({**option_build, KEY_ECHO_LIST: echo_list})}
+        return _evaluate_rotation_damage(option_team, trial_stats, initial_sequence, loop_sequence, option_buffs, enemy_info, num_loops)
+
+    # セット効果なしを基準に、各ハーモニー候補のセット効果によるダメージ増分を現在の音骸で測る
+    current_echoes = build.get(KEY_ECHO_LIST, [])
+    no_set_build = _build_with_harmony(build, None, None)
+    no_set_damage = _evaluate(no_set_build, _replace_character_harmony_buffs(all_buffs, no_set_build), current_echoes)
+
+    candidates = []
+    set_bonus_by_option = {}
+    feasibility_by_option: Dict[str, Callable[[List[Dict]], bool]] = {}
+    for h1_name, h2_name in harmony_options:
+        option_build = _build_with_harmony(build, h1_name, h2_name, harmony_effects)
+        option_buffs = _replace_character_harmony_buffs(all_buffs, option_build)
+        option_label = "+".join(n for n in (h1_name, h2_name) if n)
+        if energy_check:
+            option_team = [option_build if b.get(KEY_CHARACTER_NAME) == character_name else b for b in team_builds]
+            feasibility_by_option[option_label] = _make_energy_feasibility_check(option_team, character_name, initial_sequence, loop_sequence, option_buffs, num_loops)
+        set_bonus = _evaluate(option_build, option_buffs, current_echoes) - no_set_damage
+        set_bonus_by_option[option_label] = set_bonus
+        set_requirements = _harmony_set_requirements(option_build) if respect_harmony else None
+        for cost_combo_str in cost_combos:
+            costs = [int(c) for c in cost_combo_str.split('-')]
+            for linear_score, echo_list in _search_top_echo_combinations(pools, costs, max_evaluations, set_requirements, set_bonus):
+                candidates.append((linear_score, cost_combo_str, option_label, option_build, option_buffs, echo_list))
+
+    candidates.sort(key=lambda c: c[0], reverse=True)
+    ranking = []
+    energy_filtered = 0
+    meets_efficiency = _make_min_efficiency_check(build, min_efficiency) if min_efficiency is not None else None
+    for linear_score, cost_combo_str, option_label, option_build, option_buffs, echo_list in candidates[:max_evaluations]:
+        if meets_efficiency is not None and not meets_efficiency(_echo_list_stat_row(echo_list)):
+            energy_filtered += 1; continue
+        if energy_check and not feasibility_by_option[option_label](echo_list):
+            energy_filtered += 1; continue
+        damage = _evaluate(option_build, option_buffs, echo_list)
+        ranking.append({"cost_combo": cost_combo_str, "harmony": option_label, KEY_ECHO_LIST: echo_list, "linear_score": linear_score, "damage": damage})
+    ranking.sort(key=lambda r: r["damage"], reverse=True)
+    best = ranking[0] if ranking else None
+    return {
+        "best_echo_list": best[KEY_ECHO_LIST] if best else [],
+        "best_damage": best["damage"] if best else 0.0,
+        "best_cost_combo": best["cost_combo"] if best else "",
+        "best_harmony": best["harmony"] if best else "",
+        "marginal_values": marginal,
+        "set_bonus_by_harmony": set_bonus_by_option,
+        "echoes_kept": {cost: len(pool) for cost, pool in pools.items()},
+        "candidates_evaluated": len(ranking),
+        "energy_filtered": energy_filtered,
+        "ranking": ranking[:20],
+    }
+
+_REF_STAT_KEYS = {"攻撃力": ("atk_percent", "atk_flat", "atk"), "HP": ("hp_percent", "hp_flat", "hp"), "防御力": ("def_percent", "def_flat", "def")}
+
+def build_stat_damage_model(team_builds: List[Build], character_name: str, initial_sequence: List[Action], loop_sequence: List[Action], all_buffs: Dict,
+                            enemy_info: Optional[Dict] = None, num_loops: int = 1, team_stats: Optional[Dict] = None) -> Dict:
+    """
+    ローテーションを一度だけ計算し、character_name の音骸ステータス (ECHO_STAT_KEYS) が変化したときの
+    総ダメージ (期待値) を NumPy で一括評価するためのモデルを作る。
+    バフのタイムラインとエネルギーは固定とみなすため、共鳴効率の変化やステータス変換バフの連動は反映されない。
+    """
+    enemy_info = enemy_info or {KEY_LEVEL: 90}
+    team_stats = team_stats or {b[KEY_CHARACTER_NAME]: calculate_base_stats(b) for b in team_builds if b.get(KEY_CHARACTER_NAME)}
+    initial_records, loop_records = [], []
+    initial_result = _process_phase(initial_sequence, team_builds, team_stats, all_buffs, enemy_info, defaultdict(float), defaultdict(float), time_marks=[], damage_records=initial_records, annotate_actions=False)
+    if loop_sequence and num_loops > 0:
+        _process_phase(loop_sequence, team_builds, team_stats, all_buffs, enemy_info, initial_result["final_concerto_energy"], initial_result["final_resonance_energy"], time_marks=[], damage_records=loop_records, annotate_actions=False)
+
+    key_index = {k: i for i, k in enumerate(ECHO_STAT_KEYS)}
+    rows = defaultdict(list)
+    constant_damage, constant_variance = 0.0, 0.0
+    for weight, records in ((1.0, initial_records), (float(num_loops), loop_records)):
+        for r in records:
+            raw = r["buffed_raw_stats"]
+            defense_bonus, resistance_bonus, dmg_taken_bonus = _calculate_shared_bonuses(raw, enemy_info, r[KEY_DAMAGE_TYPES])
+            enemy_factor = defense_bonus * resistance_bonus * dmg_taken_bonus
+            if r[KEY_CHARACTER] != character_name or "components" not in r:
+                # 他のキャラや異常効果のダメージは、このキャラの音骸では変わらない
+                expected = max(r["pre_enemy_damage"] * enemy_factor, 0.0)
+                constant_damage += weight * expected
+                p = min(max(r.get("crit_rate", 0.0) / 100, 0.0), 1.0)
+                crit_multiplier = r.get("crit_damage", 0.0) / 100
+                non_crit = expected / (1 + p * crit_multiplier) if p > 0 else expected
+                constant_variance += weight * non_crit ** 2 * p * (1 - p) * crit_multiplier ** 2
+                continue
+            c = r["components"]
+            pct_key, flat_key, base_key = _REF_STAT_KEYS[c["ref_stat_key"]]
+            up_row = np.zeros(len(ECHO_STAT_KEYS))
+            for t in c["damage_types"]:
+                if ATTRIBUTE_DMG_UP_MAP.get(t) in key_index: up_row[key_index[ATTRIBUTE_DMG_UP_MAP[t]]] += 1
+                if DAMAGE_TYPE_TO_KEY_MAP.get(t) in key_index: up_row[key_index[DAMAGE_TYPE_TO_KEY_MAP[t]]] += 1
+            rows["weight"].append(weight)
+            rows["base_ref"].append(r["base_values"][base_key])
+            rows["pct_index"].append(key_index[pct_key]); rows["pct"].append(raw.get(pct_key, 0.0))
+            rows["flat_index"].append(key_index[flat_key]); rows["flat"].append(raw.get(flat_key, 0.0))
+            rows["multiplier"].append(c["final_multiplier"])
+            rows["dmg_up"].append(c["total_dmg_up"] + c["elemental_dmg_up"] + c["skill_type_dmg_up"])
+            rows["up_matrix"].append(up_row)
+            rows["boost"].append(c["damage_boost_bonus"] * enemy_factor)
+            rows["crit_rate"].append(raw.get("crit_rate", 5.0)); rows["crit_damage"].append(raw.get("crit_damage", 150.0))
+
+    model = {k: np.asarray(v, dtype=float if k not in ("pct_index", "flat_index") else int) for k, v in rows.items()}
+    model["up_matrix"] = model["up_matrix"].reshape(-1, len(ECHO_STAT_KEYS))
+    model["constant_damage"], model["constant_variance"] = constant_damage, constant_variance
+    model["crit_rate_index"], model["crit_damage_index"] = key_index["crit_rate"], key_index["crit_damage"]
+    model["stat_keys"] = ECHO_STAT_KEYS
+    return model
+
+def _stat_damage_model_hits(model: Dict, deltas: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """各候補 x 各ヒットの (会心なしのダメージ, 会心率, 会心ダメージ)"""
+    ref = model["base_ref"] * (1 + (model["pct"] + deltas[:, model["pct_index"]]) / 100) + model["flat"] + deltas[:, model["flat_index"]]
+    up = 1 + (model["dmg_up"] + deltas @ model["up_matrix"].T) / 100
+    crit_rate = np.minimum(model["crit_rate"] + deltas[:, [model["crit_rate_index"]]], 100.0)
+    crit_damage = model["crit_damage"] + deltas[:, [model["crit_damage_index"]]]
+    return ref * model["multiplier"] * up * model["boost"], crit_rate, crit_damage
+
+def evaluate_stat_damage_model(model: Dict, stat_deltas: np.ndarray) -> np.ndarray:
+    """stat_deltas (S x len(ECHO_STAT_KEYS)) の各行について、ローテーション総ダメージ (期待値) を返す"""
+    deltas = np.atleast_2d(np.asarray(stat_deltas, dtype=float))
+    if "weight" not in model or len(model["weight"]) == 0:
+        return np.full(deltas.shape[0], model["constant_damage"])
+    non_crit, crit_rate, crit_damage = _stat_damage_model_hits(model, deltas)
+    damage = non_crit * (1 + crit_rate * crit_damage / 10000)
+    return np.maximum(damage, 0.0) @ model["weight"] + model["constant_damage"]
+
+def evaluate_stat_damage_model_moments(model: Dict, stat_deltas: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """evaluate_stat_damage_model に加えて、会心による総ダメージの標準偏差 (_rotation_damage_moments と同じ式) も返す"""
+    deltas = np.atleast_2d(np.asarray(stat_deltas, dtype=float))
+    if "weight" not in model or len(model["weight"]) == 0:
+        return np.full(deltas.shape[0], model["constant_damage"]), np.full(deltas.shape[0], math.sqrt(model.get("constant_variance", 0.0)))
+    non_crit, crit_rate, crit_damage = _stat_damage_model_hits(model, deltas)
+    non_crit = np.maximum(non_crit, 0.0)
+    p, crit_multiplier = np.clip(crit_rate / 100, 0.0, 1.0), crit_damage / 100
+    mean = (non_crit * (1 + crit_rate * crit_damage / 10000)) @ model["weight"] + model["constant_damage"]
+    variance = (non_crit ** 2 * p * (1 - p) * crit_multiplier ** 2) @ model["weight"] + model.get("constant_variance", 0.0)
+    return mean, np.sqrt(variance)
+
+def _sub_stat_tier_table(echo_list: List[Dict]) -> List[Tuple[int, np.ndarray, float]]:
+    """音骸リストの各サブステについて (ステータス列, 8段階の値, 現在の値) を返す"""
+    key_index = {k: i for i, k in enumerate(ECHO_STAT_KEYS)}
+    name_by_key = {v["key"]: name for name, v in ECHO_DATA["sub_stat_values"].items()}
+    table = []
+    for echo in echo_list:
+        for sub in (echo or {}).get(KEY_SUB_STATS, []) or []:
+            sub_data = ECHO_DATA["sub_stat_values"].get(sub.get(KEY_NAME)) or ECHO_DATA["sub_stat_values"].get(name_by_key.get(sub.get(KEY_KEY)))
+            if not sub_data or sub_data["key"] not in key_index: continue
+            table.append((key_index[sub_data["key"]], np.asarray(sub_data["values"], dtype=float), float(sub.get(KEY_VALUE, 0.0))))
+    return table
+
+def evaluate_substat_roll_distribution(team_builds: List[Build], character_name: str, initial_sequence: List[Action], loop_sequence: List[Action], all_buffs: Dict,
+                                       enemy_info: Optional[Dict] = None, num_loops: int = 1, echo_list: Optional[List[Dict]] = None,
+                                       tier_probabilities: Optional[List[float]] = None, num_samples: int = 10000,
+                                       percentiles: Tuple[float, ...] = (5, 25, 50, 75, 95), seed: Optional[int] = None) -> SubstatRollDistributionResult:
+    """
+    サブステの数値を固定値ではなく sub_stat_values の8段階上の分布 (既定は一様) として扱い、
+    ローテーション総ダメージの期待値・標準偏差・パーセンタイルを求める。
+    サブステの種類は echo_list (省略時はビルドの音骸) のものを使い、段階だけを各サブステ独立に引き直す。
+    ダメージはステータス感度モデルでまとめて評価するため、ローテーションの計算は一度だけ。
+    """
+    build = next((b for b in team_builds if b.get(KEY_CHARACTER_NAME) == character_name), None)
+    if build is None: raise ValueError(f"チームに {character_name} がいません")
+    team_stats = {b[KEY_CHARACTER_NAME]: calculate_base_stats(b) for b in team_builds if b.get(KEY_CHARACTER_NAME)}
+    if echo_list is not None:
+        team_stats[character_name] = calculate_base_stats({**build, KEY_ECHO_LIST: echo_list})
+    else:
+        echo_list = build.get(KEY_ECHO_LIST, [])
+    model = build_stat_damage_model(team_builds, character_name, initial_sequence, loop_sequence, all_buffs, enemy_info, num_loops, team_stats)
+    table = _sub_stat_tier_table(echo_list)
+
+    num_tiers = len(next(iter(ECHO_DATA["sub_stat_values"].values()))["values"])
+    probs = np.asarray(tier_probabilities if tier_probabilities is not None else [1.0] * num_tiers, dtype=float)
+    probs = probs / probs.sum()
+
+    # 全サブステを同じ段階にしたときのダメージ (段階ごと) と、段階を独立に引いたサンプル
+    rng = np.random.default_rng(seed)
+    tier_deltas = np.zeros((num_tiers, len(ECHO_STAT_KEYS)))
+    sample_deltas = np.zeros((num_samples, len(ECHO_STAT_KEYS)))
+    for column, values, current in table:
+        tier_deltas[:, column] += values[:num_tiers] - current
+        sample_deltas[:, column] += values[rng.choice(num_tiers, size=num_samples, p=probs)] - current
+
+    current_damage = float(evaluate_stat_damage_model(model, np.zeros(len(ECHO_STAT_KEYS)))[0])
+    samples = evaluate_stat_damage_model(model, sample_deltas) if table else np.full(num_samples, current_damage)
+    return {
+        "current_damage": current_damage,
+        "expected_damage": float(samples.mean()),
+        "damage_std_dev": float(samples.std()),
+        "percentiles": {float(p): float(v) for p, v in zip(percentiles, np.percentile(samples, percentiles))},
+        "damage_by_tier": [float(v) for v in evaluate_stat_damage_model(model, tier_deltas)],
+        "tier_probabilities": [float(p) for p in probs],
+        "num_sub_stats": len(table),
+        "num_samples": num_samples,
+    }
+
+def _echo_stat_delta_row(echo: Optional[Dict]) -> np.ndarray:
+    """音骸1つが与えるステータスを ECHO_STAT_KEYS の並びのベクトルにする"""
+    row = np.zeros(len(ECHO_STAT_KEYS))
+    key_index = {k: i for i, k in enumerate(ECHO_STAT_KEYS)}
+    for key, value in _echo_stat_vector(echo or {}).items():
+        if key in key_index: row[key_index[key]] += value
+    return row
+
+def estimate_echo_upgrade_value(team_builds: List[Build], character_name: str, initial_sequence: List[Action], loop_sequence: List[Action], all_buffs: Dict,
+                                enemy_info: Optional[Dict] = None, num_loops: int = 1, costs: Optional[List[int]] = None,
+                                main_stat_weights: Optional[Dict[str, Dict[str, float]]] = None, tier_probabilities: Optional[List[float]] = None,
+                                num_sub_stats: int = 5, num_samples: int = 20000, seed: Optional[int] = None) -> List[EchoUpgradeEstimate]:
+    """
+    現在の音骸の各スロットを、新しく厳選したコスト c の音骸 (最大レベル) に入れ替えたときの期待ダメージ増分を見積もる。
+      メインステ: main_stat_weights[コスト][名前] の比率 (省略時は ECHO_DATA["main_stats"] から一様)
+      サブステ: 全種類から num_sub_stats 個を重複なく一様に選び、数値は tier_probabilities の8段階分布 (省略時は一様)
+    costs を省略すると各スロットは今と同じコストで見積もる。指定すると全スロットをそのコストそれぞれで見積もる。
+    ダメージは build_stat_damage_model でまとめて評価するため、ローテーションの計算は一度だけ。
+    expected_improvement は「悪ければ入れ替えない」場合の期待増分 E[max(0, 増分)]。
+    """
+    build = next((b for b in team_builds if b.get(KEY_CHARACTER_NAME) == character_name), None)
+    if build is None: raise ValueError(f"チームに {character_name} がいません")
+    model = build_stat_damage_model(team_builds, character_name, initial_sequence, loop_sequence, all_buffs, enemy_info, num_loops)
+    current_damage = float(evaluate_stat_damage_model(model, np.zeros(len(ECHO_STAT_KEYS)))[0])
+    rng = np.random.default_rng(seed)
+    key_index = {k: i for i, k in enumerate(ECHO_STAT_KEYS)}
+
+    sub_types = list(ECHO_DATA["sub_stat_values"].values())
+    sub_columns = np.array([key_index[s["key"]] for s in sub_types])
+    sub_values = np.array([s["values"] for s in sub_types], dtype=float)
+    num_tiers = sub_values.shape[1]
+    probs = np.asarray(tier_probabilities if tier_probabilities is not None else [1.0] * num_tiers, dtype=float)
+    probs = probs / probs.sum()
+    num_sub_stats = min(num_sub_stats, len(sub_types))
+
+    echo_list = build.get(KEY_ECHO_LIST, [])
+    estimates = []
+    for slot in range(5):
+        current_echo = echo_list[slot] if slot < len(echo_list) else None
+        current_row = _echo_stat_delta_row(current_echo)
+        slot_costs = costs or [int((current_echo or {}).get(KEY_COST) or 1)]
+        for cost in slot_costs:
+            mains = ECHO_DATA["main_stats"].get(str(cost), [])
+            if not mains: continue
+            weights = np.array([(main_stat_weights or {}).get(str(cost), {}).get(m["name"], 1.0 if not main_stat_weights else 0.0) for m in mains], dtype=float)
+            if weights.sum() <= 0: continue
+            weights = weights / weights.sum()
+
+            # 新しい音骸のステータスをサンプルごとに組み立てる (固定メイン + メイン + サブ)
+            deltas = np.tile(-current_row, (num_samples, 1))
+            fixed_stat = ECHO_DATA["fixed_main_stats"].get(str(cost))
+            if fixed_stat: deltas[:, key_index[fixed_stat[KEY_KEY]]] += fixed_stat[KEY_VALUE]
+            main_choice = rng.choice(len(mains), size=num_samples, p=weights)
+            main_columns = np.array([key_index[m[KEY_KEY]] for m in mains])
+            main_values = np.array([m[KEY_VALUE] for m in mains], dtype=float)
+            np.add.at(deltas, (np.arange(num_samples), main_columns[main_choice]), main_values[main_choice])
+            sub_choice = rng.random((num_samples, len(sub_types))).argsort(axis=1)[:, :num_sub_stats]
+            tiers = rng.choice(num_tiers, size=(num_samples, num_sub_stats), p=probs)
+            np.add.at(deltas, (np.repeat(np.arange(num_samples), num_sub_stats), sub_columns[sub_choice].ravel()), sub_values[sub_choice, tiers].ravel())
+
+            gains = evaluate_stat_damage_model(model, deltas) - current_damage
+            by_main = {mains[i][KEY_NAME]: float(gains[main_choice == i].mean()) for i in range(len(mains)) if np.any(main_choice == i)}
+            estimates.append({
+                "slot": slot, "cost": int(cost),
+                "current_echo_name": (current_echo or {}).get(KEY_NAME, ""),
+                "current_damage": current_damage,
+                "expected_gain": float(gains.mean()),
+                "expected_improvement": float(np.maximum(gains, 0.0).mean()),
+                "improvement_probability": float((gains > 0).mean()),
+                "gain_percentiles": {float(p): float(v) for p, v in zip((5, 50, 95), np.percentile(gains, (5, 50, 95)))},
+                "expected_gain_by_main_stat": by_main,
+            })
+    estimates.sort(key=lambda e: e["expected_improvement"], reverse=True)
+    return estimates
+
+def _compact_key_stat_rows(space: Dict, compact_keys: List[Tuple], cache: Dict) -> np.ndarray:
+    """候補キーごとに、5つの音骸が与えるステータスの合計 (ECHO_STAT_KEYS の並び) を返す。メイン・サブセットの行は cache で使い回す"""
+    rows = np.zeros((len(compact_keys), len(ECHO_STAT_KEYS)))
+    for r, (combo_index, main_indices, sub_indices) in enumerate(compact_keys):
+        costs = space["cost_combos"][combo_index]["costs"]
+        for i in range(5):
+            main_key = ("main", costs[i], main_indices[i])
+            if main_key not in cache:
+                cache[main_key] = _echo_stat_delta_row({KEY_COST: costs[i], KEY_MAIN_STAT: ECHO_DATA["main_stats"][str(costs[i])][main_indices[i]]})
+            sub_key = ("sub", sub_indices[i])
+            if sub_key not in cache:
+                cache[sub_key] = _echo_stat_delta_row({KEY_SUB_STATS: [space["sub_pool"][j] for j in _sub_set_at(space, sub_indices[i])]})
+            rows[r] += cache[main_key] + cache[sub_key]
+    return rows
+
+def _bound_dominated_mask(damage: np.ndarray, efficiency: np.ndarray, std_dev: np.ndarray, tolerance: float,
+                          by: Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]] = None, chunk_size: int = 1024) -> np.ndarray:
+    """
+    近似値の誤差を ±tolerance (相対) と見込み、by の候補 (総ダメージ, 共鳴効率, 標準偏差。省略時は自分たち) の悲観値が
+    自分の楽観値を支配する候補を True にする。総ダメージと共鳴効率は大きいほど、標準偏差は小さいほど良い。
+    共鳴効率は正確なので幅を持たせない。幅があるので、自分自身に支配されることはない。
+    """
+    by_damage, by_efficiency, by_std = by if by is not None else (damage, efficiency, std_dev)
+    n = len(damage)
+    dominated = np.zeros(n, dtype=bool)
+    if n == 0 or len(by_damage) == 0: return dominated
+    damage_low, std_high = by_damage * (1 - tolerance), by_std * (1 + tolerance)
+    damage_high, std_low = damage * (1 + tolerance), std_dev * (1 - tolerance)
+    for start in range(0, n, chunk_size):
+        i = slice(start, min(start + chunk_size, n))
+        not_worse = (damage_low[None, :] >= damage_high[i, None]) & (by_efficiency[None, :] >= efficiency[i, None]) & (std_high[None, :] <= std_low[i, None])
+        better = (damage_low[None, :] > damage_high[i, None]) | (by_efficiency[None, :] > efficiency[i, None]) | (std_high[None, :] < std_low[i, None])
+        dominated[i] = np.any(not_worse & better, axis=1)
+    return dominated
+
+def search_pareto_builds(team_builds: List[Build], character_name: str, initial_sequence: List[Action], loop_sequence: List[Action], all_buffs: Dict,
+                         selected_costs: List[str], eff_subs_per_echo: int, sub_level_index: int, selected_eff_subs: Dict[str, str],
+                         selected_eff_mains: Dict[str, List[str]], full_search_mode: bool, enemy_info: Optional[Dict] = None,
+                         time_marks_initial: Optional[List[bool]] = None, time_marks_loop: Optional[List[bool]] = None, num_loops: int = 1,
+                         min_surplus: Optional[float] = None, bound_tolerance: float = 0.02, max_candidates: Optional[int] = None,
+                         batch_size: int = 2048, max_exact_evaluations: Optional[int] = None, num_simulations: int = 0,
+                         seed: Optional[int] = None) -> ParetoSearchResult:
+    """
+    generate_build_combinations と同じ探索空間から、総ダメージ (期待値, 大きいほど良い)・共鳴効率の余裕 (大きいほど良い)・
+    会心による標準偏差 (小さいほど良い) の3目的のパレート最適なビルドを一度の探索で求める。評価は精度の低い順に3段階:
+      1. 全候補: 共鳴効率 (音骸ステータスの合計で正確) と、build_stat_damage_model による総ダメージ・標準偏差の近似を
+         NumPy でまとめて計算し、近似誤差 bound_tolerance を見込んでも他の候補に支配されるものを捨てる。
+         min_surplus を指定すると、共鳴効率の余裕がそれ未満の候補も捨てる (0 なら共鳴解放を撃てないもの)。
+      2. 残った候補: ローテーションを計算し直して (_rotation_damage_moments) 厳密な期待値・標準偏差を求め、パレート前線を取る。
+         max_exact_evaluations で件数を絞ると、評価しなかった候補に支配される点が前線に残りうるので truncated を True にする。
+         厳密評価した候補のどれかで、厳密値が近似値 ±bound_tolerance から外れていたら bounds_violated を True にする
+         (段階1の足切りが成り立たず、本当の前線の点を捨てた可能性がある。bound_tolerance を広げて探索し直す)。
+      3. num_simulations > 0 なら、前線のビルドだけ会心を乱数で決めるシミュレーションを回して simulation_stats を付ける。
+    必要な共鳴効率は solve_min_resonance_efficiency で一度だけ求める (音骸によって変わらないとみなす)。
+    共鳴エネルギーが足りずどの共鳴効率でも撃てない場合は必要量が決まらないため、min_surplus の足切りはせず、
+    required_efficiency と efficiency_surplus は None にする (共鳴効率そのものは目的として比べる)。
+    total_time / dps は time_marks_* から process_rotation と同じ規則で求める。
+    """
+    start_time = time.perf_counter()
+    enemy_info = enemy_info or {KEY_LEVEL: 90}
+    build = next((b for b in team_builds if b.get(KEY_CHARACTER_NAME) == character_name), None)
+    if build is None: raise ValueError(f"チームに {character_name} がいません")
+    space = _build_combination_space(selected_costs, eff_subs_per_echo, sub_level_index, selected_eff_subs, selected_eff_mains, full_search_mode)
+    total_candidates = count_build_combinations(space)
+
+    model = build_stat_damage_model(team_builds, character_name, initial_sequence, loop_sequence, all_buffs, enemy_info, num_loops)
+    required_efficiency = solve_min_resonance_efficiency(team_builds, initial_sequence, loop_sequence, all_buffs, num_loops)[character_name]["required_efficiency"]
+    if not math.isfinite(required_efficiency): required_efficiency = None
+    current_efficiency = calculate_base_stats(build)[1].get("resonance_efficiency", 100.0)
+    current_row = _echo_list_stat_row(build.get(KEY_ECHO_LIST, []))
+    efficiency_index = ECHO_STAT_KEYS.index("resonance_efficiency")
+
+    # 1. 近似評価と区間による足切り。支配する側の候補も支配されていない候補の中にいるので、残りだけ持ち回ればよい
+    # (区間による支配は推移的なので、後で消えた候補に支配されていた候補は、それを消した候補にも支配される)
+    # 共鳴効率の余裕は 共鳴効率 - 必要量 なので、比較は共鳴効率そのもので行う (必要量が決まらなくても比べられる)
+    keys: List[Tuple] = []
+    damage, std_dev, efficiency = np.zeros(0), np.zeros(0), np.zeros(0)
+    survivor_rows: Set[bytes] = set() # 残っている候補のステータス合計 (丸めたもの)。同じビルドの重複を除くのに使う
+    survivor_row_bytes: List[bytes] = []
+    row_cache: Dict = {}
+    evaluated = energy_filtered = 0
+    batch: List[Tuple] = []
+    def flush():
+        nonlocal keys, damage, std_dev, efficiency, survivor_row_bytes, energy_filtered
+        rows = _compact_key_stat_rows(space, batch, row_cache)
+        deltas = rows - current_row
+        batch_efficiency = current_efficiency + deltas[:, efficiency_index]
+        if min_surplus is not None and required_efficiency is not None:
+            feasible = batch_efficiency - required_efficiency >= min_surplus
+        else:
+            feasible = np.ones(len(batch), dtype=bool)
+        energy_filtered += int((~feasible).sum())
+        # 音骸の並び順が違うだけでステータスの合計が同じ候補は、先に見つかったものだけ残す (比べるのは新しい行だけ)
+        row_bytes = [r.tobytes() for r in np.round(rows, 6)]
+        seen: Set[bytes] = set()
+        for i, b in enumerate(row_bytes):
+            if not feasible[i]: continue
+            if b in survivor_rows or b in seen: feasible[i] = False
+            else: seen.add(b)
+        if feasible.any():
+            new_keys = [k for k, ok in zip(batch, feasible) if ok]
+            new_bytes = [b for b, ok in zip(row_bytes, feasible) if ok]
+            new_damage, new_std = evaluate_stat_damage_model_moments(model, deltas[feasible])
+            new_efficiency = batch_efficiency[feasible]
+            # 新しい候補は (残っている候補 + 新しい候補) と、残っている候補は新しい候補とだけ比べる
+            all_by = (np.concatenate([damage, new_damage]), np.concatenate([efficiency, new_efficiency]), np.concatenate([std_dev, new_std]))
+            keep_new = ~_bound_dominated_mask(new_damage, new_efficiency, new_std, bound_tolerance, by=all_by)
+            keep_old = ~_bound_dominated_mask(damage, efficiency, std_dev, bound_tolerance, by=(new_damage, new_efficiency, new_std))
+            keys = [k for k, ok in zip(keys, keep_old) if ok] + [k for k, ok in zip(new_keys, keep_new) if ok]
+            survivor_row_bytes = [b for b, ok in zip(survivor_row_bytes, keep_old) if ok] + [b for b, ok in zip(new_bytes, keep_new) if ok]
+            damage = np.concatenate([damage[keep_old], new_damage[keep_new]])
+            std_dev = np.concatenate([std_dev[keep_old], new_std[keep_new]])
+            efficiency = np.concatenate([efficiency[keep_old], new_efficiency[keep_new]])
+            survivor_rows.clear(); survivor_rows.update(survivor_row_bytes)
+        batch.clear()
+
+    for compact_key in iter_compact_build_combinations(space, 0, max_candidates):
+        batch.append(compact_key)
+        evaluated += 1
+        if len(batch) >= batch_size: flush()
+    if batch: flush()
+    bound_survivors = len(keys)
+
+    # 2. 残った候補を近似ダメージの高い順に厳密評価する
+    evaluate = _make_build_evaluator(team_builds, build, space, initial_sequence, loop_sequence, all_buffs, enemy_info, num_loops, time_marks_initial, time_marks_loop)
+    order = np.argsort(-damage, kind="stable")[:max_exact_evaluations]
+    truncated = len(order) < bound_survivors
+    exact = []
+    max_model_error = 0.0
+    bounds_violated = False
+    for idx in order:
+        metrics = evaluate(keys[idx])
+        if metrics["total_damage"] > 0:
+            max_model_error = max(max_model_error, float(abs(damage[idx] - metrics["total_damage"]) / metrics["total_damage"]))
+        # 厳密値が近似値 ±bound_tolerance の区間から外れていたら、段階1の足切りで前線の点を捨てた可能性がある
+        for estimate, value in ((damage[idx], metrics["total_damage"]), (std_dev[idx], metrics["damage_std_dev"])):
+            if abs(value - estimate) > bound_tolerance * abs(estimate) + 1e-9: bounds_violated = True
+        exact.append((idx, metrics))
+
+    front = []
+    for idx, metrics in exact:
+        dominated = any(
+            other["total_damage"] >= metrics["total_damage"] and efficiency[j] >= efficiency[idx] and other["damage_std_dev"] <= metrics["damage_std_dev"]
+            and (other["total_damage"] > metrics["total_damage"] or efficiency[j] > efficiency[idx] or other["damage_std_dev"] < metrics["damage_std_dev"])
+            for j, other in exact if j != idx
+        )
+        if dominated: continue
+        materialized = materialize_build_combination(space, keys[idx])
+        front.append({
+            "cost_combo": materialized["cost_combo"], KEY_ECHO_LIST: materialized[KEY_ECHO_LIST],
+            "total_damage": metrics["total_damage"], "damage_std_dev": metrics["damage_std_dev"],
+            "total_time": metrics["total_time"], "dps": metrics["dps"],
+            "resonance_efficiency": float(efficiency[idx]), "efficiency_surplus": float(efficiency[idx] - required_efficiency) if required_efficiency is not None else None,
+            "estimated_total_damage": float(damage[idx]), "estimated_damage_std_dev": float(std_dev[idx]),
+            "simulation_stats": None,
+        })
+    front.sort(key=lambda e: e["total_damage"], reverse=True)
+
+    # 3. 前線のビルドだけモンテカルロで確かめる
+    if num_simulations > 0:
+        total_time = simulation_total_time(num_loops, initial_sequence, loop_sequence, time_marks_initial or [], time_marks_loop or [])
+        for i, entry in enumerate(front):
+            trial_team = [{**b, KEY_ECHO_LIST: entry[KEY_ECHO_LIST]} if b is build else b for b in team_builds]
+            damages = simulate_rotation_damages(num_simulations, num_loops, trial_team, initial_sequence, loop_sequence, enemy_info, all_buffs,
+                                                time_marks_initial or [], time_marks_loop or [], seed=None if seed is None else seed + i)
+            entry["simulation_stats"] = summarize_simulation_damages(damages, total_time)
+
+    return {
+        "character": character_name, "required_efficiency": required_efficiency, "total_candidates": total_candidates,
+        "candidates_evaluated": evaluated, "energy_filtered": energy_filtered, "bound_survivors": bound_survivors,
+        "exact_evaluations": len(exact), "truncated": truncated, "bounds_violated": bounds_violated,
+        "max_model_error": max_model_error,
+        "elapsed_seconds": time.perf_counter() - start_time, "front": front,
+    }
@@ -0,0 +1,210 @@
+# cli.py
+"""
+ブラウザを使わずに calculator を動かすコマンドライン入口。結果は1行1 JSON で標準出力に流す。
+
+    python cli.py rotation --names test test2 --num-loops 5
+    python cli.py simulate --names test --simulations 100000 --chunk-size 2000 --workers 8 --seed 1
+    python cli.py optimize-echoes --names test --character 今汐 --owned owned_echoes.json --workers 4
+
+シナリオは data/scenarios.json の名前 (--names) か、シナリオの JSON ファイル (--scenario-file) で渡す。
+ファイルは scenarios.json と同じ {名前: シナリオ} 形式か、シナリオ1件そのもの (名前はファイル名) のどちらでもよい。
+"""
+import argparse
+import json
+import os
+import sys
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Optional
+
+import numpy as np
+
+from calculator import (
+    gather_team_buffs, simulate_rotation_damages, summarize_simulation_damages, simulation_total_time, optimize_owned_echoes
+)
+from constants import KEY_CHARACTER_NAME
+from game_data import GameData, DEFAULT_DATA_DIR
+from scenarios import DEFAULT_SCENARIOS_PATH, DEFAULT_NUM_LOOPS, load_scenarios, normalize_scenario, evaluate_scenario
+
+DEFAULT_CHUNK_SIZE = 1000
+
+# ワーカープロセスごとに一度だけ受け取るゲームデータ (scenarios.compare_scenarios と同じ方式)
+_worker_game_data: Optional[GameData] = None
+
+def _init_worker(game_data: GameData):
+    global _worker_game_data
+    _worker_game_data = game_data
+
+def json_default(value):
+    if isinstance(value, np.generic): return value.item()
+    if isinstance(value, np.ndarray): return value.tolist()
+    if isinstance(value, (set, frozenset)): return sorted(value)
+    raise TypeError(f"JSON に変換できない値です: {type(value).__name__}")
+
+def emit(record: Dict, stream=None):
+    """1件を1行の JSON として書き出し、すぐに flush する"""
+    stream = stream or sys.stdout
+    stream.write(json.dumps(record, ensure_ascii=False, default=json_default) + "\n")
+    stream.flush()
+
+def load_cli_scenarios(names: Optional[List[str]], scenario_file: Optional[str], scenarios_path: str = DEFAULT_SCENARIOS_PATH) -> Dict[str, Dict]:
+    if scenario_file:
+        with open(scenario_file, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if any(k in data for k in ("rotation_initial", "rotation_loop", "builds", "team_builds")): # シナリオ1件
+            data = {os.path.splitext(os.path.basename(scenario_file))[0]: data}
+        if names:
+            missing = [n for n in names if n not in data]
+            if missing: raise KeyError(f"シナリオが見つかりません: {', '.join(missing)}")
+            data = {n: data[n] for n in names}
+        return data
+    return load_scenarios(scenarios_path, names)
+
+def _map_tasks(func, tasks: List, game_data: GameData, workers: Optional[int]) -> Iterator:
+    """tasks を順に func で処理し、終わった順ではなく投入順に結果を返す。プロセスが使えなければ逐次実行する"""
+    if (workers is not None and workers <= 1) or len(tasks) <= 1:
+        _init_worker(game_data)
+        for task in tasks: yield func(task)
+        return
+    try:
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(game_data,))
+    except (OSError, NotImplementedError, ImportError):
+        _init_worker(game_data)
+        for task in tasks: yield func(task)
+        return
+    with executor:
+        yield from executor.map(func, tasks)
+
+# --- rotation ---
+def _rotation_task(args) -> Dict:
+    name, scenario, num_loops = args
+    try:
+        row = evaluate_scenario(name, scenario, _worker_game_data, num_loops)
+    except Exception as e:
+        return {"type": "error", "scenario": name, "error": f"{type(e).__name__}: {e}"}
+    return {"type": "rotation", "scenario": name, **{k: v for k, v in row.items() if k not in ("name", "rank", "simulation_stats")}}
+
+def run_rotation(scenarios: Dict[str, Dict], game_data: GameData, num_loops: int, workers: Optional[int]) -> Iterator[Dict]:
+    tasks = [(name, scenario, num_loops) for name, scenario in scenarios.items()]
+    yield from _map_tasks(_rotation_task, tasks, game_data, workers)
+
+# --- simulate ---
+def _simulation_chunk_task(args) -> Dict:
+    name, scenario, num_loops, count, chunk_index, seed = args
+    try:
+        s = normalize_scenario(scenario, _worker_game_data)
+        damages = simulate_rotation_damages(count, num_loops, s["team_builds"], s["rotation_initial"], s["rotation_loop"], s["enemy_info"],
+                                            gather_team_buffs(s["team_builds"]), s["time_marks_initial"], s["time_marks_loop"], seed=seed)
+    except Exception as e:
+        return {"type": "error", "scenario": name, "chunk": chunk_index, "error": f"{type(e).__name__}: {e}"}
+    return {"type": "simulation_chunk", "scenario": name, "chunk": chunk_index, "damages": damages}
+
+def run_simulation(scenarios: Dict[str, Dict], game_data: GameData, num_loops: int, num_simulations: int, chunk_size: int,
+                   workers: Optional[int], seed: Optional[int] = None) -> Iterator[Dict]:
+    """
+    num_simulations 回を chunk_size 件ずつに分けてワーカーで回し、チャンクごとの途中経過と
+    シナリオごとの最終統計を流す。失敗したチャンクは error として流し、そのシナリオの最終統計は出さない。seed を渡すとチャンク i は seed + i で回るため、ワーカー数によらず同じ結果になる。
+    """
+    tasks = []
+    for name, scenario in scenarios.items():
+        for chunk_index, start in enumerate(range(0, num_simulations, chunk_size)):
+            count = min(chunk_size, num_simulations - start)
+            tasks.append((name, scenario, num_loops, count, chunk_index, None if seed is None else seed + chunk_index))
+
+    damages_by_scenario: Dict[str, List[float]] = {name: [] for name in scenarios}
+    remaining = Counter(task[0] for task in tasks)
+    failed = set()
+    for record in _map_tasks(_simulation_chunk_task, tasks, game_data, workers):
+        name = record["scenario"]
+        remaining[name] -= 1
+        if record["type"] == "error":
+            failed.add(name)
+            yield record
+            continue
+        damages = record["damages"]
+        damages_by_scenario[name].extend(damages)
+        yield {"type": "simulation_chunk", "scenario": name, "chunk": record["chunk"], "count": len(damages),
+               "total_damage_avg": float(np.mean(damages)) if damages else 0.0, "done": len(damages_by_scenario[name])}
+        if remaining[name] == 0 and name not in failed and damages_by_scenario[name]:
+            s = normalize_scenario(scenarios[name])
+            total_time = simulation_total_time(num_loops, s["rotation_initial"], s["rotation_loop"], s["time_marks_initial"], s["time_marks_loop"])
+            yield {"type": "simulation", "scenario": name, "stats": summarize_simulation_damages(damages_by_scenario.pop(name), total_time)}
+
+# --- optimize-echoes ---
+def _optimize_task(args) -> Dict:
+    name, scenario, character, owned, cost_combo, options = args
+    try:
+        s = normalize_scenario(scenario, _worker_game_data)
+        team_builds = s["team_builds"]
+        character = character or next((b[KEY_CHARACTER_NAME] for b in team_builds if b.get(KEY_CHARACTER_NAME)), None)
+        result = optimize_owned_echoes(team_builds, character, s["rotation_initial"], s["rotation_loop"], gather_team_buffs(team_builds), owned,
+                                       cost_combos=[cost_combo], enemy_info=s["enemy_info"],
+                                       harmony_effects=_worker_game_data.get_data("harmony_effects", {}), **options)
+    except Exception as e:
+        return {"type": "error", "scenario": name, "cost_combo": cost_combo, "error": f"{type(e).__name__}: {e}"}
+    return {"type": "echo_optimization_part", "scenario": name, "character": character, "cost_combo": cost_combo, **result}
+
+def run_optimize_echoes(scenarios: Dict[str, Dict], game_data: GameData, character: Optional[str], owned: Dict[str, List[Dict]],
+                        cost_combos: List[str], workers: Optional[int], **options) -> Iterator[Dict]:
+    """コスト構成ごとに別ワーカーで optimize_owned_echoes を回し、最後にシナリオごとの最良をまとめて流す"""
+    tasks = [(name, scenario, character, owned, combo, options) for name, scenario in scenarios.items() for combo in cost_combos]
+    best: Dict[str, Dict] = {}
+    for record in _map_tasks(_optimize_task, tasks, game_data, workers):
+        yield record
+        if record["type"] != "error" and record["best_echo_list"]:
+            current = best.get(record["scenario"])
+            if current is None or record["best_damage"] > current["best_damage"]:
+                best[record["scenario"]] = record
+    for name, record in best.items():
+        yield {"type": "echo_optimization", "scenario": name, "character": record["character"], "best_cost_combo": record["best_cost_combo"],
+               "best_harmony": record["best_harmony"], "best_damage": record["best_damage"], "best_echo_list": record["best_echo_list"]}
+
+def main(argv: Optional[List[str]] = None) -> int:
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--names", nargs="*", help="scenarios.json (または --scenario-file) 内のシナリオ名")
+    common.add_argument("--scenario-file", help="シナリオの JSON ファイル")
+    common.add_argument("--scenarios", default=DEFAULT_SCENARIOS_PATH, help="scenarios.json のパス")
+    common.add_argument("--data-dir", default=DEFAULT_DATA_DIR, help="ゲームデータのディレクトリ")
+    common.add_argument("--num-loops", type=int, default=DEFAULT_NUM_LOOPS)
+    common.add_argument("--workers", type=int, default=None, help="ワーカープロセス数 (省略時は CPU 数、1 で逐次)")
+
+    parser = argparse.ArgumentParser(description="calculator のバッチ計算 (JSON lines 出力)")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("rotation", parents=[common], help="process_rotation による期待値計算")
+    p_sim = sub.add_parser("simulate", parents=[common], help="会心を乱数で決めるモンテカルロ")
+    p_sim.add_argument("--simulations", type=int, default=1000)
+    p_sim.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="1タスクあたりのシミュレーション回数")
+    p_sim.add_argument("--seed", type=int, default=None)
+    p_opt = sub.add_parser("optimize-echoes", parents=[common], help="所持音骸からの最適な組み合わせ探索")
+    p_opt.add_argument("--owned", required=True, help="所持音骸の JSON ({コスト: [音骸, ...]})")
+    p_opt.add_argument("--character", help="対象キャラクター (省略時はチームの先頭)")
+    p_opt.add_argument("--cost-combos", nargs="*", default=["4-3-3-1-1", "4-4-1-1-1"])
+    p_opt.add_argument("--top-k", type=int, default=8)
+    p_opt.add_argument("--max-evaluations", type=int, default=200)
+    args = parser.parse_args(argv)
+
+    try:
+        scenarios = load_cli_scenarios(args.names, args.scenario_file, args.scenarios)
+    except (OSError, KeyError, json.JSONDecodeError) as e:
+        emit({"type": "error", "error": f"{type(e).__name__}: {e}"})
+        return 2
+    game_data = GameData.load_compiled(args.data_dir)
+
+    if args.command == "rotation":
+        records: Iterable[Dict] = run_rotation(scenarios, game_data, args.num_loops, args.workers)
+    elif args.command == "simulate":
+        records = run_simulation(scenarios, game_data, args.num_loops, args.simulations, max(1, args.chunk_size), args.workers, args.seed)
+    else:
+        with open(args.owned, "r", encoding="utf-8") as f:
+            owned = json.load(f)
+        records = run_optimize_echoes(scenarios, game_data, args.character, owned, args.cost_combos, args.workers,
+                                      top_k=args.top_k, max_evaluations=args.max_evaluations, num_loops=args.num_loops)
+
+    failed = False
+    for record in records:
+        failed = failed or record["type"] == "error"
+        emit(record)
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
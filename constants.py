@@ -71,6 +71,14 @@ ABNORMAL_STACK_MULTIPLIERS = {
     "風蝕効果": [1, 2.5, 5, 7.5, 10, 12.5, 15, 17.5, 20],
     "斉爆効果": [1], "虚滅効果": [1]
 }
+# 上の表より多いスタック数での1スタックあたりの倍率の増分 (騒光効果の11スタック目以降)
+ABNORMAL_EXTRA_STACK_STEP = {"騒光効果": 1.812}
+# 異常効果のタイムラインのモデル (simulate_abnormal_timeline で使用)
+#   tick_interval: ダメージ間隔(秒) / duration: 最後の付与からの持続(秒) / stacks_lost_per_tick: 1回のダメージ後に減るスタック数
+ABNORMAL_TIMELINE_PARAMS = {
+    "騒光効果": {"tick_interval": 3.0, "duration": 15.0, "stacks_lost_per_tick": 1},
+    "風蝕効果": {"tick_interval": 3.0, "duration": 15.0, "stacks_lost_per_tick": 0},
+}
 
 # --- ステータスキー定義 ---
 ATTRIBUTE_NAME_TO_RES_KEY = {"気動": "aero", "焦熱": "fusion", "電導": "electro", "凝縮": "glacio", "消滅": "havoc", "回折": "spectro"}
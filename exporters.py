@@ -1,11 +1,13 @@
 # exporters.py
 
 from PIL import Image, ImageDraw, ImageFont
+import base64
 import json
 import os
 from datetime import datetime
 # from constants import FONT_FAMILY # GUI用なので不要
 from gui_widgets import ImageHandler
+from result_codec import encode_result, decode_result, restore_calculation_details
 
 class PngExporter:
     # 画像のサイズやマージンなどを定数として定義
@@ -21,6 +23,10 @@ class PngExporter:
     # プロジェクトルートに assets/fonts/ を作成し、そこにフォントファイルを配置してください
     FONT_PATH = "assets/NotoSansJP-VariableFont_wght.ttf"
 
+    # 埋め込むメタデータのキー (JSON 形式は旧バージョンの画像の読込用)
+    METADATA_KEY_JSON = "WutheringWavesDamageCalcData"
+    METADATA_KEY_COMPACT = "WutheringWavesDamageCalcDataCompact" # result_codec のバイナリを base64 にしたもの
+
     @classmethod
     def generate_build_image(cls, team_builds, username):
         """チームビルドの情報から一枚の画像を生成する"""
@@ -109,40 +115,51 @@ class PngExporter:
             print(f"画像貼り付けエラー: {e}")
 
     @classmethod
-    def save_with_metadata(cls, image: Image.Image, sharable_data: dict, filepath: str):
-        """画像にJSONデータを埋め込んで保存する"""
+    def save_with_metadata(cls, image: Image.Image, sharable_data: dict, filepath: str, compact: bool = True):
+        """
+        画像に計算データを埋め込んで保存する。
+        compact なら result_codec のバイナリ形式 (calculation_details は読込時に計算し直す) で、そうでなければ JSON で埋め込む。
+        """
         if not image: return False
         
         # PillowのPngInfoオブジェクトを使ってメタデータを設定
         from PIL import PngImagePlugin
         metadata = PngImagePlugin.PngInfo()
         
-        # --- ▼▼▼ ここから修正 ▼▼▼ ---
-        # setをlistに変換するカスタムJSONエンコーダーを定義
-        class SetEncoder(json.JSONEncoder):
-            def default(self, obj):
-                if isinstance(obj, set):
-                    return list(obj)
-                return json.JSONEncoder.default(self, obj)
-        
-        # データをJSON文字列に変換する際に、カスタムエンコーダー(cls=SetEncoder)を指定
-        json_string = json.dumps(sharable_data, ensure_ascii=False, cls=SetEncoder)
-        # --- ▲▲▲ 修正ここまで ▲▲▲ ---
-        
-        # メタデータとして追加（キーは自由に設定可能）
-        metadata.add_text("WutheringWavesDamageCalcData", json_string)
+        if compact:
+            metadata.add_text(cls.METADATA_KEY_COMPACT, base64.b64encode(encode_result(sharable_data)).decode("ascii"))
+        else:
+            # setをlistに変換するカスタムJSONエンコーダーを定義
+            class SetEncoder(json.JSONEncoder):
+                def default(self, obj):
+                    if isinstance(obj, set):
+                        return list(obj)
+                    return json.JSONEncoder.default(self, obj)
+            
+            # データをJSON文字列に変換する際に、カスタムエンコーダー(cls=SetEncoder)を指定
+            json_string = json.dumps(sharable_data, ensure_ascii=False, cls=SetEncoder)
+            metadata.add_text(cls.METADATA_KEY_JSON, json_string)
         
         # メタデータ付きで画像を保存
         image.save(filepath, "PNG", pnginfo=metadata)
         return True
 
     @classmethod
-    def load_from_metadata(cls, filepath: str):
-        """PNG画像からメタデータを読み込んでJSONデータを復元する"""
+    def load_from_metadata(cls, filepath: str, data_manager=None):
+        """
+        PNG画像からメタデータを読み込んでデータを復元する (バイナリ形式・JSON 形式のどちらも読める)。
+        バイナリ形式で data_manager が渡されていれば、calculation_details を計算し直して埋める。
+        """
         try:
             with Image.open(filepath) as img:
+                compact_string = img.text.get(cls.METADATA_KEY_COMPACT)
+                if compact_string:
+                    data = decode_result(base64.b64decode(compact_string))
+                    if data_manager is not None:
+                        restore_calculation_details(data, data_manager)
+                    return data
                 # メタデータキーを指定してテキストを読み込む
-                json_string = img.text.get("WutheringWavesDamageCalcData")
+                json_string = img.text.get(cls.METADATA_KEY_JSON)
                 if json_string:
                     return json.loads(json_string)
         except Exception as e:
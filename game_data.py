@@ -0,0 +1,273 @@
+# game_data.py
+import hashlib
+import json
+import os
+import pickle
+from typing import Dict, Any, List, Optional, Union, Literal, get_type_hints, get_origin, get_args
+
+from constants import (
+    KEY_CHARACTER_NAME, KEY_CHARACTER_DATA, KEY_WEAPON_NAME, KEY_WEAPON_DATA,
+    KEY_HARMONY1_NAME, KEY_HARMONY1_DATA, KEY_HARMONY2_NAME, KEY_HARMONY2_DATA,
+    KEY_ECHO_SKILL_NAME, KEY_ECHO_SKILL_DATA, STAT_NAME_TO_KEY
+)
+from app_types import Build, CharacterData, WeaponData, HarmonyData, EchoSkillData, StageEffectData
+
+DEFAULT_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+GAME_DATA_KEYS = ["characters", "weapons", "harmony_effects", "echo_skills", "stage_effects"]
+COMPILED_DATA_VERSION = 1
+COMPILED_CACHE_FILENAME = ".game_data.compiled.pickle"
+
+# 各カテゴリの1件が従うべき型 (validate_game_data で使う)
+GAME_DATA_SCHEMAS = {
+    "characters": CharacterData,
+    "weapons": WeaponData,
+    "harmony_effects": HarmonyData,
+    "echo_skills": EchoSkillData,
+    "stage_effects": StageEffectData,
+}
+
+# ステータス名ではなくキーを持つべきフィールド (名前で書かれていれば compile 時にキーへ直す)
+STAT_KEY_FIELDS = ("stat_to_buff", "source_stat", "dest_stat")
+
+# ビルドの「名前キー」と「データキー」、参照先カテゴリの対応表
+BUILD_DATA_REFERENCES = [
+    (KEY_CHARACTER_NAME, KEY_CHARACTER_DATA, "characters"),
+    (KEY_WEAPON_NAME, KEY_WEAPON_DATA, "weapons"),
+    (KEY_HARMONY1_NAME, KEY_HARMONY1_DATA, "harmony_effects"),
+    (KEY_HARMONY2_NAME, KEY_HARMONY2_DATA, "harmony_effects"),
+    (KEY_ECHO_SKILL_NAME, KEY_ECHO_SKILL_DATA, "echo_skills"),
+]
+
+class GameData:
+    """
+    data/ 以下のゲームデータJSONを一度だけ読み込んで保持する。
+    script.js の dataManager と同じく get_data(key, default) でアクセスできるため、
+    process_rotation の data_manager 引数としてそのまま渡せる。
+    """
+    def __init__(self, data: Optional[Dict[str, Any]] = None, data_dir: str = DEFAULT_DATA_DIR):
+        self.data = data if data is not None else {}
+        self.data_dir = data_dir
+        self.index: Optional[Dict[str, Any]] = None # load_compiled で読み込んだ場合の索引
+        self.issues: List[str] = [] # load_compiled での検証結果
+
+    @classmethod
+    def load(cls, data_dir: str = DEFAULT_DATA_DIR, keys: Optional[list] = None) -> "GameData":
+        data = {}
+        for key in (keys or GAME_DATA_KEYS):
+            path = os.path.join(data_dir, f"{key}.json")
+            if not os.path.exists(path):
+                data[key] = {}
+                continue
+            with open(path, "r", encoding="utf-8") as f:
+                data[key] = json.load(f)
+        return cls(data, data_dir)
+
+    @classmethod
+    def load_compiled(cls, data_dir: str = DEFAULT_DATA_DIR, cache_path: Optional[str] = None, strict: bool = False) -> "GameData":
+        """
+        compile_game_data で作ったキャッシュから読み込む。キャッシュが無い・古い (JSON の内容や
+        COMPILED_DATA_VERSION が変わった) 場合は作り直す。検証で見つかった問題は issues に入り、
+        strict なら GameDataValidationError を送出する。
+        """
+        cache_path = cache_path or os.path.join(data_dir, COMPILED_CACHE_FILENAME)
+        compiled = _read_compiled_cache(cache_path, data_dir)
+        if compiled is None:
+            compiled = compile_game_data(data_dir)
+            _write_compiled_cache(cache_path, compiled)
+        if strict and compiled["issues"]:
+            raise GameDataValidationError(compiled["issues"])
+        game_data = cls(compiled["data"], data_dir)
+        game_data.index = compiled["index"]
+        game_data.issues = compiled["issues"]
+        return game_data
+
+    def get_data(self, key: str, default: Any = None) -> Any:
+        return self.data.get(key, default)
+
+    def find_skill(self, owner_name: str, skill_name: str) -> Optional[Dict]:
+        """キャラクター / 音骸スキルのスキルを名前で引く (compile 済みなら索引、そうでなければ線形探索)"""
+        if self.index is not None:
+            return self.index["skills"].get(owner_name, {}).get(skill_name)
+        for category in ("characters", "echo_skills"):
+            owner = self.data.get(category, {}).get(owner_name)
+            if owner:
+                return next((sk for sk in owner.get("skills", []) if sk.get("name") == skill_name), None)
+        return None
+
+    def resolve_build(self, build: Build) -> Build:
+        """
+        名前だけが保存されたビルドに、現在のゲームデータから *_data を補完する。
+        ゲームデータ側に見つからない場合はビルドに埋め込まれたコピーをそのまま使う。
+        """
+        resolved = dict(build)
+        for name_key, data_key, category in BUILD_DATA_REFERENCES:
+            name = build.get(name_key)
+            current = self.data.get(category, {}).get(name) if name else None
+            if current is not None:
+                resolved[data_key] = current
+            elif data_key not in resolved:
+                resolved[data_key] = {}
+        return resolved
+
+class GameDataValidationError(ValueError):
+    def __init__(self, issues: List[str]):
+        self.issues = issues
+        preview = "\n".join(issues[:20]) + (f"\n... ほか {len(issues) - 20} 件" if len(issues) > 20 else "")
+        super().__init__(f"ゲームデータに {len(issues)} 件の問題があります:\n{preview}")
+
+def _is_optional(tp) -> bool:
+    return get_origin(tp) is Union and type(None) in get_args(tp)
+
+def _validate_value(value: Any, tp, path: str, issues: List[str]):
+    """value が型 tp (TypedDict / List / Dict / Literal / Optional / 基本型) に合うかを調べ、問題を issues に足す"""
+    if tp is Any: return
+    origin = get_origin(tp)
+    if origin is Union:
+        if value is None and _is_optional(tp): return
+        last = []
+        for arg in get_args(tp):
+            if arg is type(None): continue
+            found = []
+            _validate_value(value, arg, path, found)
+            if not found: return
+            last = found
+        issues.extend(last)
+    elif origin is Literal:
+        if value not in get_args(tp): issues.append(f"{path}: {value!r} は {list(get_args(tp))} のいずれでもありません")
+    elif origin is list:
+        if not isinstance(value, list):
+            issues.append(f"{path}: リストであるべきところが {type(value).__name__} です")
+            return
+        item_type = get_args(tp)[0]
+        for i, item in enumerate(value): _validate_value(item, item_type, f"{path}[{i}]", issues)
+    elif origin is dict:
+        if not isinstance(value, dict):
+            issues.append(f"{path}: オブジェクトであるべきところが {type(value).__name__} です")
+            return
+        key_type, value_type = get_args(tp)
+        for k, v in value.items():
+            if get_origin(key_type) is Literal: _validate_value(k, key_type, f"{path} のキー", issues)
+            _validate_value(v, value_type, f"{path}.{k}", issues)
+    elif isinstance(tp, type) and issubclass(tp, dict) and hasattr(tp, "__annotations__"): # TypedDict
+        if not isinstance(value, dict):
+            issues.append(f"{path}: オブジェクトであるべきところが {type(value).__name__} です")
+            return
+        for field, field_type in get_type_hints(tp).items():
+            if field not in value:
+                if not _is_optional(field_type): issues.append(f"{path}: {field} がありません")
+                continue
+            _validate_value(value[field], field_type, f"{path}.{field}", issues)
+    elif tp is float:
+        if isinstance(value, bool) or not isinstance(value, (int, float)): issues.append(f"{path}: 数値であるべきところが {value!r} です")
+    elif tp in (int, str, bool):
+        if not isinstance(value, tp) or (tp is int and isinstance(value, bool)): issues.append(f"{path}: {tp.__name__} であるべきところが {value!r} です")
+
+def validate_game_data(data: Dict[str, Dict]) -> List[str]:
+    """全カテゴリを app_types の型で検証し、"カテゴリ.名前.フィールド: 内容" 形式の問題一覧を返す"""
+    issues = []
+    for category, schema in GAME_DATA_SCHEMAS.items():
+        entries = data.get(category, {})
+        if not isinstance(entries, dict):
+            issues.append(f"{category}: オブジェクトであるべきところが {type(entries).__name__} です")
+            continue
+        for name, entry in entries.items():
+            _validate_value(entry, schema, f"{category}.{name}", issues)
+    return issues
+
+def _resolve_stat_keys(node: Any) -> Any:
+    """ステータス名で書かれたキー (stat_to_buff など、key の無い Stat) を STAT_NAME_TO_KEY でキーに直す"""
+    if isinstance(node, list):
+        return [_resolve_stat_keys(item) for item in node]
+    if not isinstance(node, dict):
+        return node
+    resolved = {k: _resolve_stat_keys(v) for k, v in node.items()}
+    for field in STAT_KEY_FIELDS:
+        if resolved.get(field) in STAT_NAME_TO_KEY: resolved[field] = STAT_NAME_TO_KEY[resolved[field]]
+    if "value" in resolved and not resolved.get("key") and resolved.get("name") in STAT_NAME_TO_KEY:
+        resolved["key"] = STAT_NAME_TO_KEY[resolved["name"]]
+    return resolved
+
+def _source_fingerprints(data_dir: str) -> Dict[str, Optional[tuple]]:
+    """各 JSON の (更新時刻, サイズ)。一致すればハッシュを取り直さずにキャッシュを使う"""
+    fingerprints = {}
+    for key in GAME_DATA_KEYS:
+        try:
+            st = os.stat(os.path.join(data_dir, f"{key}.json"))
+            fingerprints[key] = (st.st_mtime_ns, st.st_size)
+        except OSError:
+            fingerprints[key] = None
+    return fingerprints
+
+def _source_content_hash(data_dir: str) -> str:
+    """JSON の中身とステータス名の対応表のハッシュ (どちらかが変われば compile し直す)"""
+    h = hashlib.sha256(f"v{COMPILED_DATA_VERSION}".encode())
+    for key in GAME_DATA_KEYS:
+        path = os.path.join(data_dir, f"{key}.json")
+        h.update(key.encode())
+        if os.path.exists(path):
+            with open(path, "rb") as f: h.update(f.read())
+    h.update(json.dumps(STAT_NAME_TO_KEY, ensure_ascii=False, sort_keys=True).encode("utf-8"))
+    return h.hexdigest()
+
+def compile_game_data(data_dir: str = DEFAULT_DATA_DIR) -> Dict[str, Any]:
+    """JSON を読み込み、検証・ステータスキーの解決・スキル索引の作成までを済ませた結果を返す"""
+    fingerprints = _source_fingerprints(data_dir)
+    content_hash = _source_content_hash(data_dir)
+    data = {key: _resolve_stat_keys(value) for key, value in GameData.load(data_dir).data.items()}
+    skills_index = {}
+    for category in ("characters", "echo_skills"):
+        for owner_name, owner in data.get(category, {}).items():
+            if isinstance(owner, dict):
+                skills_index[owner_name] = {sk.get("name"): sk for sk in owner.get("skills", []) if isinstance(sk, dict)}
+    return {
+        "version": COMPILED_DATA_VERSION,
+        "content_hash": content_hash,
+        "fingerprints": fingerprints,
+        "data": data,
+        "index": {"skills": skills_index},
+        "issues": validate_game_data(data),
+    }
+
+def _read_compiled_cache(cache_path: str, data_dir: str) -> Optional[Dict[str, Any]]:
+    """キャッシュが現在の JSON と一致していれば返す。古い・壊れている場合は None"""
+    try:
+        with open(cache_path, "rb") as f:
+            compiled = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+        return None
+    if not isinstance(compiled, dict) or compiled.get("version") != COMPILED_DATA_VERSION:
+        return None
+    if compiled.get("fingerprints") == _source_fingerprints(data_dir):
+        return compiled
+    # 更新時刻だけが変わった (チェックアウトし直しなど) 場合は中身で判定する
+    if compiled.get("content_hash") == _source_content_hash(data_dir):
+        compiled["fingerprints"] = _source_fingerprints(data_dir)
+        return compiled
+    return None
+
+def _write_compiled_cache(cache_path: str, compiled: Dict[str, Any]):
+    """一時ファイルに書いてから置き換える。書き込めない場所 (読み取り専用など) ではキャッシュなしで続ける"""
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            pickle.dump(compiled, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """python game_data.py [--data-dir DIR] [--strict] : キャッシュを作り直し、検証結果を表示する"""
+    import argparse
+    parser = argparse.ArgumentParser(description="ゲームデータの検証とコンパイル済みキャッシュの作成")
+    parser.add_argument("--data-dir", default=DEFAULT_DATA_DIR)
+    parser.add_argument("--cache-path", default=None)
+    parser.add_argument("--strict", action="store_true", help="問題があれば終了コード 1")
+    args = parser.parse_args(argv)
+    compiled = compile_game_data(args.data_dir)
+    _write_compiled_cache(args.cache_path or os.path.join(args.data_dir, COMPILED_CACHE_FILENAME), compiled)
+    for issue in compiled["issues"]: print(issue)
+    print(f"{sum(len(v) for v in compiled['data'].values())} 件を compile しました (問題 {len(compiled['issues'])} 件)")
+    return 1 if args.strict and compiled["issues"] else 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
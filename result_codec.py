@@ -0,0 +1,314 @@
+# result_codec.py
+"""
+SharableResult / CalculationResult をコンパクトなバイナリに詰める (共有画像やキャッシュ用)。
+
+  MAGIC (4 byte) | バージョン (1 byte) | zlib( ヘッダー長 (uint32) | ヘッダー JSON | 数値配列 ... )
+
+- キャラクター名とスキル (名前 + skill_data) は名前表に1度だけ入れ、ログや Action からは番号で参照する。
+- ダメージやエネルギーなど、全行が数値の列は numpy 配列 (リトルエンディアン) にまとめる。
+- 全行で同じ値の列 (ログの concerto_energy など) は1度だけ持つ。
+- ログの total_damage は damage の累積和で復元できるので持たない。
+- calculation_details は既定では捨てる。必要になったら restore_calculation_details で計算し直す。
+
+復号結果は JSON で保存・読込したときと同じ形 (set は list) になる。verify_round_trip で現行の JSON と突き合わせられる。
+    python result_codec.py --names test test2
+"""
+import argparse
+import json
+import struct
+import sys
+import zlib
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from constants import KEY_CHARACTER, KEY_SKILL, KEY_SKILL_DATA
+
+FORMAT_MAGIC = b"WWRC"
+FORMAT_VERSION = 1
+
+_ARRAY_REF = "$array"
+_PHASE_KEYS = ("initial_phase", "loop_phase")
+_ACTION_LIST_KEYS = ("rotation_initial", "rotation_loop")
+_CUMULATIVE_COLUMNS = {"total_damage": "damage"} # 復元する列 -> 元の列
+
+class ResultCodecError(ValueError):
+    """形式が違う、または対応していないバージョンのデータ"""
+
+def to_json_compatible(data: Any) -> Any:
+    """現行の JSON 保存 (PngExporter の SetEncoder) と同じ変換をかけた値を返す"""
+    def default(obj):
+        if isinstance(obj, (set, frozenset)): return list(obj)
+        if isinstance(obj, np.generic): return obj.item()
+        if isinstance(obj, np.ndarray): return obj.tolist()
+        raise TypeError(f"JSON に変換できない値です: {type(obj).__name__}")
+    return json.loads(json.dumps(data, ensure_ascii=False, default=default))
+
+class _Tables:
+    """名前表と数値配列を集める"""
+    def __init__(self):
+        self.characters: List[Optional[str]] = []
+        self.skills: List[list] = [] # [キャラクター番号, スキル名, skill_data]
+        self.arrays: List[np.ndarray] = []
+        self._character_index: Dict[Optional[str], int] = {}
+        self._skill_index: Dict[Tuple[int, str, str], int] = {}
+
+    def character(self, name: Optional[str]) -> int:
+        if name not in self._character_index:
+            self._character_index[name] = len(self.characters)
+            self.characters.append(name)
+        return self._character_index[name]
+
+    def skill(self, character: Optional[str], skill: str, skill_data: Any) -> int:
+        char_idx = self.character(character)
+        key = (char_idx, skill, json.dumps(skill_data, ensure_ascii=False, sort_keys=True))
+        if key not in self._skill_index:
+            self._skill_index[key] = len(self.skills)
+            self.skills.append([char_idx, skill, skill_data])
+        return self._skill_index[key]
+
+    def array(self, values: np.ndarray) -> Dict[str, int]:
+        self.arrays.append(values)
+        return {_ARRAY_REF: len(self.arrays) - 1}
+
+def _column_dtype(values: List[Any]) -> Optional[str]:
+    """全行が float なら '<f8'、全行が int なら '<i8'、それ以外は None (bool は数値扱いしない)"""
+    if all(type(v) is float or isinstance(v, np.floating) for v in values): return "<f8"
+    if all(type(v) is int for v in values) and all(-2**63 <= v < 2**63 for v in values): return "<i8"
+    return None
+
+def _encode_rows(rows: List[Dict], tables: _Tables, drop: Tuple[str, ...] = ()) -> Dict:
+    """
+    辞書のリストを {n, skills, columns, const, rows} に分解する。
+    skills はスキル参照の番号 (参照しない行は -1)、columns は数値配列、const は全行共通の値。
+    """
+    rows = [{k: v for k, v in row.items() if k not in drop} for row in rows]
+    encoded: Dict[str, Any] = {"n": len(rows)}
+    if not rows: return encoded
+
+    skill_refs = []
+    for row in rows:
+        if all(k in row for k in (KEY_CHARACTER, KEY_SKILL, KEY_SKILL_DATA)):
+            skill_refs.append(tables.skill(row.pop(KEY_CHARACTER), row.pop(KEY_SKILL), row.pop(KEY_SKILL_DATA)))
+        else:
+            skill_refs.append(-1)
+    if any(i >= 0 for i in skill_refs):
+        encoded["skills"] = tables.array(np.asarray(skill_refs, dtype="<i4"))
+
+    shared_keys = set(rows[0]).intersection(*rows[1:])
+    values_by_key = {key: [row[key] for row in rows] for key in shared_keys}
+    columns, const = {}, {}
+    for key in sorted(shared_keys):
+        values = values_by_key[key]
+        cumulative_of = _CUMULATIVE_COLUMNS.get(key)
+        if cumulative_of in shared_keys and values == _cumulative_sum(values_by_key[cumulative_of]):
+            pass # 復号時に累積和から作る
+        elif (dtype := _column_dtype(values)) is not None:
+            columns[key] = tables.array(np.asarray(values, dtype=dtype))
+        elif all(v == values[0] for v in values[1:]):
+            const[key] = values[0]
+        else:
+            continue
+        for row in rows: del row[key]
+    if columns: encoded["columns"] = columns
+    if const: encoded["const"] = const
+    if any(rows): encoded["rows"] = rows
+    return encoded
+
+def _cumulative_sum(values: List[float]) -> List[float]:
+    """_process_phase の total_dmg と同じ順序で足した累積和"""
+    total, sums = 0, []
+    for v in values:
+        total += v
+        sums.append(total)
+    return sums
+
+def _decode_rows(encoded: Dict, tables: Dict, arrays: List[np.ndarray]) -> List[Dict]:
+    n = encoded["n"]
+    rows = [dict(r) for r in encoded.get("rows") or [{} for _ in range(n)]]
+    for key, value in encoded.get("const", {}).items():
+        for row in rows: row[key] = value # calculator のログと同じく、全行で同じオブジェクトを共有する
+    for key, ref in encoded.get("columns", {}).items():
+        for row, v in zip(rows, arrays[ref[_ARRAY_REF]].tolist()): row[key] = v
+    if "skills" in encoded: # skill_data も同じスキルの行どうしで共有する
+        characters, skills = tables["characters"], tables["skills"]
+        for row, idx in zip(rows, arrays[encoded["skills"][_ARRAY_REF]].tolist()):
+            if idx < 0: continue
+            char_idx, skill, skill_data = skills[idx]
+            row.update({KEY_CHARACTER: characters[char_idx], KEY_SKILL: skill, KEY_SKILL_DATA: skill_data})
+    for key, source in _CUMULATIVE_COLUMNS.items():
+        if rows and key not in rows[0] and all(source in row for row in rows):
+            for row, total in zip(rows, _cumulative_sum([row[source] for row in rows])): row[key] = total
+    return rows
+
+def _encode_calculation_result(result: Dict, tables: _Tables, keep_details: bool) -> Dict:
+    encoded = dict(result)
+    for phase_key in _PHASE_KEYS:
+        phase = result.get(phase_key)
+        if not isinstance(phase, dict): continue
+        phase = dict(phase)
+        if isinstance(phase.get("log"), list):
+            phase["log"] = {"$rows": _encode_rows(phase["log"], tables, () if keep_details else ("calculation_details",))}
+        if isinstance(phase.get("annotations"), list):
+            phase["annotations"] = {"$rows": _encode_rows(phase["annotations"], tables)}
+        encoded[phase_key] = phase
+    return encoded
+
+def _decode_calculation_result(encoded: Dict, tables: Dict, arrays: List[np.ndarray]) -> Dict:
+    result = dict(encoded)
+    for phase_key in _PHASE_KEYS:
+        phase = result.get(phase_key)
+        if not isinstance(phase, dict): continue
+        phase = dict(phase)
+        for list_key in ("log", "annotations"):
+            if isinstance(phase.get(list_key), dict) and "$rows" in phase[list_key]:
+                phase[list_key] = _decode_rows(phase[list_key]["$rows"], tables, arrays)
+        if isinstance(phase.get("log"), list):
+            for entry in phase["log"]: entry.setdefault("calculation_details", None)
+        result[phase_key] = phase
+    return result
+
+def encode_result(data: Dict, keep_details: bool = False) -> bytes:
+    """SharableResult または CalculationResult をバイナリにする"""
+    tables = _Tables()
+    document = to_json_compatible(data)
+    if "calculation_results" in document and isinstance(document["calculation_results"], dict):
+        document["calculation_results"] = _encode_calculation_result(document["calculation_results"], tables, keep_details)
+    elif any(k in document for k in _PHASE_KEYS):
+        document = _encode_calculation_result(document, tables, keep_details)
+    for key in _ACTION_LIST_KEYS:
+        if isinstance(document.get(key), list):
+            document[key] = {"$rows": _encode_rows(document[key], tables)}
+
+    header = json.dumps({
+        "characters": tables.characters,
+        "skills": tables.skills,
+        "arrays": [[a.dtype.str, len(a)] for a in tables.arrays],
+        "document": document,
+    }, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    body = struct.pack("<I", len(header)) + header + b"".join(a.tobytes() for a in tables.arrays)
+    return FORMAT_MAGIC + struct.pack("<B", FORMAT_VERSION) + zlib.compress(body, 9)
+
+def _decode_v1(body: bytes) -> Dict:
+    (header_len,) = struct.unpack_from("<I", body, 0)
+    header = json.loads(body[4:4 + header_len].decode("utf-8"))
+    arrays, offset = [], 4 + header_len
+    for dtype, length in header["arrays"]:
+        a = np.frombuffer(body, dtype=np.dtype(dtype), count=length, offset=offset)
+        arrays.append(a)
+        offset += a.nbytes
+
+    document = header["document"]
+    if isinstance(document.get("calculation_results"), dict):
+        document["calculation_results"] = _decode_calculation_result(document["calculation_results"], header, arrays)
+    elif any(k in document for k in _PHASE_KEYS):
+        document = _decode_calculation_result(document, header, arrays)
+    for key in _ACTION_LIST_KEYS:
+        if isinstance(document.get(key), dict) and "$rows" in document[key]:
+            document[key] = _decode_rows(document[key]["$rows"], header, arrays)
+    return document
+
+# バージョンごとの復号処理。形式を変えるときは FORMAT_VERSION を上げてここに足す
+_DECODERS = {1: _decode_v1}
+
+def is_encoded_result(data: bytes) -> bool:
+    return isinstance(data, (bytes, bytearray)) and bytes(data[:len(FORMAT_MAGIC)]) == FORMAT_MAGIC
+
+def decode_result(data: bytes) -> Dict:
+    """encode_result の逆。calculation_details は (keep_details で残していなければ) None になる"""
+    if not is_encoded_result(data) or len(data) <= len(FORMAT_MAGIC):
+        raise ResultCodecError("計算結果のバイナリ形式ではありません")
+    version = data[len(FORMAT_MAGIC)]
+    decoder = _DECODERS.get(version)
+    if decoder is None:
+        raise ResultCodecError(f"対応していない形式のバージョンです: {version} (対応: {sorted(_DECODERS)})")
+    try:
+        body = zlib.decompress(bytes(data[len(FORMAT_MAGIC) + 1:]))
+    except zlib.error as e:
+        raise ResultCodecError(f"データが壊れています: {e}") from e
+    return decoder(body)
+
+def restore_calculation_details(result: Dict, data_manager=None) -> int:
+    """
+    復号した SharableResult の calculation_details を process_rotation で計算し直して埋める。
+    ダメージが一致したログにだけ書き込み、埋めた件数を返す。
+    """
+    from calculator import process_rotation, gather_team_buffs
+    calculation_results = result.get("calculation_results") or {}
+    team_builds = result.get("team_builds") or []
+    recomputed = process_rotation(
+        team_builds, result.get("rotation_initial") or [], result.get("rotation_loop") or [], result.get("enemy_info") or {"level": 90},
+        gather_team_buffs(team_builds), result.get("stage_effects_name") or "", data_manager, [], [], annotate_actions=False
+    )
+    restored = 0
+    for phase_key in _PHASE_KEYS:
+        log = (calculation_results.get(phase_key) or {}).get("log") or []
+        new_log = (recomputed.get(phase_key) or {}).get("log") or []
+        if len(log) != len(new_log): continue
+        for entry, new_entry in zip(log, new_log):
+            if abs(entry.get("damage", 0.0) - new_entry["damage"]) <= 1e-6 * max(1.0, abs(new_entry["damage"])):
+                entry["calculation_details"] = new_entry["calculation_details"]
+                restored += 1
+    return restored
+
+def _diff(expected: Any, actual: Any, path: str, out: List[str]):
+    if isinstance(expected, dict) and isinstance(actual, dict):
+        for key in expected.keys() | actual.keys():
+            if key not in actual: out.append(f"{path}/{key}: 復号結果にありません")
+            elif key not in expected: out.append(f"{path}/{key}: 元データにありません")
+            else: _diff(expected[key], actual[key], f"{path}/{key}", out)
+    elif isinstance(expected, list) and isinstance(actual, list):
+        if len(expected) != len(actual):
+            out.append(f"{path}: 長さが違います ({len(expected)} != {len(actual)})")
+        for i, (e, a) in enumerate(zip(expected, actual)): _diff(e, a, f"{path}[{i}]", out)
+    elif type(expected) is not type(actual) or expected != actual:
+        out.append(f"{path}: {expected!r} != {actual!r}")
+
+def verify_round_trip(data: Dict, keep_details: bool = False) -> List[str]:
+    """
+    encode -> decode の結果を現行の JSON 形式と突き合わせ、違いのパスを返す (空なら一致)。
+    keep_details が False のときは、元データの calculation_details を None とみなして比べる。
+    """
+    expected = to_json_compatible(data)
+    if not keep_details:
+        calculation_results = expected.get("calculation_results", expected)
+        for phase_key in _PHASE_KEYS:
+            for entry in (calculation_results.get(phase_key) or {}).get("log") or []:
+                entry["calculation_details"] = None
+    differences: List[str] = []
+    _diff(expected, decode_result(encode_result(data, keep_details)), "", differences)
+    return differences
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """scenarios.json のシナリオで SharableResult を作り、往復の一致とサイズを確かめる"""
+    from calculator import process_rotation, gather_team_buffs
+    from game_data import GameData, DEFAULT_DATA_DIR
+    from scenarios import DEFAULT_SCENARIOS_PATH, load_scenarios, normalize_scenario
+
+    parser = argparse.ArgumentParser(description="計算結果のバイナリ形式の往復確認")
+    parser.add_argument("--names", nargs="*", help="scenarios.json 内のシナリオ名 (省略時はすべて)")
+    parser.add_argument("--scenarios", default=DEFAULT_SCENARIOS_PATH)
+    parser.add_argument("--data-dir", default=DEFAULT_DATA_DIR)
+    args = parser.parse_args(argv)
+
+    game_data = GameData.load_compiled(args.data_dir)
+    failed = False
+    for name, scenario in load_scenarios(args.scenarios, args.names).items():
+        s = normalize_scenario(scenario, game_data)
+        rotation_initial, rotation_loop = json.loads(json.dumps(s["rotation_initial"])), json.loads(json.dumps(s["rotation_loop"]))
+        results = process_rotation(s["team_builds"], rotation_initial, rotation_loop, s["enemy_info"], gather_team_buffs(s["team_builds"]),
+                                   s["stage_effects_name"], game_data, s["time_marks_initial"], s["time_marks_loop"])
+        sharable = {"calculation_results": results, "team_builds": s["team_builds"], "rotation_initial": rotation_initial,
+                    "rotation_loop": rotation_loop, "enemy_info": s["enemy_info"], "stage_effects_name": s["stage_effects_name"],
+                    "time_marks": s["time_marks_initial"], "active_comparison_sources": {}, "saved_by": "", "character_names": []}
+        for keep_details in (False, True):
+            differences = verify_round_trip(sharable, keep_details)
+            failed = failed or bool(differences)
+            json_size = len(json.dumps(to_json_compatible(sharable), ensure_ascii=False).encode("utf-8"))
+            print(f"{name} (keep_details={keep_details}): JSON {json_size:,} byte -> {len(encode_result(sharable, keep_details)):,} byte, "
+                  f"{'一致' if not differences else f'{len(differences)} 件の不一致'}")
+            for d in differences[:10]: print(f"  {d}")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,141 @@
+# scenarios.py
+import json
+import os
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Any
+
+from calculator import process_rotation, run_simulation_with_rng, gather_team_buffs
+from constants import KEY_CHARACTER, KEY_CHARACTER_NAME
+from app_types import Build, ScenarioComparisonRow
+from game_data import GameData, DEFAULT_DATA_DIR
+
+DEFAULT_SCENARIOS_PATH = os.path.join(DEFAULT_DATA_DIR, "scenarios.json")
+DEFAULT_NUM_LOOPS = 5 # UIのサマリー (初動 + 5ループ) に合わせる
+
+# ワーカープロセスごとに一度だけ受け取るゲームデータ
+_worker_game_data: Optional[GameData] = None
+
+def load_scenarios(path: str = DEFAULT_SCENARIOS_PATH, names: Optional[List[str]] = None) -> Dict[str, Dict]:
+    """scenarios.json を読み込み、names が指定されていればその順に絞り込む"""
+    with open(path, "r", encoding="utf-8") as f:
+        all_scenarios = json.load(f)
+    if names is None:
+        return all_scenarios
+    missing = [n for n in names if n not in all_scenarios]
+    if missing:
+        raise KeyError(f"シナリオが見つかりません: {', '.join(missing)}")
+    return {n: all_scenarios[n] for n in names}
+
+def normalize_scenario(scenario: Dict, game_data: Optional[GameData] = None) -> Dict[str, Any]:
+    """
+    保存形式の違い (builds / team_builds、time_marks の dict / list) を吸収し、
+    process_rotation にそのまま渡せる形に揃える。
+    """
+    builds: List[Build] = scenario.get("builds") or scenario.get("team_builds") or []
+    if game_data is not None:
+        builds = [game_data.resolve_build(b) for b in builds]
+    time_marks = scenario.get("time_marks") or {}
+    if isinstance(time_marks, list): # 旧形式: 初動用のみ
+        time_marks = {"initial": time_marks, "loop": []}
+    return {
+        "team_builds": builds,
+        "rotation_initial": scenario.get("rotation_initial", []),
+        "rotation_loop": scenario.get("rotation_loop", []),
+        "enemy_info": scenario.get("enemy_info") or {"level": 90},
+        "stage_effects_name": scenario.get("stage_effects_name", ""),
+        "time_marks_initial": time_marks.get("initial", []),
+        "time_marks_loop": time_marks.get("loop", []),
+    }
+
+def evaluate_scenario(name: str, scenario: Dict, game_data: GameData, num_loops: int = DEFAULT_NUM_LOOPS, num_simulations: int = 0) -> ScenarioComparisonRow:
+    """1つのシナリオを process_rotation で計算し、比較表の1行を返す (シナリオの Action は書き換えない)"""
+    s = normalize_scenario(scenario, game_data)
+    team_builds = s["team_builds"]
+    all_buffs = gather_team_buffs(team_builds)
+    result = process_rotation(
+        team_builds, s["rotation_initial"], s["rotation_loop"], s["enemy_info"], all_buffs,
+        s["stage_effects_name"], game_data, s["time_marks_initial"], s["time_marks_loop"], annotate_actions=False
+    )
+    initial_phase, loop_phase = result["initial_phase"], result["loop_phase"]
+
+    total_damage = initial_phase.get("total_damage", 0.0) + loop_phase.get("total_damage", 0.0) * num_loops
+    total_time = initial_phase.get("total_time", 0.0) + loop_phase.get("total_time", 0.0) * num_loops
+
+    damage_by_char = defaultdict(float)
+    for entry in initial_phase.get("log", []):
+        damage_by_char[entry[KEY_CHARACTER]] += entry["damage"]
+    for entry in loop_phase.get("log", []):
+        damage_by_char[entry[KEY_CHARACTER]] += entry["damage"] * num_loops
+    share_by_char = {c: (d / total_damage if total_damage > 0 else 0.0) for c, d in damage_by_char.items()}
+
+    simulation_stats = None
+    if num_simulations > 0:
+        stats = run_simulation_with_rng(
+            num_simulations, num_loops, team_builds, s["rotation_initial"], s["rotation_loop"],
+            s["enemy_info"], all_buffs, s["time_marks_initial"], s["time_marks_loop"]
+        )
+        simulation_stats = {k: (int(v) if k == "simulations_count" else float(v)) for k, v in stats.items()}
+
+    return {
+        "name": name,
+        "rank": 0,
+        "character_names": [b.get(KEY_CHARACTER_NAME) for b in team_builds if b.get(KEY_CHARACTER_NAME)],
+        "total_damage": total_damage,
+        "total_time": total_time,
+        "dps": total_damage / total_time if total_time > 0 else 0.0,
+        "damage_by_character": dict(damage_by_char),
+        "damage_share_by_character": share_by_char,
+        "simulation_stats": simulation_stats,
+        "error": None,
+    }
+
+def _init_worker(game_data: GameData):
+    global _worker_game_data
+    _worker_game_data = game_data
+
+def _evaluate_in_worker(args) -> ScenarioComparisonRow:
+    name, scenario, num_loops, num_simulations = args
+    return _safe_evaluate(name, scenario, _worker_game_data, num_loops, num_simulations)
+
+def _safe_evaluate(name: str, scenario: Dict, game_data: GameData, num_loops: int, num_simulations: int) -> ScenarioComparisonRow:
+    try:
+        return evaluate_scenario(name, scenario, game_data, num_loops, num_simulations)
+    except Exception as e:
+        return {
+            "name": name, "rank": 0, "character_names": [], "total_damage": 0.0, "total_time": 0.0, "dps": 0.0,
+            "damage_by_character": {}, "damage_share_by_character": {}, "simulation_stats": None,
+            "error": f"{type(e).__name__}: {e}",
+        }
+
+def compare_scenarios(scenarios_path: str = DEFAULT_SCENARIOS_PATH,
+                      names: Optional[List[str]] = None,
+                      game_data: Optional[GameData] = None,
+                      num_loops: int = DEFAULT_NUM_LOOPS,
+                      num_simulations: int = 0,
+                      max_workers: Optional[int] = None,
+                      sort_key: str = "dps") -> List[ScenarioComparisonRow]:
+    """
+    保存済みシナリオをまとめて計算し、sort_key (dps / total_damage) の降順で順位付けした表を返す。
+    ゲームデータは一度だけ読み込み、各ワーカーへは初期化時に一度だけ渡す。
+    max_workers が 1 以下、またはプロセスが使えない環境 (Pyodide) では逐次実行する。
+    """
+    scenarios = load_scenarios(scenarios_path, names)
+    if game_data is None:
+        game_data = GameData.load_compiled(os.path.dirname(os.path.abspath(scenarios_path)))
+
+    tasks = [(name, scenario, num_loops, num_simulations) for name, scenario in scenarios.items()]
+    rows: List[ScenarioComparisonRow] = []
+    if (max_workers is not None and max_workers <= 1) or len(tasks) <= 1:
+        rows = [_safe_evaluate(n, s, game_data, l, sims) for n, s, l, sims in tasks]
+    else:
+        try:
+            with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=(game_data,)) as executor:
+                rows = list(executor.map(_evaluate_in_worker, tasks))
+        except (OSError, NotImplementedError, ImportError):
+            rows = [_safe_evaluate(n, s, game_data, l, sims) for n, s, l, sims in tasks]
+
+    rows.sort(key=lambda r: (r["error"] is None, r.get(sort_key, 0.0)), reverse=True)
+    for i, row in enumerate(rows, start=1):
+        row["rank"] = i
+    return rows
@@ -501,6 +501,8 @@ document.addEventListener('DOMContentLoaded', async () => {
     let recalculateHelper = null;
     let exportersModule = null;
     let graphHelper = null;
+    // ?backend=http://127.0.0.1:8765 を付けて開くと、ダメージ計算を server.py のローカルサービスに任せる
+    const calcBackendUrl = new URLSearchParams(window.location.search).get('backend');
     let currentDataType = 'characters'; // どのデータタブを選択しているか
 
     let appState = {
@@ -665,17 +667,19 @@ async def generate_graph(results, theme_colors):
         await pyodide.loadPackage(["numpy", "matplotlib", "pillow"]);
 
         showStatus("Pythonモジュールを読み込み中...");
-        const [calcCode, constCode, appTypesCode, exportersCode, guiWidgetsCode] = await Promise.all([
+        const [calcCode, constCode, appTypesCode, exportersCode, guiWidgetsCode, resultCodecCode] = await Promise.all([
             fetch('./calculator.py').then(res => res.text()),
             fetch('./constants.py').then(res => res.text()),
             fetch('./app_types.py').then(res => res.text()),
             fetch('./exporters.py').then(res => res.text()),
-            fetch('./gui_widgets.py').then(res => res.text())
+            fetch('./gui_widgets.py').then(res => res.text()),
+            fetch('./result_codec.py').then(res => res.text())
         ]);
         pyodide.FS.writeFile("app_types.py", appTypesCode, { encoding: "utf8" });
         pyodide.FS.writeFile("constants.py", constCode, { encoding: "utf8" });
         pyodide.FS.writeFile("gui_widgets.py", guiWidgetsCode, { encoding: "utf8" });
         pyodide.FS.writeFile("calculator.py", calcCode, { encoding: "utf8" });
+        pyodide.FS.writeFile("result_codec.py", resultCodecCode, { encoding: "utf8" });
         pyodide.FS.writeFile("exporters.py", exportersCode, { encoding: "utf8" });
 
         pyodide.FS.writeFile("recalculate_helper.py", pythonRecalculateHelper, { encoding: "utf8" });
@@ -696,6 +700,20 @@ async def generate_graph(results, theme_colors):
         recalculateHelper = pyodide.pyimport("recalculate_helper");
         graphHelper = pyodide.pyimport("graph_helper");
 
+        // 開発者ツールから計算のプロファイルを取るための窓口
+        const profileProxyToJs = (proxy) => {
+            if (!proxy) return null;
+            const profile = proxy.toJs({ dict_converter: Object.fromEntries });
+            proxy.destroy();
+            return profile;
+        };
+        // 例: calcProfiler.enable(); (計算を実行); console.table(calcProfiler.report().stage_seconds);
+        window.calcProfiler = {
+            enable: () => { calculatorModule.enable_phase_profiling().destroy(); },
+            report: () => profileProxyToJs(calculatorModule.get_phase_profile()),
+            disable: () => profileProxyToJs(calculatorModule.disable_phase_profiling())
+        };
+
         showStatus("準備完了！", true);
     }
     
@@ -1252,26 +1270,57 @@ async def generate_graph(results, theme_colors):
     }
 
     // --- 計算結果画面 (Output View) ロジック ---
+    async function runRemoteProcessRotation() {
+        const response = await fetch(`${calcBackendUrl.replace(/\/$/, '')}/api/process_rotation`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({
+                team_builds: appState.team_builds,
+                rotation_initial: appState.rotation_initial,
+                rotation_loop: appState.rotation_loop,
+                enemy_info: { level: 90 },
+                all_buffs: {}, // Pyodide での計算 (calculatorModule.process_rotation) と同じバフ一覧を渡す
+                stage_effects_name: "",
+                time_marks_initial: [],
+                time_marks_loop: []
+            })
+        });
+        const results = await response.json();
+        if (!response.ok) throw new Error(results.error || `HTTP ${response.status}`);
+        return results;
+    }
+
     async function runCalculationAndShowResults() {
-        if (!pyodide || !calculatorModule) {
+        if (!calcBackendUrl && (!pyodide || !calculatorModule)) {
             alert("計算モジュールが初期化されていません。");
             return;
         }
         showStatus("最終ダメージ計算を実行中...");
 
-        const resultProxy = calculatorModule.process_rotation(
-            pyodide.toPy(appState.team_builds),
-            pyodide.toPy(appState.rotation_initial),
-            pyodide.toPy(appState.rotation_loop),
-            pyodide.toPy({ level: 90 }),
-            pyodide.toPy({}),
-            "",
-            null,
-            pyodide.toPy([]),
-            pyodide.toPy([])
-        );
-        const results = resultProxy.toJs({ dict_converter: Object.fromEntries });
-        resultProxy.destroy();
+        let results;
+        if (calcBackendUrl) {
+            try {
+                results = await runRemoteProcessRotation();
+            } catch (e) {
+                console.error("Remote calculation failed:", e);
+                alert(`計算サービスへのリクエストに失敗しました: ${e.message}`);
+                return;
+            }
+        } else {
+            const resultProxy = calculatorModule.process_rotation(
+                pyodide.toPy(appState.team_builds),
+                pyodide.toPy(appState.rotation_initial),
+                pyodide.toPy(appState.rotation_loop),
+                pyodide.toPy({ level: 90 }),
+                pyodide.toPy({}),
+                "",
+                null,
+                pyodide.toPy([]),
+                pyodide.toPy([])
+            );
+            results = resultProxy.toJs({ dict_converter: Object.fromEntries });
+            resultProxy.destroy();
+        }
 
         await renderOutputView(results);
         showStatus("計算完了！", true);
@@ -1323,8 +1372,32 @@ async def generate_graph(results, theme_colors):
         }
 
         const detailsContainer = document.getElementById('tab-content-details');
-        const logHtml = initialLog.map(log => `<p>${log.character}: ${log.skill} - ${log.damage.toFixed(0)}</p>`).join('');
-        detailsContainer.innerHTML = logHtml;
+        detailsContainer.innerHTML = '';
+        initialLog.forEach(log => {
+            const row = document.createElement('details');
+            row.innerHTML = `<summary>${log.character}: ${log.skill} - ${log.damage.toFixed(0)}</summary>`;
+            // 内訳の文字列は行を開いたときに初めて作る
+            row.addEventListener('toggle', () => {
+                if (!row.open || row.dataset.detailsLoaded) return;
+                row.dataset.detailsLoaded = '1';
+                const details = formatCalculationDetails(log.calculation_details);
+                row.insertAdjacentHTML('beforeend', Object.entries(details).map(([k, v]) => `<p>${k}: ${v}</p>`).join('') || '<p>内訳はありません</p>');
+            });
+            detailsContainer.appendChild(row);
+        });
+    }
+
+    function formatCalculationDetails(components) {
+        if (!components) return {};
+        if (!calculatorModule) { // 外部の計算サービスだけを使っているときは補正値をそのまま出す
+            return Object.fromEntries(Object.entries(components).map(([k, v]) => [k, typeof v === 'number' ? v.toFixed(3) : v]));
+        }
+        const componentsProxy = pyodide.toPy(components);
+        const proxy = calculatorModule.format_calculation_details(componentsProxy);
+        const details = proxy.toJs({ dict_converter: Object.fromEntries });
+        proxy.destroy();
+        componentsProxy.destroy();
+        return details;
     }
 
     // --- ユーティリティ ---
@@ -0,0 +1,258 @@
+# server.py
+"""
+calculator をローカルの HTTP/JSON サービスとして公開する。Pyodide の代わりにページの計算を受け持てる。
+
+    python server.py --port 8765 --workers 4
+    (ブラウザで http://127.0.0.1:8765/?backend=http://127.0.0.1:8765 を開く)
+
+  GET  /api/health            状態とキャッシュの統計
+  POST /api/process_rotation  {team_builds, rotation_initial, rotation_loop, enemy_info, stage_effects_name,
+                               time_marks_initial, time_marks_loop, ignore_buff} -> CalculationResult
+  POST /api/simulate          上記 + {num_simulations, num_loops} -> SimulationStats
+  それ以外の GET はリポジトリのファイル (index.html など) をそのまま返す。
+
+ゲームデータは起動時に一度だけ読み、ワーカープロセスへは初期化時に一度だけ渡す。
+同じ内容のリクエスト (JSON を正規化したハッシュが同じもの) は LRU キャッシュから返し、計算中のものには相乗りする。
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+from typing import Callable, Dict, Optional, Tuple
+
+from calculator import process_rotation, run_simulation_with_rng, gather_team_buffs
+from cli import json_default
+from game_data import GameData, DEFAULT_DATA_DIR
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+DEFAULT_CACHE_SIZE = 256
+MAX_REQUEST_BYTES = 16 * 1024 * 1024
+STATIC_ROOT = os.path.dirname(os.path.abspath(__file__))
+LOCAL_ORIGIN_HOSTS = ("localhost", "127.0.0.1")
+
+# ワーカープロセスごとに一度だけ受け取るゲームデータ
+_worker_game_data: Optional[GameData] = None
+
+def _init_worker(game_data: GameData):
+    global _worker_game_data
+    _worker_game_data = game_data
+
+def _prepare_payload(payload: Dict) -> Tuple[list, Dict]:
+    """ビルドにゲームデータを補完し、バフ一覧 (キーがなければチームから収集。空の {} はそのまま使う) と一緒に返す"""
+    team_builds = [_worker_game_data.resolve_build(b) for b in payload.get("team_builds") or []]
+    all_buffs = payload["all_buffs"] if "all_buffs" in payload else gather_team_buffs(team_builds)
+    return team_builds, all_buffs
+
+def _process_rotation_task(payload: Dict) -> Dict:
+    team_builds, all_buffs = _prepare_payload(payload)
+    return process_rotation(
+        team_builds, payload.get("rotation_initial") or [], payload.get("rotation_loop") or [], payload.get("enemy_info") or {"level": 90},
+        all_buffs, payload.get("stage_effects_name") or "", _worker_game_data,
+        payload.get("time_marks_initial") or [], payload.get("time_marks_loop") or [], payload.get("ignore_buff"), annotate_actions=False
+    )
+
+def _simulate_task(payload: Dict) -> Dict:
+    team_builds, all_buffs = _prepare_payload(payload)
+    return run_simulation_with_rng(
+        int(payload.get("num_simulations", 1000)), int(payload.get("num_loops", 1)), team_builds,
+        payload.get("rotation_initial") or [], payload.get("rotation_loop") or [], payload.get("enemy_info") or {"level": 90},
+        all_buffs, payload.get("time_marks_initial") or [], payload.get("time_marks_loop") or []
+    )
+
+# 乱数を使う計算はキャッシュしない
+ENDPOINTS: Dict[str, Tuple[Callable[[Dict], Dict], bool]] = {
+    "/api/process_rotation": (_process_rotation_task, True),
+    "/api/simulate": (_simulate_task, False),
+}
+
+def is_local_origin(origin: str) -> bool:
+    """Origin ヘッダーが http://localhost または http://127.0.0.1 (ポートは任意) か"""
+    try:
+        parts = urlsplit(origin)
+        parts.port # 不正なポートなら ValueError
+    except ValueError:
+        return False
+    return (parts.scheme == "http" and parts.hostname in LOCAL_ORIGIN_HOSTS and not parts.username and not parts.password
+            and parts.path == "" and not parts.query and not parts.fragment)
+
+def payload_hash(endpoint: str, payload: Dict) -> str:
+    """キーの順序や空白によらない、リクエスト内容のハッシュ"""
+    canonical = json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(",", ":"), default=json_default)
+    return hashlib.sha256(f"{endpoint}\n{canonical}".encode("utf-8")).hexdigest()
+
+class ResultCache:
+    """内容ハッシュ -> JSON 文字列の LRU キャッシュ (スレッドセーフ)"""
+    def __init__(self, max_size: int = DEFAULT_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            body = self._entries.get(key)
+            if body is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return body
+
+    def put(self, key: str, body: str):
+        if self.max_size <= 0: return
+        with self._lock:
+            self._entries[key] = body
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"size": len(self._entries), "max_size": self.max_size, "hits": self.hits, "misses": self.misses}
+
+class CalculationService:
+    """ゲームデータ・プロセスプール・キャッシュをまとめて持ち、リクエストを JSON 文字列の結果に変える"""
+    def __init__(self, game_data: GameData, workers: Optional[int] = None, cache_size: int = DEFAULT_CACHE_SIZE):
+        self.game_data = game_data
+        self.cache = ResultCache(cache_size)
+        self._inflight: Dict[str, Future] = {}
+        self._inflight_lock = threading.Lock()
+        self.executor = None
+        if workers is None or workers > 1:
+            try:
+                self.executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(game_data,))
+            except (OSError, NotImplementedError, ImportError):
+                self.executor = None
+        if self.executor is None:
+            _init_worker(game_data) # 逐次実行ではこのプロセス自身がワーカー
+
+    def calculate(self, endpoint: str, payload: Dict) -> Tuple[str, bool]:
+        """(結果の JSON 文字列, キャッシュから返したか) を返す"""
+        task, cacheable = ENDPOINTS[endpoint]
+        key = payload_hash(endpoint, payload)
+        if cacheable:
+            body = self.cache.get(key)
+            if body is not None: return body, True
+
+        with self._inflight_lock:
+            future = self._inflight.get(key) if cacheable else None
+            owner = future is None
+            if owner:
+                future = self.executor.submit(task, payload) if self.executor is not None else self._run_inline(task, payload)
+                if cacheable: self._inflight[key] = future
+        try:
+            body = json.dumps(future.result(), ensure_ascii=False, default=json_default)
+        finally:
+            if owner and cacheable:
+                with self._inflight_lock: self._inflight.pop(key, None)
+        if owner and cacheable: self.cache.put(key, body)
+        return body, False
+
+    @staticmethod
+    def _run_inline(task, payload: Dict) -> Future:
+        future = Future()
+        try: future.set_result(task(payload))
+        except Exception as e: future.set_exception(e)
+        return future
+
+    def shutdown(self):
+        if self.executor is not None: self.executor.shutdown(wait=True, cancel_futures=True)
+
+class CalculationRequestHandler(SimpleHTTPRequestHandler):
+    service: CalculationService = None # make_server で設定する
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, directory=STATIC_ROOT, **kwargs)
+
+    def end_headers(self):
+        # ページを別ポート (例: 開発用サーバー) から開いても呼べるように、ローカルからのアクセスは許可する
+        origin = self.headers.get("Origin", "")
+        if is_local_origin(origin):
+            self.send_header("Access-Control-Allow-Origin", origin)
+            self.send_header("Access-Control-Allow-Headers", "Content-Type")
+            self.send_header("Access-Control-Allow-Methods", "GET, POST, OPTIONS")
+        super().end_headers()
+
+    def _send_json(self, status: int, body: str, extra_headers: Optional[Dict[str, str]] = None):
+        data = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        for k, v in (extra_headers or {}).items(): self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_error_json(self, status: int, message: str):
+        self._send_json(status, json.dumps({"error": message}, ensure_ascii=False))
+
+    def do_OPTIONS(self):
+        self.send_response(204)
+        self.end_headers()
+
+    def do_GET(self):
+        if self.path.split("?")[0] == "/api/health":
+            self._send_json(200, json.dumps({"status": "ok", "cache": self.service.cache.stats(),
+                                             "workers": getattr(self.service.executor, "_max_workers", 1)}))
+            return
+        super().do_GET()
+
+    def do_POST(self):
+        endpoint = self.path.split("?")[0]
+        if endpoint not in ENDPOINTS:
+            self._send_error_json(404, f"不明なエンドポイントです: {endpoint}")
+            return
+        length = int(self.headers.get("Content-Length") or 0)
+        if length <= 0 or length > MAX_REQUEST_BYTES:
+            self._send_error_json(400 if length <= 0 else 413, "リクエストの本文が空、または大きすぎます")
+            return
+        try:
+            payload = json.loads(self.rfile.read(length).decode("utf-8"))
+            if not isinstance(payload, dict): raise ValueError("JSON オブジェクトを送ってください")
+        except (UnicodeDecodeError, ValueError) as e:
+            self._send_error_json(400, f"{type(e).__name__}: {e}")
+            return
+        try:
+            body, cached = self.service.calculate(endpoint, payload)
+        except Exception as e:
+            self._send_error_json(500, f"{type(e).__name__}: {e}")
+            return
+        self._send_json(200, body, {"X-Cache": "HIT" if cached else "MISS"})
+
+def make_server(host: str = DEFAULT_HOST, port: int = DEFAULT_PORT, data_dir: str = DEFAULT_DATA_DIR,
+                workers: Optional[int] = None, cache_size: int = DEFAULT_CACHE_SIZE) -> ThreadingHTTPServer:
+    service = CalculationService(GameData.load_compiled(data_dir), workers, cache_size)
+    handler = type("BoundCalculationRequestHandler", (CalculationRequestHandler,), {"service": service})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.service = service
+    return server
+
+def main(argv: Optional[list] = None) -> int:
+    parser = argparse.ArgumentParser(description="calculator のローカル HTTP サービス")
+    parser.add_argument("--host", default=DEFAULT_HOST, help="待ち受けるアドレス (既定はローカルのみ)")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--data-dir", default=DEFAULT_DATA_DIR, help="ゲームデータのディレクトリ")
+    parser.add_argument("--workers", type=int, default=None, help="ワーカープロセス数 (省略時は CPU 数、1 で逐次)")
+    parser.add_argument("--cache-size", type=int, default=DEFAULT_CACHE_SIZE, help="キャッシュする結果の件数 (0 で無効)")
+    args = parser.parse_args(argv)
+
+    server = make_server(args.host, args.port, args.data_dir, args.workers, args.cache_size)
+    print(f"http://{args.host}:{args.port}/ で待ち受けています (Ctrl+C で終了)", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.service.shutdown()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())